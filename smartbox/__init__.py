@@ -1,6 +1,47 @@
-from .error import SmartboxError  # noqa: F401
-from .session import Session  # noqa: F401
-from .socket import SocketSession  # noqa: F401
+from .ack import AckResult, AckTracker  # noqa: F401
+from .async_session import AsyncSession  # noqa: F401
+from .codec import get_json_codec_name, set_json_codec  # noqa: F401
+from .dev_data import (  # noqa: F401
+    get_node_setups,
+    get_node_states,
+    get_node_statuses,
+)
+from .dispatch import DispatchQueue, OverflowPolicy  # noqa: F401
+from .capabilities import CapabilityMap  # noqa: F401
+from .circuit_breaker import (  # noqa: F401
+    CircuitBreaker,
+    CircuitBreakerRegistry,
+    CircuitState,
+)
+from .error import (  # noqa: F401
+    CircuitOpenError,
+    SmartboxError,
+    UnsupportedEndpointError,
+)
+from .hedging import HedgePolicy  # noqa: F401
+from .models import (  # noqa: F401
+    AwayStatus,
+    Device,
+    Node,
+    NodeSetup,
+    NodeStatus,
+    nodes_from_dev_data,
+)
+from .metrics import PrometheusSessionMetrics, SessionMetrics  # noqa: F401
+from .programme import Programme, ProgrammeChange  # noqa: F401
+from .rate_limit import Priority, RequestScheduler  # noqa: F401
+from .session import ProgRollout, Session, SetupSource  # noqa: F401
+from .session_pool import SessionPool  # noqa: F401
+from .socket import SocketSession, SocketState  # noqa: F401
+from .socket_fleet import SocketFleet  # noqa: F401
+from .streaming import JSONArrayParser, iter_json_array  # noqa: F401
+from .token_store import (  # noqa: F401
+    FileTokenStore,
+    SqliteTokenStore,
+    TokenData,
+    TokenStore,
+)
 from .update_manager import UpdateManager  # noqa: F401
+from .write_buffer import WriteBuffer  # noqa: F401
 
 __version__ = "2.0.0-beta.2"
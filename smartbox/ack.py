@@ -0,0 +1,265 @@
+"""Tracking of when writes are acknowledged by socket updates from the
+device."""
+
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Union
+
+from .async_session import AsyncSession
+from .metrics import Histogram, format_histogram
+from .session import Session
+from .update_manager import UpdateManager
+
+_DEFAULT_ACK_TIMEOUT = 30.0
+# Actuation is much slower than HTTP requests, so needs wider buckets
+DEFAULT_ACK_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AckResult(NamedTuple):
+    """The update acknowledging a write, and the time from the write to the
+    update (in seconds)."""
+
+    body: Dict[str, Any]
+    latency: float
+
+
+def _values_match(expected: Any, actual: Any) -> bool:
+    if expected == actual:
+        return True
+    # The API is inconsistent about representing numbers as strings
+    try:
+        return float(expected) == float(actual)
+    except (TypeError, ValueError):
+        return str(expected).lower() == str(actual).lower()
+
+
+class _PendingAck(object):
+    def __init__(
+        self, expected: Dict[str, Any], future: asyncio.Future, start: float
+    ) -> None:
+        self.expected = expected
+        self.future = future
+        self.start = start
+
+    def matches(self, body: Dict[str, Any]) -> bool:
+        return all(
+            k in body and _values_match(v, body[k]) for k, v in self.expected.items()
+        )
+
+
+class AckTracker(object):
+    """Links REST writes to the socket updates which confirm them.
+
+    Writes made via the set_* coroutines (or registered with expect()) are
+    acknowledged by the first update on the written path whose body contains
+    all the written values. The time from the write to its acknowledgement
+    (i.e. the actuation latency, rather than the HTTP latency) is recorded in a
+    histogram per endpoint (e.g. status, setup, away_status).
+
+    Update paths don't include the device, so writes are made to the
+    UpdateManager's device. Must be used on the event loop running the
+    UpdateManager.
+    """
+
+    def __init__(
+        self,
+        update_manager: UpdateManager,
+        timeout: float = _DEFAULT_ACK_TIMEOUT,
+        latency_buckets: Sequence[float] = DEFAULT_ACK_LATENCY_BUCKETS,
+    ) -> None:
+        """Create an AckTracker receiving updates from update_manager."""
+        self._device_id = update_manager.socket_session.device_id
+        self._timeout = timeout
+        self._latency_buckets = latency_buckets
+        self._pending: Dict[str, List[_PendingAck]] = {}
+        self._latency: Dict[str, Histogram] = {}
+        self._acked = 0
+        self._timeouts = 0
+        update_manager.subscribe_to_updates(
+            r"^(?P<path>/.*)", ".body", self._update_cb, use_executor=False
+        )
+
+    def _update_cb(self, body: Dict[str, Any], path: str) -> None:
+        path = path.rstrip("/")
+        pending_acks = self._pending.get(path)
+        if not pending_acks or not isinstance(body, dict):
+            return
+        now = time.monotonic()
+        remaining = []
+        for pending in pending_acks:
+            if pending.future.done():
+                continue
+            if not pending.matches(body):
+                remaining.append(pending)
+                continue
+            latency = now - pending.start
+            _LOGGER.debug(f"Write to {path} acknowledged after {latency:.3f}s")
+            self._acked += 1
+            endpoint = path.rsplit("/", 1)[-1]
+            histogram = self._latency.get(endpoint)
+            if histogram is None:
+                histogram = Histogram(self._latency_buckets)
+                self._latency[endpoint] = histogram
+            histogram.observe(latency)
+            pending.future.set_result(AckResult(body, latency))
+        if remaining:
+            self._pending[path] = remaining
+        else:
+            del self._pending[path]
+
+    def _expire(self, path: str, pending: _PendingAck) -> None:
+        if pending.future.done():
+            return
+        _LOGGER.debug(f"Write to {path} not acknowledged within timeout")
+        self._timeouts += 1
+        pending.future.set_exception(
+            asyncio.TimeoutError(f"Write to {path} not acknowledged")
+        )
+
+    def _discard(self, path: str, pending: _PendingAck) -> None:
+        pending_acks = self._pending.get(path, [])
+        if pending in pending_acks:
+            pending_acks.remove(pending)
+        if not pending_acks:
+            self._pending.pop(path, None)
+
+    def expect(
+        self,
+        path: str,
+        expected: Dict[str, Any],
+        timeout: Optional[float] = None,
+    ) -> asyncio.Future:
+        """Expect an update on path (e.g. /htr/1/status) containing the
+        expected values.
+
+        Call this before making the write, so that the latency includes the
+        write itself and an update arriving before the write returns isn't
+        missed. Returns a future resolving to an AckResult, or raising
+        asyncio.TimeoutError if no matching update arrives within timeout
+        seconds.
+        """
+        loop = asyncio.get_running_loop()
+        path = path.rstrip("/")
+        pending = _PendingAck(
+            {k: v for k, v in expected.items() if v is not None},
+            loop.create_future(),
+            time.monotonic(),
+        )
+        self._pending.setdefault(path, []).append(pending)
+        handle = loop.call_later(
+            timeout if timeout is not None else self._timeout,
+            self._expire,
+            path,
+            pending,
+        )
+
+        def done(_: asyncio.Future) -> None:
+            handle.cancel()
+            self._discard(path, pending)
+
+        pending.future.add_done_callback(done)
+        return pending.future
+
+    async def _tracked_write(
+        self,
+        path: str,
+        expected: Dict[str, Any],
+        timeout: Optional[float],
+        write: Callable[..., Any],
+        *args: Any,
+    ) -> AckResult:
+        future = self.expect(path, expected, timeout)
+        try:
+            if asyncio.iscoroutinefunction(write):
+                await write(*args)
+            else:
+                await asyncio.get_running_loop().run_in_executor(None, write, *args)
+        except BaseException:
+            future.cancel()
+            raise
+        return await future
+
+    async def set_status(
+        self,
+        session: Union[Session, AsyncSession],
+        node: Dict[str, Any],
+        status_args: Dict[str, Any],
+        timeout: Optional[float] = None,
+    ) -> AckResult:
+        """Set node status and wait for the device to acknowledge it."""
+        return await self._tracked_write(
+            f"/{node['type']}/{node['addr']}/status",
+            status_args,
+            timeout,
+            session.set_status,
+            self._device_id,
+            node,
+            status_args,
+        )
+
+    async def set_setup(
+        self,
+        session: Union[Session, AsyncSession],
+        node: Dict[str, Any],
+        setup_args: Dict[str, Any],
+        timeout: Optional[float] = None,
+    ) -> AckResult:
+        """Set node setup and wait for the device to acknowledge it."""
+        return await self._tracked_write(
+            f"/{node['type']}/{node['addr']}/setup",
+            setup_args,
+            timeout,
+            session.set_setup,
+            self._device_id,
+            node,
+            setup_args,
+        )
+
+    async def set_device_away_status(
+        self,
+        session: Union[Session, AsyncSession],
+        status_args: Dict[str, Any],
+        timeout: Optional[float] = None,
+    ) -> AckResult:
+        """Set device away status and wait for the device to acknowledge it."""
+        return await self._tracked_write(
+            "/mgr/away_status",
+            status_args,
+            timeout,
+            session.set_device_away_status,
+            self._device_id,
+            status_args,
+        )
+
+    def get_latency(self, endpoint: str) -> Optional[Histogram]:
+        """Get the write to acknowledgement latency histogram for an endpoint
+        (e.g. status), if any."""
+        return self._latency.get(endpoint)
+
+    def stats(self) -> Dict[str, int]:
+        """Get the number of acknowledged, timed out and pending writes."""
+        return {
+            "acked": self._acked,
+            "timeouts": self._timeouts,
+            "pending": sum(len(p) for p in self._pending.values()),
+        }
+
+    def export_prometheus(self) -> str:
+        """Export latency histograms and counts in Prometheus text format."""
+        lines = [
+            "# HELP smartbox_ack_latency_seconds Write to acknowledgement latency",
+            "# TYPE smartbox_ack_latency_seconds histogram",
+        ]
+        for endpoint, histogram in sorted(self._latency.items()):
+            lines += format_histogram(
+                "smartbox_ack_latency_seconds", {"endpoint": endpoint}, histogram
+            )
+        lines += [
+            "# HELP smartbox_ack_timeouts_total Writes not acknowledged in time",
+            "# TYPE smartbox_ack_timeouts_total counter",
+            f"smartbox_ack_timeouts_total {self._timeouts}",
+        ]
+        return "\n".join(lines) + "\n"
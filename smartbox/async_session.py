@@ -0,0 +1,402 @@
+import aiohttp
+import asyncio
+import datetime
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from . import codec
+from .capabilities import CapabilityMap
+from .error import UnsupportedEndpointError
+from .programme import Programme
+from .session import (
+    _DEFAULT_BACKOFF_FACTOR,
+    _DEFAULT_MAX_CONCURRENCY,
+    _DEFAULT_RETRY_ATTEMPTS,
+    _MIN_TOKEN_LIFETIME,
+    _NODE_STATE_KINDS,
+    _RETRY_STATUS_CODES,
+    _get_token_request,
+    _parse_token_response,
+)
+from .streaming import DEFAULT_CHUNK_SIZE, JSONArrayParser
+
+_DEFAULT_POOL_SIZE = 100
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AsyncSession(object):
+    """asyncio equivalent of Session, using a pooled aiohttp client.
+
+    Methods mirror those on Session but are coroutines. The underlying
+    aiohttp.ClientSession is created lazily on first use so that it is bound to
+    the running event loop (which can then be shared with SocketSession and
+    UpdateManager). Authentication also happens lazily on the first request, or
+    explicitly via authenticate().
+
+    Unsupported node endpoints are tracked with a CapabilityMap as for Session.
+    """
+
+    def __init__(
+        self,
+        api_name: str,
+        basic_auth_credentials: str,
+        username: str,
+        password: str,
+        retry_attempts: int = _DEFAULT_RETRY_ATTEMPTS,
+        backoff_factor: float = _DEFAULT_BACKOFF_FACTOR,
+        pool_size: int = _DEFAULT_POOL_SIZE,
+        capabilities: Optional[CapabilityMap] = None,
+    ) -> None:
+        self._api_name = api_name
+        self._api_host = f"https://{self._api_name}.helki.com"
+        self._basic_auth_credentials = basic_auth_credentials
+        self._username = username
+        self._password = password
+        self._retry_attempts = retry_attempts
+        self._backoff_factor = backoff_factor
+        self._pool_size = pool_size
+        self._capabilities = (
+            capabilities if capabilities is not None else CapabilityMap()
+        )
+
+        self._client: Optional[aiohttp.ClientSession] = None
+        self._auth_lock: Optional[asyncio.Lock] = None
+        self._access_token: Optional[str] = None
+        self._refresh_token: Optional[str] = None
+        self._expires_at: Optional[datetime.datetime] = None
+
+    async def __aenter__(self) -> "AsyncSession":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
+
+    def _get_client(self) -> aiohttp.ClientSession:
+        if self._client is None or self._client.closed:
+            connector = aiohttp.TCPConnector(limit=self._pool_size)
+            self._client = aiohttp.ClientSession(connector=connector)
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def _request(self, method: str, url: str, **kwargs: Any) -> Any:
+        client = self._get_client()
+        for attempt in range(self._retry_attempts + 1):
+            try:
+                async with client.request(method, url, **kwargs) as response:
+                    if (
+                        response.status in _RETRY_STATUS_CODES
+                        and attempt < self._retry_attempts
+                    ):
+                        _LOGGER.debug(
+                            f"Received {response.status} from {url}, retrying"
+                        )
+                    else:
+                        response.raise_for_status()
+                        return codec.loads(await response.read())
+            except aiohttp.ClientConnectionError:
+                if attempt >= self._retry_attempts:
+                    raise
+                _LOGGER.debug(f"Connection error from {url}, retrying")
+            await asyncio.sleep(self._backoff_factor * (2**attempt))
+
+    async def _auth(self, credentials: Dict[str, str]) -> None:
+        token_data, token_headers = _get_token_request(
+            self._basic_auth_credentials, credentials
+        )
+
+        token_url = f"{self._api_host}/client/token"
+        r = await self._request(
+            "POST", token_url, data=token_data, headers=token_headers
+        )
+        (
+            self._access_token,
+            self._refresh_token,
+            self._expires_at,
+        ) = _parse_token_response(r)
+        _LOGGER.debug(
+            (
+                f"Authenticated session ({credentials['grant_type']}), "
+                f"access_token={self._access_token}, expires at {self._expires_at}"
+            )
+        )
+
+    def _has_token_expired(self, min_lifetime: float = _MIN_TOKEN_LIFETIME) -> bool:
+        if self._expires_at is None:
+            return True
+        return (self._expires_at - datetime.datetime.now()) < datetime.timedelta(
+            seconds=min_lifetime
+        )
+
+    async def authenticate(self) -> None:
+        """Obtain an access token using the username and password."""
+        await self._auth(
+            {
+                "grant_type": "password",
+                "username": self._username,
+                "password": self._password,
+            }
+        )
+
+    async def _check_refresh(self, min_lifetime: float = _MIN_TOKEN_LIFETIME) -> None:
+        if self._auth_lock is None:
+            self._auth_lock = asyncio.Lock()
+        async with self._auth_lock:
+            # Check again once we hold the lock, since a concurrent caller may
+            # have just refreshed
+            if not self._has_token_expired(min_lifetime):
+                return
+            if self._refresh_token is None:
+                await self.authenticate()
+            else:
+                await self._auth(
+                    {
+                        "grant_type": "refresh_token",
+                        "refresh_token": self._refresh_token,
+                    }
+                )
+
+    async def refresh_token_if_expiring(self, min_lifetime: float) -> None:
+        """Refresh the access token if it expires within min_lifetime
+        seconds."""
+        await self._check_refresh(min_lifetime)
+
+    def _get_headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self._access_token}",
+            "Content-Type": "application/json",
+            # TODO: generalise
+            "x-serialid": "5",
+        }
+
+    async def _api_request(self, path: str) -> Any:
+        if self._has_token_expired():
+            await self._check_refresh()
+        api_url = f"{self._api_host}/api/v2/{path}"
+        return await self._request("GET", api_url, headers=self._get_headers())
+
+    async def _api_post(self, data: Any, path: str) -> Any:
+        if self._has_token_expired():
+            await self._check_refresh()
+        api_url = f"{self._api_host}/api/v2/{path}"
+        data_str = codec.dumps(data)
+        _LOGGER.debug(f"Posting {data_str} to {api_url}")
+        try:
+            return await self._request(
+                "POST", api_url, data=data_str.encode(), headers=self._get_headers()
+            )
+        except aiohttp.ClientResponseError as e:
+            _LOGGER.error(e)
+            raise
+
+    def get_api_name(self) -> str:
+        return self._api_name
+
+    def get_access_token(self) -> Optional[str]:
+        return self._access_token
+
+    def get_refresh_token(self) -> Optional[str]:
+        return self._refresh_token
+
+    def get_expiry_time(self) -> Optional[datetime.datetime]:
+        return self._expires_at
+
+    async def get_devices(self) -> List[Dict[str, Any]]:
+        response = await self._api_request("devs")
+        return response["devs"]
+
+    async def get_grouped_devices(self):
+        response = await self._api_request("grouped_devs")
+        return response
+
+    async def _iter_api_array(
+        self, path: str, key: Optional[str]
+    ) -> AsyncIterator[Any]:
+        if self._has_token_expired():
+            await self._check_refresh()
+        api_url = f"{self._api_host}/api/v2/{path}"
+        parser = JSONArrayParser(key)
+        async with self._get_client().get(
+            api_url, headers=self._get_headers()
+        ) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(DEFAULT_CHUNK_SIZE):
+                for item in parser.feed(chunk):
+                    yield item
+                if parser.done:
+                    return
+        for item in parser.close():
+            yield item
+
+    def iter_devices(self) -> AsyncIterator[Dict[str, Any]]:
+        """Iterate over devices as the response is read, rather than loading
+        the whole listing into memory."""
+        return self._iter_api_array("devs", "devs")
+
+    def iter_grouped_devices(self) -> AsyncIterator[Dict[str, Any]]:
+        """Iterate over device groups as the response is read. Each group is
+        parsed whole, with all of its devices, before it is yielded."""
+        return self._iter_api_array("grouped_devs", None)
+
+    async def get_dev_data(self, device_id: str) -> Dict[str, Any]:
+        """Get all data for a device (nodes with status and setup, away status
+        etc) in a single request."""
+        return await self._api_request(f"devs/{device_id}/dev_data")
+
+    async def get_nodes(self, device_id: str) -> List[Dict[str, Any]]:
+        response = await self._api_request(f"devs/{device_id}/mgr/nodes")
+        return response["nodes"]
+
+    async def _node_api_request(
+        self, device_id: str, node: Dict[str, Any], endpoint: str
+    ) -> Any:
+        node_type, addr = node["type"], node["addr"]
+        if not self._capabilities.should_request(node_type, endpoint, device_id, addr):
+            raise UnsupportedEndpointError(
+                f"{endpoint} is not supported for {node_type} node {addr}"
+            )
+        try:
+            response = await self._api_request(
+                f"devs/{device_id}/{node_type}/{addr}/{endpoint}"
+            )
+        except aiohttp.ClientResponseError as e:
+            self._capabilities.record_failure(
+                node_type, endpoint, e.status, device_id, addr
+            )
+            raise
+        self._capabilities.record_success(node_type, endpoint, device_id, addr)
+        return response
+
+    def supports_endpoint(
+        self,
+        node_type: str,
+        endpoint: str,
+        device_id: Optional[str] = None,
+        addr: Any = None,
+    ) -> bool:
+        return self._capabilities.is_supported(node_type, endpoint, device_id, addr)
+
+    def get_capabilities(self) -> Dict[str, Dict[str, Optional[bool]]]:
+        return self._capabilities.get_capabilities()
+
+    async def get_status(self, device_id: str, node: Dict[str, Any]) -> Dict[str, str]:
+        try:
+            return await self._node_api_request(device_id, node, "status")
+        except (aiohttp.ClientError, asyncio.TimeoutError, UnsupportedEndpointError):
+            return {}
+
+    async def set_status(
+        self,
+        device_id: str,
+        node: Dict[str, Any],
+        status_args: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        data = {k: v for k, v in status_args.items() if v is not None}
+        if "stemp" in data and "units" not in data:
+            raise ValueError("Must supply unit with temperature fields")
+        return await self._api_post(
+            data=data, path=f"devs/{device_id}/{node['type']}/{node['addr']}/status"
+        )
+
+    async def get_setup(self, device_id: str, node: Dict[str, Any]) -> Dict[str, Any]:
+        return await self._node_api_request(device_id, node, "setup")
+
+    async def set_setup(
+        self,
+        device_id: str,
+        node: Dict[str, Any],
+        setup_args: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        data = {k: v for k, v in setup_args.items() if v is not None}
+        # setup seems to require all settings to be re-posted, so get current
+        # values and update
+        setup_data = await self.get_setup(device_id, node)
+        setup_data.update(data)
+        return await self._api_post(
+            data=setup_data,
+            path=f"devs/{device_id}/{node['type']}/{node['addr']}/setup",
+        )
+
+    async def get_prog(self, device_id: str, node: Dict[str, Any]) -> Programme:
+        return Programme.from_dict(
+            await self._node_api_request(device_id, node, "prog")
+        )
+
+    async def set_prog(
+        self, device_id: str, node: Dict[str, Any], prog: Programme
+    ) -> Dict[str, Any]:
+        return await self._api_post(
+            data=prog.to_dict(),
+            path=f"devs/{device_id}/{node['type']}/{node['addr']}/prog",
+        )
+
+    async def get_all_node_states(
+        self, kind: str = "status", max_concurrency: int = _DEFAULT_MAX_CONCURRENCY
+    ) -> Dict[Tuple[str, str, int], Any]:
+        """Get status, setup or prog for every node on every device.
+
+        Requests are issued concurrently (at most max_concurrency at a time) and
+        results are keyed by (dev_id, node_type, addr). Nodes known not to
+        support the endpoint are skipped (and logged). Statuses which can't be
+        fetched are {}, and setups and programmes None (and logged), so one
+        failing node doesn't lose the rest.
+        """
+        if kind not in _NODE_STATE_KINDS:
+            raise ValueError(f"Unknown node state kind {kind}")
+        getter = getattr(self, f"get_{kind}")
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def bounded(coro: Any) -> Any:
+            async with semaphore:
+                return await coro
+
+        async def get_state(key: Tuple[str, str, int], node: Dict[str, Any]) -> Any:
+            try:
+                return await bounded(getter(key[0], node))
+            except Exception as e:
+                _LOGGER.warning(f"Failed to get {kind} for {key}: {e}")
+                return None
+
+        dev_ids = [device["dev_id"] for device in await self.get_devices()]
+        dev_nodes = await asyncio.gather(
+            *[bounded(self.get_nodes(dev_id)) for dev_id in dev_ids]
+        )
+        keys = []
+        coros = []
+        skipped = []
+        for dev_id, nodes in zip(dev_ids, dev_nodes):
+            for node in nodes:
+                key = (dev_id, node["type"], node["addr"])
+                if not self.supports_endpoint(node["type"], kind, dev_id, node["addr"]):
+                    skipped.append(key)
+                    continue
+                keys.append(key)
+                coros.append(get_state(key, node))
+        if skipped:
+            _LOGGER.info(f"Skipped {kind} for unsupported nodes {skipped}")
+        return dict(zip(keys, await asyncio.gather(*coros)))
+
+    async def get_device_connected(self, device_id: str) -> bool:
+        resp = await self._api_request(f"devs/{device_id}/connected")
+        return bool(resp.get("connected")) if isinstance(resp, dict) else bool(resp)
+
+    async def get_device_away_status(self, device_id: str) -> Dict[str, Any]:
+        return await self._api_request(f"devs/{device_id}/mgr/away_status")
+
+    async def set_device_away_status(
+        self, device_id: str, status_args: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        data = {k: v for k, v in status_args.items() if v is not None}
+        return await self._api_post(data=data, path=f"devs/{device_id}/mgr/away_status")
+
+    async def get_device_power_limit(self, device_id: str) -> int:
+        resp = await self._api_request(f"devs/{device_id}/htr_system/power_limit")
+        return int(resp["power_limit"])
+
+    async def set_device_power_limit(self, device_id: str, power_limit: int) -> None:
+        data = {"power_limit": str(power_limit)}
+        await self._api_post(data=data, path=f"devs/{device_id}/htr_system/power_limit")
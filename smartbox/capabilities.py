@@ -0,0 +1,236 @@
+"""Tracking of which node endpoints each node (and node type) supports."""
+
+import logging
+import math
+import threading
+import time
+from typing import Any, Dict, Iterable, NamedTuple, Optional, Set, Tuple
+
+# Per-node endpoints, i.e. devs/<dev_id>/<node_type>/<addr>/<endpoint>
+NODE_ENDPOINTS = ("status", "setup", "prog", "version")
+
+# Endpoints known not to be supported by some node types, which are never
+# requested
+KNOWN_UNSUPPORTED: Tuple[Tuple[str, str], ...] = (("pmo", "status"),)
+
+# Responses indicating an endpoint is unsupported for a node. Bad requests,
+# auth errors and rate limiting say nothing about the endpoint, and server
+# errors are more likely to be transient or mean the device is offline (see
+# circuit_breaker).
+UNSUPPORTED_STATUS_CODES = frozenset([404, 405, 501])
+
+_DEFAULT_INITIAL_BACKOFF = 60.0
+_DEFAULT_MAX_BACKOFF = 3600.0
+# How many different nodes of a type must fail before the endpoint is assumed
+# to be unsupported for the whole type
+_DEFAULT_NODE_TYPE_THRESHOLD = 3
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class EndpointState(NamedTuple):
+    """What we know about an endpoint for a node or node type."""
+
+    supported: Optional[bool]
+    failures: int
+    retry_at: float
+    last_status: Optional[int]
+
+
+_UNKNOWN = EndpointState(None, 0, 0.0, None)
+
+
+class CapabilityMap(object):
+    """Learns which nodes support which node endpoints.
+
+    After a request to an endpoint fails with one of
+    UNSUPPORTED_STATUS_CODES, requests for that node (identified by device ID
+    and address) and endpoint are skipped until a backoff (doubling on each
+    consecutive failure from initial_backoff up to max_backoff) has passed,
+    when one request is allowed through to check again. A success resets the
+    backoff.
+
+    Once the endpoint has failed for node_type_threshold different nodes of a
+    type (without any succeeding), it is assumed to be unsupported for the
+    whole node type, with the same backoff. A CapabilityMap can be shared
+    between sessions. Calls without a device ID and address apply to the
+    node type.
+    """
+
+    def __init__(
+        self,
+        initial_backoff: float = _DEFAULT_INITIAL_BACKOFF,
+        max_backoff: float = _DEFAULT_MAX_BACKOFF,
+        known_unsupported: Iterable[Tuple[str, str]] = KNOWN_UNSUPPORTED,
+        node_type_threshold: int = _DEFAULT_NODE_TYPE_THRESHOLD,
+    ) -> None:
+        """Create a capability map, seeded with known unsupported endpoints
+        (by node type)."""
+        if node_type_threshold < 1:
+            raise ValueError("node_type_threshold must be at least 1")
+        self._initial_backoff = initial_backoff
+        self._max_backoff = max_backoff
+        self._node_type_threshold = node_type_threshold
+        self._lock = threading.Lock()
+        # Keyed by (node_type, endpoint) for node types, and (node_type,
+        # endpoint, dev_id, addr) for nodes
+        self._states: Dict[Tuple[str, ...], EndpointState] = {
+            key: EndpointState(False, 0, math.inf, None) for key in known_unsupported
+        }
+        # Nodes of each type currently failing for each endpoint
+        self._failing_nodes: Dict[Tuple[str, ...], Set[Tuple[str, str]]] = {}
+        self._skipped = 0
+
+    @staticmethod
+    def _keys(
+        node_type: str, endpoint: str, dev_id: Optional[str], addr: Any
+    ) -> Tuple[Tuple[str, ...], ...]:
+        """Get the state keys for the node type, and the node if given."""
+        type_key = (node_type, endpoint)
+        if dev_id is None:
+            return (type_key,)
+        return (type_key, (node_type, endpoint, dev_id, str(addr)))
+
+    def get_state(
+        self,
+        node_type: str,
+        endpoint: str,
+        dev_id: Optional[str] = None,
+        addr: Any = None,
+    ) -> EndpointState:
+        """Get the state of an endpoint for a node type, or a node if dev_id
+        and addr are given."""
+        return self._states.get(
+            self._keys(node_type, endpoint, dev_id, addr)[-1], _UNKNOWN
+        )
+
+    def should_request(
+        self,
+        node_type: str,
+        endpoint: str,
+        dev_id: Optional[str] = None,
+        addr: Any = None,
+    ) -> bool:
+        """Check whether a request should be made, i.e. the endpoint isn't
+        known to be unsupported for the node type or node, or its backoff has
+        passed.
+
+        If the backoff has passed, the next check is pushed back so that only
+        one caller retries the endpoint.
+        """
+        for key in self._keys(node_type, endpoint, dev_id, addr):
+            state = self._states.get(key)
+            if state is None or state.supported is not False:
+                continue
+            now = time.monotonic()
+            with self._lock:
+                state = self._states[key]
+                if now < state.retry_at:
+                    self._skipped += 1
+                    return False
+                self._states[key] = state._replace(retry_at=now + self._backoff(state))
+            _LOGGER.debug(f"Rechecking support for {endpoint} on {key}")
+            return True
+        return True
+
+    def is_supported(
+        self,
+        node_type: str,
+        endpoint: str,
+        dev_id: Optional[str] = None,
+        addr: Any = None,
+    ) -> bool:
+        """Check whether an endpoint is usable for a node type (or node), i.e.
+        not known to be unsupported (or backed off after failures)."""
+        now = time.monotonic()
+        for key in self._keys(node_type, endpoint, dev_id, addr):
+            state = self._states.get(key, _UNKNOWN)
+            if state.supported is False and now < state.retry_at:
+                return False
+        return True
+
+    def _backoff(self, state: EndpointState) -> float:
+        return min(
+            self._initial_backoff * (2 ** max(state.failures - 1, 0)),
+            self._max_backoff,
+        )
+
+    def record_success(
+        self,
+        node_type: str,
+        endpoint: str,
+        dev_id: Optional[str] = None,
+        addr: Any = None,
+    ) -> None:
+        """Record a successful request for a node (or node type)."""
+        keys = self._keys(node_type, endpoint, dev_id, addr)
+        if all(self._states.get(k, _UNKNOWN).supported is True for k in keys):
+            return
+        with self._lock:
+            for key in keys:
+                self._states[key] = EndpointState(True, 0, 0.0, None)
+            self._failing_nodes.pop((node_type, endpoint), None)
+
+    def _record_failure(self, key: Tuple[str, ...], status: int) -> float:
+        state = self._states.get(key, _UNKNOWN)
+        state = EndpointState(False, state.failures + 1, 0.0, status)
+        backoff = self._backoff(state)
+        self._states[key] = state._replace(retry_at=time.monotonic() + backoff)
+        return backoff
+
+    def record_failure(
+        self,
+        node_type: str,
+        endpoint: str,
+        status: int,
+        dev_id: Optional[str] = None,
+        addr: Any = None,
+    ) -> bool:
+        """Record a failed request for a node (or node type) with the given
+        HTTP status.
+
+        Returns whether the failure marked the endpoint as unsupported.
+        """
+        if status not in UNSUPPORTED_STATUS_CODES:
+            return False
+        type_key, *node_key = self._keys(node_type, endpoint, dev_id, addr)
+        with self._lock:
+            if node_key:
+                backoff = self._record_failure(node_key[0], status)
+                _LOGGER.debug(
+                    f"{endpoint} failed with {status} on {node_type} node {addr}"
+                    f" of {dev_id}, skipping for {backoff}s"
+                )
+                failing = self._failing_nodes.setdefault(type_key, set())
+                failing.add((str(dev_id), str(addr)))
+                # Once the type is unsupported, failures when rechecking it
+                # keep it so
+                if (
+                    len(failing) < self._node_type_threshold
+                    and self._states.get(type_key, _UNKNOWN).supported is not False
+                ):
+                    return True
+            backoff = self._record_failure(type_key, status)
+        _LOGGER.debug(
+            f"{endpoint} failed with {status} on {node_type} nodes, "
+            f"skipping for {backoff}s"
+        )
+        return True
+
+    def get_capabilities(self) -> Dict[str, Dict[str, Optional[bool]]]:
+        """Get the capability map, i.e. for each node type seen, whether each
+        endpoint is supported (None if unknown)."""
+        with self._lock:
+            states = {k: v for k, v in self._states.items() if len(k) == 2}
+        capabilities: Dict[str, Dict[str, Optional[bool]]] = {}
+        for (node_type, endpoint), state in states.items():
+            node_capabilities = capabilities.setdefault(
+                node_type, {e: None for e in NODE_ENDPOINTS}
+            )
+            node_capabilities[endpoint] = state.supported
+        return capabilities
+
+    @property
+    def skipped(self) -> int:
+        """Get the number of requests skipped."""
+        return self._skipped
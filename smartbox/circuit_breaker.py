@@ -0,0 +1,236 @@
+"""Per-device circuit breakers, to fail fast while a device is offline."""
+
+from enum import Enum
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple, Type, TypeVar
+
+from .error import CircuitOpenError
+
+_DEFAULT_FAILURE_THRESHOLD = 3
+_DEFAULT_RESET_TIMEOUT = 30.0
+_DEFAULT_MAX_RESET_TIMEOUT = 600.0
+
+_LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class CircuitState(str, Enum):
+    """State of a circuit breaker."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker(object):
+    """Circuit breaker for requests to a device.
+
+    After failure_threshold consecutive failures the circuit opens, and
+    requests fail immediately with CircuitOpenError. After reset_timeout
+    seconds the circuit becomes half-open and a single probe request is
+    allowed through: if it succeeds the circuit closes, otherwise it opens
+    again with the timeout doubled (up to max_reset_timeout).
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = _DEFAULT_FAILURE_THRESHOLD,
+        reset_timeout: float = _DEFAULT_RESET_TIMEOUT,
+        max_reset_timeout: float = _DEFAULT_MAX_RESET_TIMEOUT,
+        name: str = "",
+    ) -> None:
+        """Create a closed circuit breaker."""
+        if failure_threshold < 1:
+            raise ValueError("failure_threshold must be at least 1")
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._max_reset_timeout = max_reset_timeout
+        self._name = name
+        self._lock = threading.Lock()
+        self._state = CircuitState.CLOSED
+        self._failures = 0
+        self._open_timeout = reset_timeout
+        self._open_until = 0.0
+        self._probe_in_flight = False
+        self._rejected = 0
+        self._opened = 0
+
+    @property
+    def state(self) -> CircuitState:
+        """Get the current state."""
+        return self._state
+
+    def retry_delay(self) -> float:
+        """Get the time until a probe request will be allowed (0 if requests
+        are currently allowed)."""
+        with self._lock:
+            if self._state == CircuitState.OPEN:
+                return max(self._open_until - time.monotonic(), 0.0)
+            return 0.0
+
+    def before_request(self) -> CircuitState:
+        """Check whether a request may be made, raising CircuitOpenError if
+        not.
+
+        Returns CircuitState.HALF_OPEN if the caller is making the probe
+        request, in which case it must report the outcome with record_success
+        or record_failure.
+        """
+        with self._lock:
+            if self._state == CircuitState.CLOSED:
+                return CircuitState.CLOSED
+            if (
+                self._state == CircuitState.OPEN
+                and time.monotonic() >= self._open_until
+            ):
+                _LOGGER.debug(f"Circuit {self._name} half-open, probing")
+                self._state = CircuitState.HALF_OPEN
+                self._probe_in_flight = False
+            if self._state == CircuitState.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return CircuitState.HALF_OPEN
+            self._rejected += 1
+        raise CircuitOpenError(f"Circuit for {self._name} is open")
+
+    def record_success(self) -> None:
+        """Record a successful request, closing the circuit."""
+        with self._lock:
+            if self._state != CircuitState.CLOSED:
+                _LOGGER.info(f"Circuit {self._name} closed")
+            self._state = CircuitState.CLOSED
+            self._failures = 0
+            self._open_timeout = self._reset_timeout
+            self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """Give up the probe request without recording an outcome, e.g. if it
+        failed for a reason that says nothing about the device, so another
+        request can probe it."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        """Record a failed request, opening the circuit if there have been
+        too many."""
+        with self._lock:
+            self._failures += 1
+            if self._state == CircuitState.HALF_OPEN:
+                # Probe failed, back off further
+                self._open_timeout = min(
+                    self._open_timeout * 2, self._max_reset_timeout
+                )
+            elif (
+                self._state == CircuitState.OPEN
+                or self._failures < self._failure_threshold
+            ):
+                return
+            self._state = CircuitState.OPEN
+            self._open_until = time.monotonic() + self._open_timeout
+            self._probe_in_flight = False
+            self._opened += 1
+        _LOGGER.warning(
+            f"Circuit {self._name} opened after {self._failures} failures"
+            f", retrying in {self._open_timeout}s"
+        )
+
+    def call(
+        self,
+        func: Callable[[], T],
+        probe: Optional[Callable[[], bool]] = None,
+        failure_exceptions: Tuple[Type[BaseException], ...] = (Exception,),
+        is_failure: Optional[Callable[[T], bool]] = None,
+    ) -> T:
+        """Call func through the circuit breaker.
+
+        Exceptions in failure_exceptions, or results for which is_failure
+        returns True, count as failures. If given, probe is used as a cheap
+        health check before the first request when half-open.
+        """
+        state = self.before_request()
+        try:
+            if state == CircuitState.HALF_OPEN and probe is not None:
+                try:
+                    healthy = probe()
+                except Exception:
+                    _LOGGER.debug(
+                        f"Health check for {self._name} failed", exc_info=True
+                    )
+                    healthy = False
+                if not healthy:
+                    self.record_failure()
+                    raise CircuitOpenError(f"Health check for {self._name} failed")
+            try:
+                result = func()
+            except failure_exceptions:
+                self.record_failure()
+                raise
+            except Exception:
+                # Not a failure of the device (e.g. a bad request)
+                self.record_success()
+                raise
+        except Exception:
+            raise
+        except BaseException:
+            # Interrupted (e.g. KeyboardInterrupt), which says nothing about
+            # the device, but let another request probe it
+            if state == CircuitState.HALF_OPEN:
+                self.release_probe()
+            raise
+        if is_failure is not None and is_failure(result):
+            self.record_failure()
+        else:
+            self.record_success()
+        return result
+
+    def stats(self) -> Dict[str, float]:
+        """Get the state, consecutive failures, and rejected and opened
+        counts."""
+        with self._lock:
+            return {
+                "state": self._state.value,  # type: ignore
+                "failures": self._failures,
+                "rejected": self._rejected,
+                "opened": self._opened,
+            }
+
+
+class CircuitBreakerRegistry(object):
+    """Circuit breakers for each device, created on demand with the given
+    arguments."""
+
+    def __init__(
+        self,
+        failure_threshold: int = _DEFAULT_FAILURE_THRESHOLD,
+        reset_timeout: float = _DEFAULT_RESET_TIMEOUT,
+        max_reset_timeout: float = _DEFAULT_MAX_RESET_TIMEOUT,
+    ) -> None:
+        """Create an empty registry."""
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._max_reset_timeout = max_reset_timeout
+        self._lock = threading.Lock()
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, device_id: str) -> CircuitBreaker:
+        """Get the circuit breaker for a device."""
+        breaker = self._breakers.get(device_id)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(device_id)
+                if breaker is None:
+                    breaker = CircuitBreaker(
+                        self._failure_threshold,
+                        self._reset_timeout,
+                        self._max_reset_timeout,
+                        name=device_id,
+                    )
+                    self._breakers[device_id] = breaker
+        return breaker
+
+    def get_states(self) -> Dict[str, CircuitState]:
+        """Get the state of each device's circuit breaker."""
+        with self._lock:
+            return {dev_id: b.state for dev_id, b in self._breakers.items()}
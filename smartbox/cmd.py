@@ -1,16 +1,20 @@
 import asyncio
 import click
-import json
 import logging
 
+from . import codec
 from .session import Session
 from .socket import SocketSession
 
 _LOGGER = logging.getLogger(__name__)
 
+# Commands can be chained, so cache topology (devices, nodes) for a few
+# minutes, which covers a typical CLI run
+_CLI_CACHE_TTL = 300
+
 
 def _pretty_print(data):
-    print(json.dumps(data, indent=4, sort_keys=True))
+    print(codec.dumps(data, indent=4, sort_keys=True))
 
 
 @click.group(chain=True)
@@ -23,8 +27,14 @@ def _pretty_print(data):
 @click.option(
     "-v", "--verbose/--no-verbose", default=False, help="Enable verbose logging"
 )
+@click.option(
+    "--json-codec",
+    type=click.Choice(codec.CODEC_NAMES),
+    default=None,
+    help="JSON codec (defaults to the fastest installed)",
+)
 @click.pass_context
-def smartbox(ctx, api_name, basic_auth_creds, username, password, verbose):
+def smartbox(ctx, api_name, basic_auth_creds, username, password, verbose, json_codec):
     ctx.ensure_object(dict)
     logging.basicConfig(
         format="%(asctime)s %(levelname)-8s "
@@ -32,7 +42,10 @@ def smartbox(ctx, api_name, basic_auth_creds, username, password, verbose):
         level=logging.DEBUG if verbose else logging.INFO,
         datefmt="%Y-%m-%d %H:%M:%S",
     )
-    session = Session(api_name, basic_auth_creds, username, password)
+    codec.set_json_codec(json_codec)
+    session = Session(
+        api_name, basic_auth_creds, username, password, cache_ttl=_CLI_CACHE_TTL
+    )
     ctx.obj["session"] = session
     ctx.obj["verbose"] = verbose
 
@@ -69,7 +82,9 @@ def status(ctx):
 
         for node in nodes:
             print(f"{node['name']} (addr: {node['addr']})")
-            if node['type'] == "pmo":
+            if not session.supports_endpoint(
+                node["type"], "status", device["dev_id"], node["addr"]
+            ):
                 continue
             status = session.get_status(device["dev_id"], node)
             _pretty_print(status)
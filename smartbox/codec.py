@@ -0,0 +1,137 @@
+"""Pluggable JSON codec used for REST and socket payloads.
+
+The fastest available of orjson, ujson and the stdlib json module is used by
+default. The module-level dumps() and loads() functions follow the stdlib
+signatures closely enough that this module can be passed to python-socketio as
+its json module.
+"""
+
+import json
+import logging
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None  # type: ignore
+
+_LOGGER = logging.getLogger(__name__)
+
+# In order of preference
+CODEC_NAMES = ("orjson", "ujson", "json")
+
+
+def _json_dumps(
+    obj: Any,
+    indent: Optional[int] = None,
+    sort_keys: bool = False,
+    separators: Optional[Tuple[str, str]] = None,
+) -> str:
+    return json.dumps(obj, indent=indent, sort_keys=sort_keys, separators=separators)
+
+
+def _json_loads(s: Union[str, bytes]) -> Any:
+    return json.loads(s)
+
+
+def _orjson_dumps(
+    obj: Any,
+    indent: Optional[int] = None,
+    sort_keys: bool = False,
+    separators: Optional[Tuple[str, str]] = None,
+) -> str:
+    if indent not in (None, 2) or separators not in (None, (",", ":")):
+        # orjson only supports compact or 2 space indented output
+        return _json_dumps(obj, indent, sort_keys, separators)
+    option = 0
+    if indent is not None:
+        option |= orjson.OPT_INDENT_2
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    return orjson.dumps(obj, option=option).decode()
+
+
+def _ujson_dumps(
+    obj: Any,
+    indent: Optional[int] = None,
+    sort_keys: bool = False,
+    separators: Optional[Tuple[str, str]] = None,
+) -> str:
+    if separators not in (None, (",", ":")):
+        return _json_dumps(obj, indent, sort_keys, separators)
+    return ujson.dumps(obj, indent=indent or 0, sort_keys=sort_keys)
+
+
+def _get_codecs() -> Dict[str, Tuple[Callable[..., str], Callable[[Any], Any]]]:
+    codecs: Dict[str, Tuple[Callable[..., str], Callable[[Any], Any]]] = {
+        "json": (_json_dumps, _json_loads)
+    }
+    if orjson is not None:
+        codecs["orjson"] = (_orjson_dumps, orjson.loads)
+    if ujson is not None:
+        codecs["ujson"] = (_ujson_dumps, ujson.loads)
+    return codecs
+
+
+_CODECS = _get_codecs()
+_codec_name = next(name for name in CODEC_NAMES if name in _CODECS)
+_dumps, _loads = _CODECS[_codec_name]
+# Whether a codec was chosen with set_json_codec, rather than by default
+_codec_selected = False
+
+
+def get_available_json_codecs() -> Tuple[str, ...]:
+    """Get the names of the installed codecs, in order of preference."""
+    return tuple(name for name in CODEC_NAMES if name in _CODECS)
+
+
+def get_json_codec_name() -> str:
+    """Get the name of the codec in use."""
+    return _codec_name
+
+
+def is_json_codec_selected() -> bool:
+    """Get whether a codec has been selected by name with set_json_codec."""
+    return _codec_selected
+
+
+def set_json_codec(name: Optional[str] = None) -> None:
+    """Select the codec to use by name ('orjson', 'ujson' or 'json'), or the
+    fastest available if name is None.
+
+    Note that once a codec is selected by name, SocketSession passes this
+    module to python-socketio as its json module, which (in python-socketio
+    4.x) replaces the JSON handling of every socketio client in the process,
+    not just smartbox's. Without a selection, socketio's default is left
+    alone.
+    """
+    global _codec_name, _dumps, _loads, _codec_selected
+    explicit = name is not None
+    if name is None:
+        name = get_available_json_codecs()[0]
+    if name not in CODEC_NAMES:
+        raise ValueError(f"Unknown JSON codec {name}")
+    if name not in _CODECS:
+        raise ValueError(f"JSON codec {name} is not installed")
+    _LOGGER.debug(f"Using JSON codec {name}")
+    _dumps, _loads = _CODECS[name]
+    _codec_name = name
+    _codec_selected = explicit
+
+
+def dumps(obj: Any, **kwargs: Any) -> str:
+    """Serialise obj to a JSON string.
+
+    Supports the indent, sort_keys and separators arguments of json.dumps.
+    """
+    return _dumps(obj, **kwargs)
+
+
+def loads(s: Union[str, bytes, bytearray]) -> Any:
+    """Deserialise a JSON document from a str or UTF-8 bytes."""
+    return _loads(s)
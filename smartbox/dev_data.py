@@ -0,0 +1,30 @@
+"""Helpers for unpacking dev_data responses."""
+
+from typing import Any, Dict, Tuple
+
+
+def get_node_states(
+    dev_data: Dict[str, Any], kind: str
+) -> Dict[Tuple[str, int], Dict[str, Any]]:
+    """Return the given kind of node state (e.g. status or setup) from dev data.
+
+    Results are keyed by (node_type, addr), with addr converted to an int as for
+    UpdateManager node callbacks. Nodes without the requested state are omitted.
+    """
+    return {
+        (node["type"], int(node["addr"])): node[kind]
+        for node in dev_data.get("nodes", [])
+        if node.get(kind) is not None
+    }
+
+
+def get_node_statuses(
+    dev_data: Dict[str, Any],
+) -> Dict[Tuple[str, int], Dict[str, Any]]:
+    """Return node statuses from dev data, keyed by (node_type, addr)."""
+    return get_node_states(dev_data, "status")
+
+
+def get_node_setups(dev_data: Dict[str, Any]) -> Dict[Tuple[str, int], Dict[str, Any]]:
+    """Return node setups from dev data, keyed by (node_type, addr)."""
+    return get_node_states(dev_data, "setup")
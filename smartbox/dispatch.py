@@ -0,0 +1,231 @@
+"""Bounded queue for running socket callbacks outside the receive loop."""
+
+import asyncio
+from collections import OrderedDict
+import concurrent.futures
+from enum import Enum
+import inspect
+import logging
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+_DEFAULT_MAXSIZE = 1000
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class OverflowPolicy(str, Enum):
+    """What a DispatchQueue does with a new callback when it is full."""
+
+    # Wait for space, applying backpressure to the socket
+    BLOCK = "block"
+    # Discard the oldest queued callback
+    DROP_OLDEST = "drop_oldest"
+    # Always replace (or merge with) a queued callback with the same key
+    # (e.g. update path), otherwise discard the oldest
+    COALESCE = "coalesce"
+
+
+class _Item(object):
+    __slots__ = ("func", "args", "key", "enqueued")
+
+    def __init__(
+        self, func: Callable, args: tuple, key: Optional[Hashable], enqueued: float
+    ) -> None:
+        self.func = func
+        self.args = args
+        self.key = key
+        self.enqueued = enqueued
+
+
+class DispatchQueue(object):
+    """Bounded queue of callbacks, run in order by worker tasks.
+
+    Lets the socket receive loop hand off callbacks (which may be slow, e.g.
+    writing to a database) rather than running them inline, which would delay
+    pings and can get the socket disconnected. Callbacks returning awaitables
+    are awaited; if an executor is given, other callbacks are run in it so
+    they can block. With more than one worker, callbacks may run
+    concurrently and finish out of order.
+
+    With OverflowPolicy.COALESCE, only the latest callback for each key is
+    kept, so it only suits callbacks which receive the whole of the state
+    for that key, unless a merge function is given to combine the arguments
+    of the queued and new callbacks (as SocketSession does for the partial
+    bodies of updates).
+
+    Workers are started on the running event loop when the first callback is
+    queued. One queue may be shared by many sockets.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = _DEFAULT_MAXSIZE,
+        policy: OverflowPolicy = OverflowPolicy.BLOCK,
+        workers: int = 1,
+        executor: Optional[concurrent.futures.Executor] = None,
+    ) -> None:
+        """Create an empty queue."""
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self._maxsize = maxsize
+        self._policy = OverflowPolicy(policy)
+        self._num_workers = workers
+        self._executor = executor
+        # Queued items by sequence number, in order, and the sequence number
+        # of the queued item for each key
+        self._items: "OrderedDict[int, _Item]" = OrderedDict()
+        self._keys: Dict[Hashable, int] = {}
+        self._seq = 0
+        self._condition: Optional[asyncio.Condition] = None
+        self._workers: List[asyncio.Future] = []
+        self._active = 0
+        self._max_depth = 0
+        self._enqueued = 0
+        self._dispatched = 0
+        self._dropped = 0
+        self._coalesced = 0
+        self._blocked = 0
+        self._errors = 0
+        self._lag_total = 0.0
+        self._lag_max = 0.0
+
+    def _start(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+            self._workers = [
+                asyncio.ensure_future(self._work()) for _ in range(self._num_workers)
+            ]
+        return self._condition
+
+    def _pop(self, seq: Optional[int] = None) -> _Item:
+        if seq is None:
+            seq, item = self._items.popitem(last=False)
+        else:
+            item = self._items.pop(seq)
+        if item.key is not None and self._keys.get(item.key) == seq:
+            del self._keys[item.key]
+        return item
+
+    @property
+    def executor(self) -> Optional[concurrent.futures.Executor]:
+        """Get the executor for blocking callbacks, if any."""
+        return self._executor
+
+    async def put(
+        self,
+        func: Callable,
+        *args: Any,
+        key: Optional[Hashable] = None,
+        merge: Optional[Callable[[tuple, tuple], tuple]] = None,
+    ):
+        """Queue func to be called with args, applying the overflow policy if
+        the queue is full.
+
+        key is used for coalescing, in which case merge (if given) is called
+        with the args of the queued callback and the new args, and returns
+        the args to queue.
+        """
+        condition = self._start()
+        async with condition:
+            if self._policy == OverflowPolicy.COALESCE and key in self._keys:
+                replaced = self._pop(self._keys[key])
+                if merge is not None:
+                    args = merge(replaced.args, args)
+                self._coalesced += 1
+            if len(self._items) >= self._maxsize and self._policy == (
+                OverflowPolicy.BLOCK
+            ):
+                self._blocked += 1
+                await condition.wait_for(lambda: len(self._items) < self._maxsize)
+            while len(self._items) >= self._maxsize:
+                dropped = self._pop()
+                self._dropped += 1
+                _LOGGER.debug(f"Dispatch queue full, dropped {dropped.func}")
+            self._seq += 1
+            self._items[self._seq] = _Item(func, args, key, time.monotonic())
+            if key is not None:
+                self._keys[key] = self._seq
+            self._enqueued += 1
+            self._max_depth = max(self._max_depth, len(self._items))
+            condition.notify_all()
+
+    async def _call(self, item: _Item) -> None:
+        if self._executor is not None and not asyncio.iscoroutinefunction(item.func):
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._executor, item.func, *item.args)
+        else:
+            result = item.func(*item.args)
+        if inspect.isawaitable(result):
+            await result
+
+    async def _work(self) -> None:
+        assert self._condition is not None
+        condition = self._condition
+        while True:
+            async with condition:
+                await condition.wait_for(lambda: len(self._items) > 0)
+                item = self._pop()
+                self._active += 1
+                condition.notify_all()
+            lag = time.monotonic() - item.enqueued
+            self._lag_total += lag
+            self._lag_max = max(self._lag_max, lag)
+            try:
+                await self._call(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._errors += 1
+                _LOGGER.exception(f"Error in dispatched callback {item.func}")
+            finally:
+                self._dispatched += 1
+                async with condition:
+                    self._active -= 1
+                    condition.notify_all()
+
+    async def join(self) -> None:
+        """Wait until all queued callbacks have run."""
+        if self._condition is None:
+            return
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: not self._items and self._active == 0
+            )
+
+    async def close(self, drain: bool = True) -> None:
+        """Stop the workers, first waiting for queued callbacks to run if
+        drain is set (otherwise they are discarded)."""
+        if drain:
+            await self.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._condition = None
+        self._items.clear()
+        self._keys.clear()
+        self._active = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def stats(self) -> Dict[str, float]:
+        """Get the queue depth, counts of queued, run, dropped, coalesced and
+        failed callbacks and puts which had to wait, and the mean and max
+        callback lag (seconds from being queued to starting)."""
+        return {
+            "depth": len(self._items),
+            "max_depth": self._max_depth,
+            "active": self._active,
+            "enqueued": self._enqueued,
+            "dispatched": self._dispatched,
+            "dropped": self._dropped,
+            "coalesced": self._coalesced,
+            "blocked": self._blocked,
+            "errors": self._errors,
+            "lag_mean": self._lag_total / self._dispatched if self._dispatched else 0.0,
+            "lag_max": self._lag_max,
+        }
@@ -2,3 +2,17 @@ class SmartboxError(Exception):
     """General errors from smartbox API"""
 
     pass
+
+
+class UnsupportedEndpointError(SmartboxError):
+    """A node endpoint is (or was recently found to be) unsupported for a node
+    type, so the request was not made"""
+
+    pass
+
+
+class CircuitOpenError(SmartboxError):
+    """Requests to a device are failing fast because its circuit breaker is
+    open"""
+
+    pass
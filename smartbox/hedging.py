@@ -0,0 +1,194 @@
+"""Hedged requests, to cut the tail latency of idempotent requests."""
+
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    TimeoutError,
+    wait,
+)
+import logging
+import threading
+import time
+from typing import Callable, Deque, Dict, Optional, TypeVar
+
+_DEFAULT_PERCENTILE = 0.95
+_DEFAULT_BUDGET = 0.05
+_DEFAULT_MIN_DELAY = 0.01
+_DEFAULT_MIN_SAMPLES = 20
+_DEFAULT_WINDOW = 1000
+_DEFAULT_MAX_WORKERS = 32
+# How many new samples before the hedge delay is recalculated
+_RECALCULATE_INTERVAL = 16
+
+_LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class _EndpointLatency(object):
+    def __init__(self, window: int) -> None:
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.delay: Optional[float] = None
+        self.new_samples = 0
+
+
+class HedgePolicy(object):
+    """Sends a second (hedged) request if the first hasn't completed within
+    the given percentile of recent latencies, using whichever completes first.
+
+    Delays are tracked per endpoint (e.g. an endpoint template), over the last
+    window requests, and no hedging happens until min_samples have been seen.
+    Hedged requests are limited to budget (a fraction) of all requests, so
+    that hedging can't significantly add to server load. The losing request is
+    left to complete in the background.
+
+    Once an endpoint has a delay, each first attempt runs on a thread of its
+    own, started straight away, so concurrent requests aren't limited by the
+    pool and no part of the delay is spent waiting for a worker. Only hedged
+    requests use the pool of max_workers threads.
+
+    A HedgePolicy can be shared between sessions; call shutdown() once it is
+    no longer used.
+    """
+
+    def __init__(
+        self,
+        percentile: float = _DEFAULT_PERCENTILE,
+        budget: float = _DEFAULT_BUDGET,
+        min_delay: float = _DEFAULT_MIN_DELAY,
+        min_samples: int = _DEFAULT_MIN_SAMPLES,
+        window: int = _DEFAULT_WINDOW,
+        max_workers: int = _DEFAULT_MAX_WORKERS,
+    ) -> None:
+        """Create a hedge policy."""
+        if not 0 < percentile < 1:
+            raise ValueError("percentile must be between 0 and 1")
+        if not 0 <= budget <= 1:
+            raise ValueError("budget must be between 0 and 1")
+        self._percentile = percentile
+        self._budget = budget
+        self._min_delay = min_delay
+        self._min_samples = min_samples
+        self._window = window
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="smartbox-hedge"
+        )
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, _EndpointLatency] = {}
+        self._requests = 0
+        self._hedges = 0
+        self._hedge_wins = 0
+        self._budget_exhausted = 0
+
+    def _observe(self, endpoint: str, latency: float) -> None:
+        with self._lock:
+            latencies = self._latencies.get(endpoint)
+            if latencies is None:
+                latencies = _EndpointLatency(self._window)
+                self._latencies[endpoint] = latencies
+            latencies.samples.append(latency)
+            latencies.new_samples += 1
+            if len(latencies.samples) >= self._min_samples and (
+                latencies.delay is None
+                or latencies.new_samples >= _RECALCULATE_INTERVAL
+            ):
+                samples = sorted(latencies.samples)
+                index = min(int(len(samples) * self._percentile), len(samples) - 1)
+                latencies.delay = max(samples[index], self._min_delay)
+                latencies.new_samples = 0
+
+    def get_delay(self, endpoint: str) -> Optional[float]:
+        """Get the delay before hedging requests to endpoint, or None if there
+        aren't enough samples yet."""
+        latencies = self._latencies.get(endpoint)
+        return latencies.delay if latencies is not None else None
+
+    def _take_budget(self) -> bool:
+        with self._lock:
+            if self._hedges + 1 > self._budget * self._requests:
+                self._budget_exhausted += 1
+                return False
+            self._hedges += 1
+            return True
+
+    def _timed(self, endpoint: str, request: Callable[[], T]) -> Callable[[], T]:
+        def run() -> T:
+            start = time.perf_counter()
+            result = request()
+            self._observe(endpoint, time.perf_counter() - start)
+            return result
+
+        return run
+
+    @staticmethod
+    def _start(request: Callable[[], T]) -> "Future[T]":
+        future: "Future[T]" = Future()
+
+        def run() -> None:
+            future.set_running_or_notify_cancel()
+            try:
+                result = request()
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        threading.Thread(target=run, name="smartbox-request", daemon=True).start()
+        return future
+
+    def run(self, endpoint: str, request: Callable[[], T]) -> T:
+        """Run request, hedging it if it is slow."""
+        with self._lock:
+            self._requests += 1
+        delay = self.get_delay(endpoint)
+        if delay is None:
+            return self._timed(endpoint, request)()
+
+        first = self._start(self._timed(endpoint, request))
+        try:
+            return first.result(timeout=delay)
+        except TimeoutError:
+            pass
+        if not self._take_budget():
+            return first.result()
+
+        _LOGGER.debug(f"Hedging request to {endpoint} after {delay:.3f}s")
+        # The hedged request isn't timed, so that hedging doesn't skew the
+        # latency distribution
+        second = self._executor.submit(request)
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        with self._lock:
+                            self._hedge_wins += 1
+                    return future.result()
+                if error is None:
+                    error = future.exception()
+        # Both failed
+        assert error is not None
+        raise error
+
+    def stats(self) -> Dict[str, float]:
+        """Get request, hedge and budget counts, and the current delay for
+        each endpoint."""
+        with self._lock:
+            stats: Dict[str, float] = {
+                "requests": self._requests,
+                "hedges": self._hedges,
+                "hedge_wins": self._hedge_wins,
+                "budget_exhausted": self._budget_exhausted,
+            }
+            for endpoint, latencies in self._latencies.items():
+                if latencies.delay is not None:
+                    stats[f"delay:{endpoint}"] = latencies.delay
+            return stats
+
+    def shutdown(self) -> None:
+        """Shut down the executor used for hedged requests."""
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,268 @@
+"""Lightweight metrics for smartbox sessions, exportable in Prometheus text
+format."""
+
+import bisect
+from collections import defaultdict
+import functools
+import re
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds
+DEFAULT_LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+# Response size buckets in bytes
+DEFAULT_SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+_DEV_PATH_RE = re.compile(r"^devs/[^/]+")
+_NODE_PATH_RE = re.compile(r"^devs/\{dev\}/[^/]+/\d+(?=/|$)")
+
+
+@functools.lru_cache(maxsize=4096)
+def get_endpoint_template(path: str) -> str:
+    """Convert an API path to its endpoint template, e.g.
+    devs/{dev}/{type}/{addr}/status."""
+    template = _DEV_PATH_RE.sub("devs/{dev}", path)
+    return _NODE_PATH_RE.sub("devs/{dev}/{type}/{addr}", template)
+
+
+class Histogram(object):
+    """Thread-safe cumulative histogram with fixed buckets."""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> None:
+        """Create a histogram with the given (sorted) bucket upper bounds."""
+        self._buckets = tuple(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        """Record a value."""
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    @property
+    def count(self) -> int:
+        """Get the number of observed values."""
+        return self._count
+
+    @property
+    def sum(self) -> float:
+        """Get the sum of observed values."""
+        return self._sum
+
+    def cumulative_buckets(self) -> List[Tuple[float, int]]:
+        """Return (upper bound, cumulative count) pairs, ending with +Inf."""
+        with self._lock:
+            counts = list(self._counts)
+        result = []
+        total = 0
+        for bound, count in zip(self._buckets + (float("inf"),), counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate a quantile as the upper bound of the bucket containing it."""
+        if self._count == 0:
+            return None
+        target = q * self._count
+        for bound, total in self.cumulative_buckets():
+            if total >= target:
+                return bound
+        return float("inf")  # pragma: no cover
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    return ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in labels.items())
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+def format_histogram(
+    name: str, labels: Dict[str, str], histogram: Histogram
+) -> List[str]:
+    """Format a histogram as Prometheus text exposition lines."""
+    lines = []
+    for bound, total in histogram.cumulative_buckets():
+        bucket_labels = _format_labels(dict(labels, le=_format_bound(bound)))
+        lines.append(f"{name}_bucket{{{bucket_labels}}} {total}")
+    label_str = _format_labels(labels)
+    lines.append(f"{name}_sum{{{label_str}}} {histogram.sum}")
+    lines.append(f"{name}_count{{{label_str}}} {histogram.count}")
+    return lines
+
+
+class SessionMetrics(object):
+    """Hooks called by Session to record metrics. The default does nothing."""
+
+    def observe_request(
+        self,
+        method: str,
+        endpoint: str,
+        status: str,
+        latency: float,
+        response_size: int,
+        retries: int,
+    ) -> None:
+        """Record a completed API request.
+
+        endpoint is the path template (see get_endpoint_template) and status is
+        the HTTP status code, or 'error' if no response was received.
+        """
+
+    def observe_auth(self, grant_type: str, duration: float, success: bool) -> None:
+        """Record a token request."""
+
+
+class PrometheusSessionMetrics(SessionMetrics):
+    """SessionMetrics aggregating histograms and counters in memory, which can
+    be exported in Prometheus text format."""
+
+    def __init__(
+        self,
+        latency_buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS,
+        size_buckets: Sequence[float] = DEFAULT_SIZE_BUCKETS,
+    ) -> None:
+        """Create an empty set of session metrics."""
+        self._latency_buckets = latency_buckets
+        self._size_buckets = size_buckets
+        self._lock = threading.Lock()
+        self._latency: Dict[Tuple[str, str], Histogram] = {}
+        self._size: Dict[Tuple[str, str], Histogram] = {}
+        self._requests: Dict[Tuple[str, str, str], int] = defaultdict(int)
+        self._retries: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._auth: Dict[Tuple[str], Histogram] = {}
+        self._auth_failures: Dict[str, int] = defaultdict(int)
+
+    def _histogram(
+        self, histograms: Dict, key: Tuple, buckets: Sequence[float]
+    ) -> Histogram:
+        histogram = histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = histograms.setdefault(key, Histogram(buckets))
+        return histogram
+
+    def observe_request(
+        self,
+        method: str,
+        endpoint: str,
+        status: str,
+        latency: float,
+        response_size: int,
+        retries: int,
+    ) -> None:
+        key = (method, endpoint)
+        self._histogram(self._latency, key, self._latency_buckets).observe(latency)
+        self._histogram(self._size, key, self._size_buckets).observe(response_size)
+        with self._lock:
+            self._requests[(method, endpoint, status)] += 1
+            if retries:
+                self._retries[key] += retries
+
+    def observe_auth(self, grant_type: str, duration: float, success: bool) -> None:
+        self._histogram(self._auth, (grant_type,), self._latency_buckets).observe(
+            duration
+        )
+        if not success:
+            with self._lock:
+                self._auth_failures[grant_type] += 1
+
+    def get_latency(self, method: str, endpoint: str) -> Optional[Histogram]:
+        """Get the latency histogram for an endpoint template, if any."""
+        return self._latency.get((method, endpoint))
+
+    def get_request_count(self, method: str, endpoint: str, status: str) -> int:
+        """Get the number of requests with the given result."""
+        return self._requests.get((method, endpoint, status), 0)
+
+    def get_retry_count(self, method: str, endpoint: str) -> int:
+        """Get the number of retries for an endpoint template."""
+        return self._retries.get((method, endpoint), 0)
+
+    def export_prometheus(self) -> str:
+        """Export all metrics in Prometheus text exposition format."""
+        with self._lock:
+            latency = dict(self._latency)
+            size = dict(self._size)
+            requests = dict(self._requests)
+            retries = dict(self._retries)
+            auth = dict(self._auth)
+            auth_failures = dict(self._auth_failures)
+
+        lines = [
+            "# HELP smartbox_request_duration_seconds API request latency",
+            "# TYPE smartbox_request_duration_seconds histogram",
+        ]
+        for (method, endpoint), histogram in sorted(latency.items()):
+            lines += format_histogram(
+                "smartbox_request_duration_seconds",
+                {"method": method, "endpoint": endpoint},
+                histogram,
+            )
+        lines += [
+            "# HELP smartbox_response_size_bytes API response body size",
+            "# TYPE smartbox_response_size_bytes histogram",
+        ]
+        for (method, endpoint), histogram in sorted(size.items()):
+            lines += format_histogram(
+                "smartbox_response_size_bytes",
+                {"method": method, "endpoint": endpoint},
+                histogram,
+            )
+        lines += [
+            "# HELP smartbox_requests_total API requests by result",
+            "# TYPE smartbox_requests_total counter",
+        ]
+        for (method, endpoint, status), count in sorted(requests.items()):
+            labels = _format_labels(
+                {"method": method, "endpoint": endpoint, "status": status}
+            )
+            lines.append(f"smartbox_requests_total{{{labels}}} {count}")
+        lines += [
+            "# HELP smartbox_request_retries_total API request retries",
+            "# TYPE smartbox_request_retries_total counter",
+        ]
+        for (method, endpoint), count in sorted(retries.items()):
+            labels = _format_labels({"method": method, "endpoint": endpoint})
+            lines.append(f"smartbox_request_retries_total{{{labels}}} {count}")
+        lines += [
+            "# HELP smartbox_auth_duration_seconds Token request latency",
+            "# TYPE smartbox_auth_duration_seconds histogram",
+        ]
+        for (grant_type,), histogram in sorted(auth.items()):
+            lines += format_histogram(
+                "smartbox_auth_duration_seconds",
+                {"grant_type": grant_type},
+                histogram,
+            )
+        lines += [
+            "# HELP smartbox_auth_failures_total Failed token requests",
+            "# TYPE smartbox_auth_failures_total counter",
+        ]
+        for grant_type, count in sorted(auth_failures.items()):
+            labels = _format_labels({"grant_type": grant_type})
+            lines.append(f"smartbox_auth_failures_total{{{labels}}} {count}")
+        return "\n".join(lines) + "\n"
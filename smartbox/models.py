@@ -0,0 +1,232 @@
+"""Compact typed models for devices, nodes and their state.
+
+These are optional: Session and UpdateManager return plain dicts, which can be
+converted with the from_dict class methods (or nodes_from_dev_data). Numeric
+fields, which the API usually sends as strings, are parsed once on conversion,
+and node addresses are always ints. Fields not known to a model are kept in
+its extra dict.
+"""
+
+from typing import Any, Callable, Dict, Optional, Tuple, Type, TypeVar
+
+M = TypeVar("M", bound="_Model")
+
+_Converter = Callable[[Any], Any]
+
+
+def _to_float(value: Any) -> Optional[float]:
+    if value is None or value == "":
+        return None
+    return float(value)
+
+
+def _to_int(value: Any) -> Optional[int]:
+    if value is None or value == "":
+        return None
+    return int(value)
+
+
+def _to_bool(value: Any) -> Optional[bool]:
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        return value.lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def _to_str(value: Any) -> Optional[str]:
+    return value if value is None else str(value)
+
+
+class _Model(object):
+    """Base for models, which list their fields and converters in _fields."""
+
+    __slots__ = ("extra",)
+    _fields: Tuple[Tuple[str, _Converter], ...] = ()
+
+    def __init__(self, **kwargs: Any) -> None:
+        for name, _ in self._fields:
+            setattr(self, name, kwargs.pop(name, None))
+        self.extra: Optional[Dict[str, Any]] = kwargs or None
+
+    @classmethod
+    def from_dict(cls: Type[M], data: Dict[str, Any]) -> M:
+        """Create a model from an API response, parsing known fields."""
+        model = cls.__new__(cls)
+        extra = dict(data)
+        for name, convert in cls._fields:
+            value = extra.pop(name, None)
+            setattr(model, name, convert(value) if value is not None else None)
+        model.extra = extra or None
+        return model
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Get the known fields which are set (with their parsed values), and
+        any extra fields."""
+        data = {
+            name: getattr(self, name)
+            for name, _ in self._fields
+            if getattr(self, name) is not None
+        }
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def __eq__(self, other: Any) -> bool:
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(
+            getattr(self, name) == getattr(other, name) for name, _ in self._fields
+        ) and (self.extra == other.extra)
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{k}={v!r}" for k, v in self.to_dict().items())
+        return f"{type(self).__name__}({fields})"
+
+
+class NodeStatus(_Model):
+    """Status of a node (temperatures in the node's units)."""
+
+    __slots__ = (
+        "mode",
+        "stemp",
+        "mtemp",
+        "units",
+        "active",
+        "locked",
+        "power",
+        "charging",
+        "charge_level",
+    )
+    _fields = (
+        ("mode", _to_str),
+        ("stemp", _to_float),
+        ("mtemp", _to_float),
+        ("units", _to_str),
+        ("active", _to_bool),
+        ("locked", _to_bool),
+        ("power", _to_float),
+        ("charging", _to_bool),
+        ("charge_level", _to_int),
+    )
+
+    mode: Optional[str]
+    stemp: Optional[float]
+    mtemp: Optional[float]
+    units: Optional[str]
+    active: Optional[bool]
+    locked: Optional[bool]
+    power: Optional[float]
+    charging: Optional[bool]
+    charge_level: Optional[int]
+
+
+class NodeSetup(_Model):
+    """Setup of a node."""
+
+    __slots__ = (
+        "units",
+        "away_mode",
+        "control_mode",
+        "offset",
+        "power",
+        "priority",
+        "window_mode_enabled",
+        "true_radiant_enabled",
+    )
+    _fields = (
+        ("units", _to_str),
+        ("away_mode", _to_int),
+        ("control_mode", _to_int),
+        ("offset", _to_float),
+        ("power", _to_float),
+        ("priority", _to_str),
+        ("window_mode_enabled", _to_bool),
+        ("true_radiant_enabled", _to_bool),
+    )
+
+    units: Optional[str]
+    away_mode: Optional[int]
+    control_mode: Optional[int]
+    offset: Optional[float]
+    power: Optional[float]
+    priority: Optional[str]
+    window_mode_enabled: Optional[bool]
+    true_radiant_enabled: Optional[bool]
+
+
+class AwayStatus(_Model):
+    """Away status of a device."""
+
+    __slots__ = ("away", "enabled", "forced")
+    _fields = (
+        ("away", _to_bool),
+        ("enabled", _to_bool),
+        ("forced", _to_bool),
+    )
+
+    away: Optional[bool]
+    enabled: Optional[bool]
+    forced: Optional[bool]
+
+
+class Device(_Model):
+    """A device (i.e. a gateway with nodes attached)."""
+
+    __slots__ = ("dev_id", "name", "product_id", "fw_version", "serial_id")
+    _fields = (
+        ("dev_id", _to_str),
+        ("name", _to_str),
+        ("product_id", _to_str),
+        ("fw_version", _to_str),
+        ("serial_id", _to_str),
+    )
+
+    dev_id: Optional[str]
+    name: Optional[str]
+    product_id: Optional[str]
+    fw_version: Optional[str]
+    serial_id: Optional[str]
+
+
+class Node(_Model):
+    """A node on a device, with its status and setup if known."""
+
+    __slots__ = ("type", "addr", "name", "installed", "status", "setup")
+    _fields = (
+        ("type", _to_str),
+        ("addr", _to_int),
+        ("name", _to_str),
+        ("installed", _to_bool),
+        ("status", NodeStatus.from_dict),
+        ("setup", NodeSetup.from_dict),
+    )
+
+    type: Optional[str]
+    addr: Optional[int]
+    name: Optional[str]
+    installed: Optional[bool]
+    status: Optional[NodeStatus]
+    setup: Optional[NodeSetup]
+
+    @property
+    def key(self) -> Tuple[Optional[str], Optional[int]]:
+        """Get the (node_type, addr) key used by UpdateManager and dev_data
+        helpers."""
+        return (self.type, self.addr)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = super().to_dict()
+        for name in ("status", "setup"):
+            if name in data:
+                data[name] = data[name].to_dict()
+        return data
+
+
+def nodes_from_dev_data(dev_data: Dict[str, Any]) -> Dict[Tuple[str, int], Node]:
+    """Get the nodes in dev data as models, keyed by (node_type, addr)."""
+    nodes = {}
+    for node_data in dev_data.get("nodes", []):
+        node = Node.from_dict(node_data)
+        nodes[(node_data["type"], int(node_data["addr"]))] = node
+    return nodes
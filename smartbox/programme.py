@@ -0,0 +1,158 @@
+"""Compact representation of node weekly programmes."""
+
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Sequence
+
+DAYS_PER_WEEK = 7
+# Programmes are hourly, though some nodes use half-hour slots
+DEFAULT_SLOTS_PER_DAY = 24
+SLOTS_PER_DAY = (24, 48)
+
+
+class ProgrammeChange(NamedTuple):
+    """A slot which differs between two programmes."""
+
+    day: int
+    slot: int
+    old: int
+    new: int
+
+
+class Programme(object):
+    """A node's weekly programme, i.e. the temperature mode (e.g. 0 for
+    antifrost, 1 for eco, 2 for comfort) of each slot of each day, with day 0
+    being Monday.
+
+    Stored as a single bytearray of 7 * slots_per_day modes, so comparing two
+    programmes is a memory comparison.
+    """
+
+    __slots__ = ("_slots_per_day", "_data")
+
+    def __init__(
+        self,
+        data: Optional[Sequence[int]] = None,
+        slots_per_day: int = DEFAULT_SLOTS_PER_DAY,
+    ) -> None:
+        """Create a programme from the modes of each slot, day by day (all 0 if
+        not given)."""
+        if slots_per_day not in SLOTS_PER_DAY:
+            raise ValueError(f"Unsupported slots per day {slots_per_day}")
+        size = DAYS_PER_WEEK * slots_per_day
+        if data is None:
+            data = bytes(size)
+        elif len(data) != size:
+            raise ValueError(f"Programme must have {size} slots, not {len(data)}")
+        self._slots_per_day = slots_per_day
+        self._data = bytearray(data)
+
+    @classmethod
+    def from_dict(cls, prog: Dict[str, Any]) -> "Programme":
+        """Create a programme from a prog API response, i.e. {"prog": {"0":
+        [modes...], ..., "6": [...]}} (or just the inner dict)."""
+        days = prog.get("prog", prog)
+        if len(days) != DAYS_PER_WEEK:
+            raise ValueError(f"Programme must have {DAYS_PER_WEEK} days")
+        data = bytearray()
+        slots_per_day = None
+        for day in range(DAYS_PER_WEEK):
+            modes = days.get(str(day), days.get(day))
+            if modes is None:
+                raise ValueError(f"Programme is missing day {day}")
+            if slots_per_day is None:
+                slots_per_day = len(modes)
+            elif len(modes) != slots_per_day:
+                raise ValueError("Programme days must all have the same slots")
+            data.extend(int(mode) for mode in modes)
+        return cls(data, slots_per_day or DEFAULT_SLOTS_PER_DAY)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Get the programme in the format posted to the prog endpoint."""
+        return {"prog": {str(day): self.get_day(day) for day in range(DAYS_PER_WEEK)}}
+
+    @property
+    def slots_per_day(self) -> int:
+        """Get the number of slots per day."""
+        return self._slots_per_day
+
+    def _index(self, day: int, slot: int) -> int:
+        if not 0 <= day < DAYS_PER_WEEK or not 0 <= slot < self._slots_per_day:
+            raise IndexError(f"Invalid programme slot ({day}, {slot})")
+        return day * self._slots_per_day + slot
+
+    def get(self, day: int, slot: int) -> int:
+        """Get the mode for a slot."""
+        return self._data[self._index(day, slot)]
+
+    def set(self, day: int, slot: int, mode: int) -> None:
+        """Set the mode for a slot."""
+        self._data[self._index(day, slot)] = mode
+
+    def get_day(self, day: int) -> List[int]:
+        """Get the modes for each slot of a day."""
+        start = self._index(day, 0)
+        return list(self._data[start : start + self._slots_per_day])
+
+    def set_day(self, day: int, modes: List[int]) -> None:
+        """Set the modes for each slot of a day."""
+        if len(modes) != self._slots_per_day:
+            raise ValueError(f"Day must have {self._slots_per_day} slots")
+        start = self._index(day, 0)
+        self._data[start : start + self._slots_per_day] = bytes(modes)
+
+    def diff(self, other: "Programme") -> List[ProgrammeChange]:
+        """Get the slots which differ from another programme (with the same
+        slots per day)."""
+        if other._slots_per_day != self._slots_per_day:
+            raise ValueError("Can't compare programmes with different slots")
+        if other._data == self._data:
+            return []
+        return [
+            ProgrammeChange(*divmod(i, self._slots_per_day), old, new)
+            for i, (old, new) in enumerate(zip(self._data, other._data))
+            if old != new
+        ]
+
+    def resample(self, slots_per_day: int) -> "Programme":
+        """Get the programme with a different number of slots per day, e.g.
+        for a node using half-hour slots. Raises ValueError if it can't be
+        represented exactly (a half hour differing from the other half of its
+        hour)."""
+        if slots_per_day not in SLOTS_PER_DAY:
+            raise ValueError(f"Unsupported slots per day {slots_per_day}")
+        if slots_per_day == self._slots_per_day:
+            return self.copy()
+        if slots_per_day > self._slots_per_day:
+            factor = slots_per_day // self._slots_per_day
+            data = bytes(mode for mode in self._data for _ in range(factor))
+        else:
+            factor = self._slots_per_day // slots_per_day
+            data = bytes(self._data[::factor])
+            if any(
+                self._data[i : i + factor] != bytes([data[i // factor]]) * factor
+                for i in range(0, len(self._data), factor)
+            ):
+                raise ValueError(
+                    f"Programme can't be represented with {slots_per_day} slots"
+                )
+        return Programme(data, slots_per_day)
+
+    def copy(self) -> "Programme":
+        """Get a copy of the programme."""
+        return Programme(self._data, self._slots_per_day)
+
+    def __bytes__(self) -> bytes:
+        return bytes(self._data)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return (self.get_day(day) for day in range(DAYS_PER_WEEK))
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, Programme):
+            return NotImplemented
+        return self._slots_per_day == other._slots_per_day and self._data == other._data
+
+    # Programmes are mutable
+    __hash__ = None  # type: ignore
+
+    def __repr__(self) -> str:
+        return f"Programme({bytes(self._data)!r}, {self._slots_per_day})"
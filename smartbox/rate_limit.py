@@ -0,0 +1,153 @@
+"""Client-side rate limiting and prioritisation of REST requests."""
+
+from enum import IntEnum
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import weakref
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Request priority (lower values are scheduled first)."""
+
+    WRITE = 0
+    READ = 1
+
+
+class RequestScheduler(object):
+    """Token bucket rate limiter which admits waiting requests in priority order.
+
+    Requests are admitted at up to rate per second, with bursts of up to burst
+    requests. When the server asks us to back off (e.g. a 429 with
+    Retry-After), pause() holds all requests until the given time has passed.
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        """Create a scheduler admitting rate requests/second."""
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst at least 1")
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        self._waiters: List[Tuple[int, int]] = []
+        self._seq = itertools.count()
+
+        self._max_queue_depth = 0
+        self._admitted: Dict[Priority, int] = {p: 0 for p in Priority}
+        self._total_wait: Dict[Priority, float] = {p: 0.0 for p in Priority}
+        self._max_wait: Dict[Priority, float] = {p: 0.0 for p in Priority}
+        self._pauses = 0
+
+    @property
+    def rate(self) -> float:
+        """Get the number of requests admitted per second."""
+        return self._rate
+
+    @property
+    def burst(self) -> int:
+        """Get the maximum burst of requests."""
+        return self._burst
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(
+            self._burst, self._tokens + (now - self._last_refill) * self._rate
+        )
+        self._last_refill = now
+
+    def acquire(self, priority: Priority = Priority.READ) -> float:
+        """Wait until a request of the given priority may be sent.
+
+        Returns the time spent waiting, in seconds.
+        """
+        start = time.monotonic()
+        with self._cond:
+            entry = (int(priority), next(self._seq))
+            heapq.heappush(self._waiters, entry)
+            self._max_queue_depth = max(self._max_queue_depth, len(self._waiters))
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                timeout: Optional[float] = None
+                if self._waiters[0] == entry:
+                    if now >= self._paused_until and self._tokens >= 1:
+                        heapq.heappop(self._waiters)
+                        self._tokens -= 1
+                        # Let the next waiter check whether it can go
+                        self._cond.notify_all()
+                        break
+                    timeout = max(
+                        self._paused_until - now, (1 - self._tokens) / self._rate
+                    )
+                # Non-head waiters are woken when the head is admitted. A
+                # head displaced by a higher priority request finds out when
+                # its timed wait ends (the new head checks for itself)
+                self._cond.wait(timeout)
+            waited = time.monotonic() - start
+            self._admitted[priority] += 1
+            self._total_wait[priority] += waited
+            self._max_wait[priority] = max(self._max_wait[priority], waited)
+        return waited
+
+    def pause(self, seconds: float) -> None:
+        """Hold all requests for the given time (e.g. from Retry-After)."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+            self._pauses += 1
+            self._cond.notify_all()
+
+    @property
+    def queue_depth(self) -> int:
+        """Get the number of requests currently waiting."""
+        with self._cond:
+            return len(self._waiters)
+
+    def stats(self) -> Dict[str, float]:
+        """Return queue depth and per-priority wait time metrics."""
+        with self._cond:
+            stats: Dict[str, float] = {
+                "queue_depth": len(self._waiters),
+                "max_queue_depth": self._max_queue_depth,
+                "pauses": self._pauses,
+            }
+            for p in Priority:
+                name = p.name.lower()
+                stats[f"{name}_admitted"] = self._admitted[p]
+                stats[f"{name}_wait_total"] = self._total_wait[p]
+                stats[f"{name}_wait_max"] = self._max_wait[p]
+            return stats
+
+
+# Schedulers are dropped once no session uses them
+_schedulers: "weakref.WeakValueDictionary[str, RequestScheduler]" = (
+    weakref.WeakValueDictionary()
+)
+_schedulers_lock = threading.Lock()
+
+
+def get_request_scheduler(api_host: str, rate: float, burst: int) -> RequestScheduler:
+    """Get the shared scheduler for an API host, creating it if needed.
+
+    All sessions talking to the same host in a process share one scheduler,
+    using the rate and burst of the caller which created it (a warning is
+    logged if later callers ask for different ones).
+    """
+    with _schedulers_lock:
+        scheduler = _schedulers.get(api_host)
+        if scheduler is None:
+            scheduler = RequestScheduler(rate, burst)
+            _schedulers[api_host] = scheduler
+        elif (scheduler.rate, scheduler.burst) != (rate, burst):
+            _LOGGER.warning(
+                f"Rate limit for {api_host} is already {scheduler.rate}/s"
+                f" (burst {scheduler.burst}), ignoring {rate}/s (burst {burst})"
+            )
+        return scheduler
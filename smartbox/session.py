@@ -1,21 +1,258 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import copy
 import datetime
-import json
+import email.utils
+from enum import Enum
 import logging
+import re
 import requests
+import socket
+import threading
+import time
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
-from typing import Any, Dict, List
+from typing import (
+    Any,
+    ContextManager,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
-from .error import SmartboxError
+from . import codec
+from .cache import TTLCache
+from .capabilities import CapabilityMap
+from .circuit_breaker import CircuitBreaker, CircuitBreakerRegistry
+from .error import CircuitOpenError, SmartboxError, UnsupportedEndpointError
+from .hedging import HedgePolicy
+from .metrics import SessionMetrics, get_endpoint_template
+from .programme import Programme
+from .rate_limit import Priority, RequestScheduler, get_request_scheduler
+from .streaming import DEFAULT_CHUNK_SIZE, iter_json_array
+from .token_store import TokenData, TokenStore
 
 _DEFAULT_RETRY_ATTEMPTS = 5
 _DEFAULT_BACKOFF_FACTOR = 0.1
 _MIN_TOKEN_LIFETIME = 60  # Minimum time left before expiry before we refresh (seconds)
+_RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+# How long before expiry the background scheduler refreshes the token (seconds)
+_DEFAULT_REFRESH_LEAD_TIME = 300
+# Minimum wait between background refresh attempts (seconds)
+_MIN_REFRESH_INTERVAL = 1.0
+# Maximum wait before retrying failed background refreshes (seconds)
+_MAX_REFRESH_RETRY_INTERVAL = 300.0
+# Matches the default urllib3 connection pool size
+_DEFAULT_MAX_CONCURRENCY = 10
+_NODE_STATE_KINDS = ("status", "setup", "prog")
+_DEFAULT_CACHE_MAXSIZE = 1024
+_DEFAULT_POOL_CONNECTIONS = 10
+_DEFAULT_POOL_MAXSIZE = 10
+_DEFAULT_RATE_LIMIT_BURST = 10
+# Matches device paths, capturing the device ID and first path element
+_DEVICE_PATH_RE = re.compile(r"^devs/([^/]+)/([^/]+)")
 
 _LOGGER = logging.getLogger(__name__)
 
 
+class SetupSource(str, Enum):
+    """Where set_setup obtained the current node setup from."""
+
+    PROVIDED = "provided"
+    CACHED = "cached"
+    FETCHED = "fetched"
+
+
+class ProgRollout(NamedTuple):
+    """Outcome of roll_out_prog: the (dev_id, node_type, addr) keys of nodes
+    posted to, and the error for each node which failed."""
+
+    posted: List[Tuple[str, str, int]]
+    failed: Dict[Tuple[str, str, int], Exception]
+
+
+def _get_token_request(
+    basic_auth_credentials: str, credentials: Dict[str, str]
+) -> Tuple[str, Dict[str, str]]:
+    token_data = "&".join(f"{k}={v}" for k, v in credentials.items())
+    token_headers = {
+        "authorization": f"Basic {basic_auth_credentials}",
+        "Content-Type": "application/x-www-form-urlencoded",
+    }
+    return token_data, token_headers
+
+
+def _parse_token_response(r: Dict[str, Any]) -> Tuple[str, str, datetime.datetime]:
+    if "access_token" not in r or "refresh_token" not in r or "expires_in" not in r:
+        _LOGGER.error(f"Received invalid auth response, please check credentials: {r}")
+        raise SmartboxError("Received invalid auth response")
+    if r["expires_in"] < _MIN_TOKEN_LIFETIME:
+        _LOGGER.warning(
+            (
+                f"Token expires in {r['expires_in']}s"
+                f", which is below minimum lifetime of {_MIN_TOKEN_LIFETIME}s"
+                " - will refresh again on next operation"
+            )
+        )
+    expires_at = datetime.datetime.now() + datetime.timedelta(seconds=r["expires_in"])
+    return r["access_token"], r["refresh_token"], expires_at
+
+
+def _get_refresh_lead_time(lead_time: float, expires_at: datetime.datetime) -> float:
+    """Get how long before expires_at to refresh a token, at most half its
+    remaining lifetime so short-lived tokens aren't refreshed continuously."""
+    remaining = (expires_at - datetime.datetime.now()).total_seconds()
+    return min(lead_time, max(remaining, 0) / 2)
+
+
+def _get_refresh_retry_interval(
+    failures: int,
+    interval: float = _MIN_REFRESH_INTERVAL,
+    max_interval: float = _MAX_REFRESH_RETRY_INTERVAL,
+) -> float:
+    """Get how long to wait before retrying after consecutive refresh
+    failures, backing off exponentially."""
+    return min(interval * 2 ** (failures - 1), max_interval)
+
+
+class _HTTPAdapter(HTTPAdapter):
+    """HTTPAdapter allowing socket options (e.g. TCP keep-alive) to be set."""
+
+    def __init__(
+        self, socket_options: Optional[List[Tuple[int, int, int]]] = None, **kwargs: Any
+    ) -> None:
+        self._socket_options = socket_options
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        if self._socket_options is not None:
+            kwargs["socket_options"] = self._socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+def _get_response_size(response: Optional[requests.Response], stream: bool) -> int:
+    if response is None:
+        return 0
+    if stream:
+        # Don't read a streamed body just to measure it
+        return int(response.headers.get("Content-Length", 0))
+    return len(response.content)
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(retry_at.tzinfo)
+    return max((retry_at - now).total_seconds(), 0.0)
+
+
+def _get_keepalive_socket_options(idle: int) -> List[Tuple[int, int, int]]:
+    # Keep urllib3's default of disabling Nagle's algorithm
+    options = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+    # Not available on all platforms
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle))
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, idle))
+    return options
+
+
+def create_requests_session(
+    retry_attempts: int = _DEFAULT_RETRY_ATTEMPTS,
+    backoff_factor: float = _DEFAULT_BACKOFF_FACTOR,
+    retry_rate_limited: bool = True,
+    pool_connections: int = _DEFAULT_POOL_CONNECTIONS,
+    pool_maxsize: int = _DEFAULT_POOL_MAXSIZE,
+    pool_block: bool = False,
+    tcp_keepalive: Optional[int] = None,
+) -> requests.Session:
+    """Create a requests.Session with retries and connection pooling set up
+    for the smartbox API, which can be shared between Sessions."""
+    requests_session = requests.Session()
+    retry_strategy = Retry(  # type: ignore
+        total=retry_attempts,
+        backoff_factor=backoff_factor,
+        status_forcelist=[
+            code for code in _RETRY_STATUS_CODES if code != 429 or retry_rate_limited
+        ],
+        allowed_methods=["GET", "POST"],
+    )
+    http_adapter = _HTTPAdapter(
+        socket_options=(
+            _get_keepalive_socket_options(tcp_keepalive)
+            if tcp_keepalive is not None
+            else None
+        ),
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block,
+        max_retries=retry_strategy,
+    )
+    requests_session.mount("http://", http_adapter)
+    requests_session.mount("https://", http_adapter)
+    return requests_session
+
+
 class Session(object):
+    """Blocking client for the smartbox REST API.
+
+    A Session can be shared between threads: token state is replaced
+    atomically, token refreshes are serialised, and the underlying connection
+    pool can be sized with pool_connections (number of hosts to pool) and
+    pool_maxsize (connections kept per host, which should be at least the
+    number of threads making concurrent requests). If pool_block is set,
+    requests wait for a free connection rather than opening extra ones which
+    are discarded afterwards. tcp_keepalive enables TCP keep-alive probes after
+    the given number of idle seconds, which helps keep pooled connections
+    alive through NAT and load balancers.
+
+    If rate_limit is set, requests to the API host are limited to that many per
+    second (with bursts of rate_limit_burst) by a scheduler shared with other
+    sessions for the same host. Writes are admitted before reads, and 429
+    responses pause the scheduler for the Retry-After time before retrying.
+
+    If metrics is set (e.g. a PrometheusSessionMetrics), it is called with the
+    latency, status, response size and retry count of each API request, keyed
+    by endpoint template, and with the duration and outcome of token requests.
+
+    Requests to node endpoints (status, setup etc) which fail because the node
+    doesn't support them are remembered in a CapabilityMap (which can be
+    shared between sessions with capabilities), and further requests to that
+    endpoint for that node (or its node type, once several nodes of the type
+    have failed) raise UnsupportedEndpointError without being sent until a
+    backoff has passed.
+
+    If hedge_policy is set, GET requests which are slower than a percentile of
+    recent requests to the same endpoint template are hedged with a second
+    request (within a budget), using whichever response arrives first.
+
+    If circuit_breakers is set, requests for a device fail fast with
+    CircuitOpenError after repeated connection errors or server errors for
+    that device, until a half-open probe (checked first with the cheap
+    devs/<dev_id>/connected endpoint) succeeds.
+
+    requests_session can be used to share a requests.Session (see
+    create_requests_session) between Sessions, in which case the pool and
+    retry arguments are ignored and it is not closed by close(). SessionPool
+    does this to share connection pools between many accounts.
+    """
+
     def __init__(
         self,
         api_name: str,
@@ -24,99 +261,377 @@ class Session(object):
         password: str,
         retry_attempts: int = _DEFAULT_RETRY_ATTEMPTS,
         backoff_factor: float = _DEFAULT_BACKOFF_FACTOR,
+        cache_ttl: Optional[float] = None,
+        cache_maxsize: int = _DEFAULT_CACHE_MAXSIZE,
+        setup_cache_ttl: Optional[float] = None,
+        auto_refresh: bool = False,
+        refresh_lead_time: float = _DEFAULT_REFRESH_LEAD_TIME,
+        token_store: Optional[TokenStore] = None,
+        pool_connections: int = _DEFAULT_POOL_CONNECTIONS,
+        pool_maxsize: int = _DEFAULT_POOL_MAXSIZE,
+        pool_block: bool = False,
+        tcp_keepalive: Optional[int] = None,
+        api_host: Optional[str] = None,
+        rate_limit: Optional[float] = None,
+        rate_limit_burst: int = _DEFAULT_RATE_LIMIT_BURST,
+        metrics: Optional[SessionMetrics] = None,
+        requests_session: Optional[requests.Session] = None,
+        capabilities: Optional[CapabilityMap] = None,
+        hedge_policy: Optional[HedgePolicy] = None,
+        circuit_breakers: Optional[CircuitBreakerRegistry] = None,
     ) -> None:
         self._api_name = api_name
-        self._api_host = f"https://{self._api_name}.helki.com"
+        self._api_host = (
+            api_host if api_host is not None else f"https://{self._api_name}.helki.com"
+        )
         self._basic_auth_credentials = basic_auth_credentials
 
-        self._requests = requests.Session()
-        retry_strategy = Retry(  # type: ignore
-            total=retry_attempts,
-            backoff_factor=backoff_factor,
-            status_forcelist=[429, 500, 502, 503, 504],
-            allowed_methods=["GET", "POST"],
+        # Device and node topology rarely changes, so can optionally be cached
+        self._topology_cache: Optional[TTLCache] = (
+            TTLCache(cache_ttl, cache_maxsize) if cache_ttl is not None else None
+        )
+        # Node setup is cached (and can be kept fresh from socket updates) so
+        # that set_setup can avoid a GET before each POST
+        self._setup_cache: Optional[TTLCache] = (
+            TTLCache(setup_cache_ttl, cache_maxsize)
+            if setup_cache_ttl is not None
+            else None
+        )
+        self._set_setup_sources: Counter = Counter()
+        self._stats_lock = threading.Lock()
+        # Learns which node endpoints each node type supports, so requests
+        # which are known to fail can be skipped
+        self._capabilities = (
+            capabilities if capabilities is not None else CapabilityMap()
+        )
+
+        # Serialises token refreshes so concurrent callers share a single
+        # in-flight refresh
+        self._auth_lock = threading.Lock()
+        self._refresh_lead_time = refresh_lead_time
+        self._refresh_thread: Optional[threading.Thread] = None
+        self._stop_refresh = threading.Event()
+        # Tokens can be persisted to resume sessions and share refreshed tokens
+        # between processes
+        self._token_store = token_store
+        self._token_store_key = f"{api_name}:{username}"
+
+        self._retry_attempts = retry_attempts
+        self._backoff_factor = backoff_factor
+        self._metrics = metrics
+        self._hedge_policy = hedge_policy
+        self._circuit_breakers = circuit_breakers
+        self._request_scheduler: Optional[RequestScheduler] = (
+            get_request_scheduler(self._api_host, rate_limit, rate_limit_burst)
+            if rate_limit is not None
+            else None
         )
-        http_adapter = HTTPAdapter(max_retries=retry_strategy)
-        self._requests.mount("http://", http_adapter)
-        self._requests.mount("https://", http_adapter)
 
-        self._auth(
-            {"grant_type": "password", "username": username, "password": password}
+        # A requests session (and its connection pools) can be shared between
+        # Sessions, in which case it is owned (and closed) by the caller
+        self._owns_requests = requests_session is None
+        self._requests = (
+            requests_session
+            if requests_session is not None
+            else create_requests_session(
+                retry_attempts,
+                backoff_factor,
+                # With a rate limiter, 429s are retried via the scheduler so
+                # that retries don't add to the overload
+                retry_rate_limited=self._request_scheduler is None,
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+                pool_block=pool_block,
+                tcp_keepalive=tcp_keepalive,
+            )
         )
+        self._last_used = time.monotonic()
+
+        self._initial_auth(username, password)
+
+        if auto_refresh:
+            self.start_refresh_scheduler()
 
     def _auth(self, credentials: Dict[str, str]) -> None:
-        token_data = "&".join(f"{k}={v}" for k, v in credentials.items())
-        token_headers = {
-            "authorization": f"Basic {self._basic_auth_credentials}",
-            "Content-Type": "application/x-www-form-urlencoded",
-        }
+        token_data, token_headers = _get_token_request(
+            self._basic_auth_credentials, credentials
+        )
 
         token_url = f"{self._api_host}/client/token"
-        response = self._requests.post(
-            token_url, data=token_data, headers=token_headers
-        )
-        response.raise_for_status()
-        r = response.json()
-        if "access_token" not in r or "refresh_token" not in r or "expires_in" not in r:
-            _LOGGER.error(
-                f"Received invalid auth response, please check credentials: {r}"
+        start = time.perf_counter()
+        success = False
+        try:
+            response = self._requests.post(
+                token_url, data=token_data, headers=token_headers
             )
-            raise SmartboxError("Received invalid auth response")
-        self._access_token = r["access_token"]
-        self._refresh_token = r["refresh_token"]
-        if r["expires_in"] < _MIN_TOKEN_LIFETIME:
-            _LOGGER.warning(
-                (
-                    f"Token expires in {r['expires_in']}s"
-                    f", which is below minimum lifetime of {_MIN_TOKEN_LIFETIME}s"
-                    " - will refresh again on next operation"
+            response.raise_for_status()
+            success = True
+        finally:
+            if self._metrics is not None:
+                self._metrics.observe_auth(
+                    credentials["grant_type"], time.perf_counter() - start, success
                 )
-            )
-        self._expires_at = datetime.datetime.now() + datetime.timedelta(
-            seconds=r["expires_in"]
-        )
+        # Token state is replaced with a single assignment so concurrent
+        # readers never see a mix of old and new values
+        self._token = TokenData(*_parse_token_response(response.json()))
         _LOGGER.debug(
             (
                 f"Authenticated session ({credentials['grant_type']}), "
-                f"access_token={self._access_token}, expires at {self._expires_at}"
+                f"access_token={self._token.access_token}"
+                f", expires at {self._token.expires_at}"
             )
         )
 
-    def _has_token_expired(self) -> bool:
-        return (self._expires_at - datetime.datetime.now()) < datetime.timedelta(
-            seconds=_MIN_TOKEN_LIFETIME
+    def _token_store_lock(self) -> ContextManager[None]:
+        if self._token_store is None:
+            return contextlib.nullcontext()
+        return self._token_store.lock()
+
+    def _adopt_stored_token(
+        self, newer_than: Optional[datetime.datetime] = None
+    ) -> bool:
+        if self._token_store is None:
+            return False
+        stored = self._token_store.load(self._token_store_key)
+        if stored is None or (
+            newer_than is not None and stored.expires_at <= newer_than
+        ):
+            return False
+        self._token = stored
+        _LOGGER.debug(f"Using stored token, expires at {stored.expires_at}")
+        return True
+
+    def _save_token(self) -> None:
+        if self._token_store is not None:
+            self._token_store.save(
+                self._token_store_key,
+                self._token,
+            )
+
+    def _initial_auth(self, username: str, password: str) -> None:
+        with self._token_store_lock():
+            if self._adopt_stored_token():
+                if not self._has_token_expired():
+                    return
+                try:
+                    self._auth(
+                        {
+                            "grant_type": "refresh_token",
+                            "refresh_token": self._token.refresh_token,
+                        }
+                    )
+                    self._save_token()
+                    return
+                except (requests.HTTPError, SmartboxError) as e:
+                    _LOGGER.warning(f"Failed to refresh stored token: {e}")
+            self._auth(
+                {"grant_type": "password", "username": username, "password": password}
+            )
+            self._save_token()
+
+    def _token_expires_within(self, seconds: float) -> bool:
+        return (self._token.expires_at - datetime.datetime.now()) < datetime.timedelta(
+            seconds=seconds
         )
 
+    def _has_token_expired(self) -> bool:
+        return self._token_expires_within(_MIN_TOKEN_LIFETIME)
+
+    def _refresh(self, min_lifetime: float) -> None:
+        with self._auth_lock, self._token_store_lock():
+            # Another caller (or process sharing the token store) may have
+            # refreshed while we waited for the lock
+            self._adopt_stored_token(newer_than=self._token.expires_at)
+            if not self._token_expires_within(min_lifetime):
+                return
+            self._auth(
+                {
+                    "grant_type": "refresh_token",
+                    "refresh_token": self._token.refresh_token,
+                }
+            )
+            self._save_token()
+
     def _check_refresh(self) -> None:
         if self._has_token_expired():
-            self._auth(
-                {"grant_type": "refresh_token", "refresh_token": self._refresh_token}
+            self._refresh(_MIN_TOKEN_LIFETIME)
+
+    def refresh_token_if_expiring(self, min_lifetime: float) -> None:
+        """Refresh the access token if it expires within min_lifetime
+        seconds."""
+        if self._token_expires_within(min_lifetime):
+            self._refresh(min_lifetime)
+
+    def _refresh_loop(self) -> None:
+        _LOGGER.debug("Starting token refresh scheduler")
+        failures = 0
+        while True:
+            lead_time = _get_refresh_lead_time(
+                self._refresh_lead_time, self._token.expires_at
             )
+            if failures:
+                wait = _get_refresh_retry_interval(failures)
+            else:
+                refresh_at = self._token.expires_at - datetime.timedelta(
+                    seconds=lead_time
+                )
+                wait = (refresh_at - datetime.datetime.now()).total_seconds()
+            if self._stop_refresh.wait(max(wait, _MIN_REFRESH_INTERVAL)):
+                break
+            try:
+                # A little over the lead time, so the refresh is due on waking
+                self._refresh(lead_time + _MIN_REFRESH_INTERVAL)
+                failures = 0
+            except Exception:
+                # Requests will still refresh on demand if we keep failing
+                failures += 1
+                _LOGGER.exception("Background token refresh failed")
+        _LOGGER.debug("Stopped token refresh scheduler")
+
+    def start_refresh_scheduler(self) -> None:
+        """Refresh the access token in the background shortly before it
+        expires, so requests don't have to wait for a refresh."""
+        if self._refresh_thread is not None:
+            return
+        self._stop_refresh.clear()
+        self._refresh_thread = threading.Thread(
+            target=self._refresh_loop, name="smartbox-token-refresh", daemon=True
+        )
+        self._refresh_thread.start()
+
+    def stop_refresh_scheduler(self) -> None:
+        """Stop the background token refresh scheduler, if running."""
+        if self._refresh_thread is None:
+            return
+        self._stop_refresh.set()
+        self._refresh_thread.join()
+        self._refresh_thread = None
+
+    def close(self) -> None:
+        self.stop_refresh_scheduler()
+        if self._owns_requests:
+            self._requests.close()
+
+    @property
+    def last_used(self) -> float:
+        """Get the time.monotonic() time of the last API request (or of
+        creation if none have been made)."""
+        return self._last_used
 
     def _get_headers(self) -> Dict[str, str]:
         return {
-            "Authorization": f"Bearer {self._access_token}",
+            "Authorization": f"Bearer {self._token.access_token}",
             "Content-Type": "application/json",
             # TODO: generalise
             "x-serialid": "5",
         }
 
+    def _send(
+        self, method: str, path: str, priority: Priority, **kwargs: Any
+    ) -> requests.Response:
+        self._last_used = time.monotonic()
+        if self._metrics is None:
+            return self._send_attempts(method, path, priority, **kwargs)[0]
+        start = time.perf_counter()
+        response = None
+        retries = 0
+        try:
+            response, retries = self._send_attempts(method, path, priority, **kwargs)
+            return response
+        finally:
+            self._metrics.observe_request(
+                method,
+                get_endpoint_template(path),
+                str(response.status_code) if response is not None else "error",
+                time.perf_counter() - start,
+                _get_response_size(response, kwargs.get("stream", False)),
+                retries,
+            )
+
+    def _send_attempts(
+        self, method: str, path: str, priority: Priority, **kwargs: Any
+    ) -> Tuple[requests.Response, int]:
+        api_url = f"{self._api_host}/api/v2/{path}"
+        attempt = 0
+        retries = 0
+        while True:
+            if self._request_scheduler is not None:
+                self._request_scheduler.acquire(priority)
+            response = self._requests.request(
+                method, api_url, headers=self._get_headers(), **kwargs
+            )
+            # Include retries made by urllib3
+            urllib3_retries = getattr(response.raw, "retries", None)
+            if urllib3_retries is not None:
+                retries += len(urllib3_retries.history)
+            if (
+                response.status_code != 429
+                or self._request_scheduler is None
+                or attempt >= self._retry_attempts
+            ):
+                return response, retries
+            retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is None:
+                retry_after = self._backoff_factor * (2**attempt)
+            _LOGGER.debug(f"Rate limited by server, pausing for {retry_after}s")
+            self._request_scheduler.pause(retry_after)
+            attempt += 1
+            retries += 1
+
+    def _get_circuit_breaker_for_path(self, path: str) -> Optional[CircuitBreaker]:
+        if self._circuit_breakers is None:
+            return None
+        m = _DEVICE_PATH_RE.match(path)
+        if m is None or m.group(2) == "connected":
+            return None
+        return self._circuit_breakers.get(m.group(1))
+
+    def _send_guarded(
+        self, method: str, path: str, priority: Priority, **kwargs: Any
+    ) -> requests.Response:
+        def send() -> requests.Response:
+            # Streamed responses can't be hedged, as the loser would never
+            # be read or closed
+            if (
+                method == "GET"
+                and self._hedge_policy is not None
+                and not kwargs.get("stream")
+            ):
+                return self._hedge_policy.run(
+                    get_endpoint_template(path),
+                    lambda: self._send(method, path, priority, **kwargs),
+                )
+            return self._send(method, path, priority, **kwargs)
+
+        breaker = self._get_circuit_breaker_for_path(path)
+        if breaker is None:
+            return send()
+        device_id = path.split("/", 2)[1]
+        return breaker.call(
+            send,
+            probe=lambda: self.get_device_connected(device_id),
+            failure_exceptions=(
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.RetryError,
+            ),
+            is_failure=lambda response: response.status_code >= 500,
+        )
+
     def _api_request(self, path: str) -> Any:
         self._check_refresh()
-        api_url = f"{self._api_host}/api/v2/{path}"
-        response = self._requests.get(api_url, headers=self._get_headers())
+        response = self._send_guarded("GET", path, Priority.READ)
         response.raise_for_status()
-        return response.json()
+        return codec.loads(response.content)
 
     def _api_post(self, data: Any, path: str) -> Any:
         self._check_refresh()
         api_url = f"{self._api_host}/api/v2/{path}"
-        # TODO: json dump
         try:
-            data_str = json.dumps(data)
+            data_str = codec.dumps(data)
             _LOGGER.debug(f"Posting {data_str} to {api_url}")
-            response = self._requests.post(
-                api_url, data=data_str, headers=self._get_headers()
+            response = self._send_guarded(
+                "POST", path, Priority.WRITE, data=data_str.encode()
             )
             response.raise_for_status()
         except requests.HTTPError as e:
@@ -124,38 +639,167 @@ class Session(object):
             _LOGGER.error(e)
             _LOGGER.error(e.response.json())
             raise
-        return response.json()
+        return codec.loads(response.content)
+
+    def _cached_api_request(self, path: str) -> Any:
+        if self._topology_cache is None:
+            return self._api_request(path)
+        response = self._topology_cache.get(path)
+        if response is None:
+            response = self._api_request(path)
+            self._topology_cache.set(path, response)
+        # Callers may modify the response, so don't hand out the cached copy
+        return copy.deepcopy(response)
+
+    def invalidate_cache(self, device_id: Optional[str] = None) -> None:
+        """Invalidate cached topology, either for one device's nodes or
+        everything."""
+        if self._topology_cache is None:
+            return
+        if device_id is None:
+            self._topology_cache.clear()
+        else:
+            self._topology_cache.invalidate(f"devs/{device_id}/mgr/nodes")
+
+    def get_cache_stats(self) -> Dict[str, int]:
+        """Get topology cache hit/miss counters."""
+        if self._topology_cache is None:
+            return {}
+        return self._topology_cache.stats()
+
+    @property
+    def setup_cache_enabled(self) -> bool:
+        return self._setup_cache is not None
+
+    def update_setup_cache(
+        self, device_id: str, node_type: str, addr: int, setup: Dict[str, Any]
+    ) -> None:
+        """Record the full current setup for a node (e.g. from a socket
+        update)."""
+        if self._setup_cache is not None:
+            self._setup_cache.set(
+                (device_id, node_type, int(addr)), copy.deepcopy(setup)
+            )
+
+    def get_set_setup_sources(self) -> Dict[str, int]:
+        """Get counts of where set_setup obtained the current setup from."""
+        with self._stats_lock:
+            return {
+                source.value: self._set_setup_sources[source] for source in SetupSource
+            }
+
+    def get_rate_limit_stats(self) -> Dict[str, float]:
+        """Get request scheduler queue depth and wait time metrics."""
+        if self._request_scheduler is None:
+            return {}
+        return self._request_scheduler.stats()
 
     def get_api_name(self) -> str:
         return self._api_name
 
+    @property
+    def _access_token(self) -> str:
+        return self._token.access_token
+
     def get_access_token(self) -> str:
-        return self._access_token
+        return self._token.access_token
 
     def get_refresh_token(self) -> str:
-        return self._refresh_token
+        return self._token.refresh_token
 
     def get_expiry_time(self) -> datetime.datetime:
-        return self._expires_at
+        return self._token.expires_at
 
     def get_devices(self) -> List[Dict[str, Any]]:
-        response = self._api_request("devs")
+        response = self._cached_api_request("devs")
         return response["devs"]
 
     def get_grouped_devices(self):
-        response = self._api_request("grouped_devs")
+        response = self._cached_api_request("grouped_devs")
         return response
 
+    def _iter_api_array(self, path: str, key: Optional[str]) -> Iterator[Any]:
+        self._check_refresh()
+        response = self._send_guarded("GET", path, Priority.READ, stream=True)
+        with response:
+            response.raise_for_status()
+            yield from iter_json_array(response.iter_content(DEFAULT_CHUNK_SIZE), key)
+
+    def iter_devices(self) -> Iterator[Dict[str, Any]]:
+        """Iterate over devices as the response is read, rather than loading
+        the whole listing into memory.
+
+        Bypasses the topology cache. The connection is held until the
+        iterator is exhausted or closed.
+        """
+        return self._iter_api_array("devs", "devs")
+
+    def iter_grouped_devices(self) -> Iterator[Dict[str, Any]]:
+        """Iterate over device groups as the response is read (see
+        iter_devices).
+
+        Each group is parsed whole before it is yielded, so a group and all
+        of its devices are held in memory at once.
+        """
+        return self._iter_api_array("grouped_devs", None)
+
+    def get_dev_data(self, device_id: str) -> Dict[str, Any]:
+        """Get all data for a device (nodes with status and setup, away status
+        etc) in a single request."""
+        return self._api_request(f"devs/{device_id}/dev_data")
+
     def get_nodes(self, device_id: str) -> List[Dict[str, Any]]:
-        response = self._api_request(f"devs/{device_id}/mgr/nodes")
+        response = self._cached_api_request(f"devs/{device_id}/mgr/nodes")
         return response["nodes"]
 
-    def get_status(self, device_id: str, node: Dict[str, Any]) -> Dict[str, str]:
+    def _node_api_request(
+        self, device_id: str, node: Dict[str, Any], endpoint: str
+    ) -> Any:
+        node_type, addr = node["type"], node["addr"]
+        if not self._capabilities.should_request(node_type, endpoint, device_id, addr):
+            raise UnsupportedEndpointError(
+                f"{endpoint} is not supported for {node_type} node {addr}"
+            )
         try:
-            return self._api_request(
-                f"devs/{device_id}/{node['type']}/{node['addr']}/status"
+            response = self._api_request(
+                f"devs/{device_id}/{node_type}/{addr}/{endpoint}"
+            )
+        except requests.HTTPError as e:
+            self._capabilities.record_failure(
+                node_type, endpoint, e.response.status_code, device_id, addr
             )
-        except:
+            raise
+        self._capabilities.record_success(node_type, endpoint, device_id, addr)
+        return response
+
+    def supports_endpoint(
+        self,
+        node_type: str,
+        endpoint: str,
+        device_id: Optional[str] = None,
+        addr: Any = None,
+    ) -> bool:
+        """Check whether a node endpoint (e.g. status) is usable for a node
+        type (or a node, if device_id and addr are given), i.e. it isn't known
+        to be unsupported."""
+        return self._capabilities.is_supported(node_type, endpoint, device_id, addr)
+
+    def get_capabilities(self) -> Dict[str, Dict[str, Optional[bool]]]:
+        """Get whether each node endpoint is supported (None if unknown), by
+        node type."""
+        return self._capabilities.get_capabilities()
+
+    def get_status(self, device_id: str, node: Dict[str, Any]) -> Dict[str, str]:
+        """Get a node's status, or {} if the request failed or the node is
+        known not to support it."""
+        try:
+            return self._node_api_request(device_id, node, "status")
+        except (
+            requests.RequestException,
+            UnsupportedEndpointError,
+            CircuitOpenError,
+        ) as e:
+            _LOGGER.debug(f"Failed to get status for {node['type']} node: {e}")
             return {}
 
     def set_status(
@@ -172,25 +816,192 @@ class Session(object):
         )
 
     def get_setup(self, device_id: str, node: Dict[str, Any]) -> Dict[str, Any]:
-        return self._api_request(
-            f"devs/{device_id}/{node['type']}/{node['addr']}/setup"
-        )
+        setup = self._node_api_request(device_id, node, "setup")
+        self.update_setup_cache(device_id, node["type"], node["addr"], setup)
+        return setup
 
     def set_setup(
         self,
         device_id: str,
         node: Dict[str, Any],
         setup_args: Dict[str, Any],
+        current_setup: Optional[Dict[str, Any]] = None,
     ) -> Dict[str, Any]:
         data = {k: v for k, v in setup_args.items() if v is not None}
-        # setup seems to require all settings to be re-posted, so get current
-        # values and update
-        setup_data = self.get_setup(device_id, node)
+        # setup seems to require all settings to be re-posted, so start from
+        # the current values (supplied, cached or fetched) and update
+        if current_setup is not None:
+            source = SetupSource.PROVIDED
+            setup_data = copy.deepcopy(current_setup)
+        else:
+            cached = None
+            if self._setup_cache is not None:
+                cached = self._setup_cache.get(
+                    (device_id, node["type"], int(node["addr"]))
+                )
+            if cached is not None:
+                source = SetupSource.CACHED
+                setup_data = copy.deepcopy(cached)
+            else:
+                source = SetupSource.FETCHED
+                setup_data = self.get_setup(device_id, node)
+        _LOGGER.debug(f"Using {source.value} setup for set_setup")
+        with self._stats_lock:
+            self._set_setup_sources[source] += 1
         setup_data.update(data)
-        return self._api_post(
+        response = self._api_post(
             data=setup_data,
             path=f"devs/{device_id}/{node['type']}/{node['addr']}/setup",
         )
+        self.update_setup_cache(device_id, node["type"], node["addr"], setup_data)
+        return response
+
+    def get_prog(self, device_id: str, node: Dict[str, Any]) -> Programme:
+        return Programme.from_dict(self._node_api_request(device_id, node, "prog"))
+
+    def set_prog(
+        self, device_id: str, node: Dict[str, Any], prog: Programme
+    ) -> Dict[str, Any]:
+        return self._api_post(
+            data=prog.to_dict(),
+            path=f"devs/{device_id}/{node['type']}/{node['addr']}/prog",
+        )
+
+    def _get_supported_nodes(
+        self, kind: str, executor: ThreadPoolExecutor
+    ) -> List[Tuple[str, Dict[str, Any]]]:
+        """Get (dev_id, node) for every node supporting the kind endpoint,
+        logging those skipped."""
+        dev_ids = [device["dev_id"] for device in self.get_devices()]
+        supported = []
+        skipped = []
+        for dev_id, nodes in zip(dev_ids, executor.map(self.get_nodes, dev_ids)):
+            for node in nodes:
+                if self.supports_endpoint(node["type"], kind, dev_id, node["addr"]):
+                    supported.append((dev_id, node))
+                else:
+                    skipped.append((dev_id, node["type"], node["addr"]))
+        if skipped:
+            _LOGGER.info(f"Skipped {kind} for unsupported nodes {skipped}")
+        return supported
+
+    def get_all_node_states(
+        self, kind: str = "status", max_concurrency: int = _DEFAULT_MAX_CONCURRENCY
+    ) -> Dict[Tuple[str, str, int], Any]:
+        """Get status, setup or prog for every node on every device.
+
+        Requests are issued in parallel (at most max_concurrency at a time) and
+        results are keyed by (dev_id, node_type, addr). Nodes known not to
+        support the endpoint are skipped (and logged). Statuses which can't be
+        fetched are {}, and setups and programmes None (and logged), so one
+        failing node doesn't lose the rest.
+        """
+        if kind not in _NODE_STATE_KINDS:
+            raise ValueError(f"Unknown node state kind {kind}")
+        getter = getattr(self, f"get_{kind}")
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = {
+                (dev_id, node["type"], node["addr"]): executor.submit(
+                    getter, dev_id, node
+                )
+                for dev_id, node in self._get_supported_nodes(kind, executor)
+            }
+            states: Dict[Tuple[str, str, int], Any] = {}
+            for key, future in futures.items():
+                try:
+                    states[key] = future.result()
+                except Exception as e:
+                    _LOGGER.warning(f"Failed to get {kind} for {key}: {e}")
+                    states[key] = None
+            return states
+
+    def _roll_out_prog_to_node(
+        self,
+        prog: Programme,
+        dev_id: str,
+        node: Dict[str, Any],
+        current: Optional[Programme],
+    ) -> bool:
+        if current is None:
+            current = self.get_prog(dev_id, node)
+        if current.slots_per_day != prog.slots_per_day:
+            prog = prog.resample(current.slots_per_day)
+        if current == prog:
+            return False
+        self.set_prog(dev_id, node, prog)
+        return True
+
+    def roll_out_prog(
+        self,
+        prog: Programme,
+        nodes: Optional[Iterable[Tuple[str, str, int]]] = None,
+        current_progs: Optional[Dict[Tuple[str, str, int], Programme]] = None,
+        max_concurrency: int = _DEFAULT_MAX_CONCURRENCY,
+    ) -> ProgRollout:
+        """Set the programme of many nodes, only posting to nodes whose
+        programme differs.
+
+        nodes are (dev_id, node_type, addr) keys, defaulting to all nodes
+        supporting prog. The current programme of each node is fetched
+        unless supplied in current_progs (e.g. from an earlier rollout). prog
+        is resampled for nodes with a different number of slots per day.
+        Failures (e.g. a node not supporting prog, or prog not being
+        representable in its slots) don't stop the rollout to other nodes,
+        and are returned with the keys of the nodes posted to.
+        """
+        if current_progs is None:
+            current_progs = {}
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            if nodes is None:
+                targets = self._get_supported_nodes("prog", executor)
+            else:
+                targets = [
+                    (dev_id, {"type": node_type, "addr": addr})
+                    for dev_id, node_type, addr in nodes
+                ]
+            futures = {
+                (dev_id, node["type"], node["addr"]): executor.submit(
+                    self._roll_out_prog_to_node,
+                    prog,
+                    dev_id,
+                    node,
+                    current_progs.get((dev_id, node["type"], node["addr"])),
+                )
+                for dev_id, node in targets
+            }
+            posted = []
+            failed = {}
+            for key, future in futures.items():
+                try:
+                    if future.result():
+                        posted.append(key)
+                except Exception as e:
+                    _LOGGER.warning(f"Failed to roll out programme to {key}: {e}")
+                    failed[key] = e
+        _LOGGER.debug(
+            f"Programme posted to {len(posted)} of {len(futures)} nodes"
+            f", {len(failed)} failed"
+        )
+        return ProgRollout(posted, failed)
+
+    def get_version(self, device_id: str, node: Dict[str, Any]) -> Dict[str, Any]:
+        return self._node_api_request(device_id, node, "version")
+
+    def get_device_connected(self, device_id: str) -> bool:
+        """Check whether a device is connected to the server.
+
+        This bypasses the device's circuit breaker, so can be used as a health
+        check.
+        """
+        resp = self._api_request(f"devs/{device_id}/connected")
+        return bool(resp.get("connected")) if isinstance(resp, dict) else bool(resp)
+
+    def get_circuit_breaker(self, device_id: str) -> Optional[CircuitBreaker]:
+        """Get the circuit breaker for a device, if circuit breakers are
+        enabled."""
+        if self._circuit_breakers is None:
+            return None
+        return self._circuit_breakers.get(device_id)
 
     def get_device_away_status(self, device_id: str) -> Dict[str, Any]:
         return self._api_request(f"devs/{device_id}/mgr/away_status")
@@ -0,0 +1,384 @@
+"""Pool of Sessions for many accounts, sharing connection pools and token
+refresh scheduling."""
+
+from collections import OrderedDict
+import datetime
+import heapq
+import http.cookiejar
+import logging
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import requests
+
+from .session import (
+    _DEFAULT_BACKOFF_FACTOR,
+    _DEFAULT_POOL_CONNECTIONS,
+    _DEFAULT_POOL_MAXSIZE,
+    _DEFAULT_REFRESH_LEAD_TIME,
+    _DEFAULT_RETRY_ATTEMPTS,
+    _MAX_REFRESH_RETRY_INTERVAL,
+    _MIN_REFRESH_INTERVAL,
+    Session,
+    _get_refresh_lead_time,
+    _get_refresh_retry_interval,
+    create_requests_session,
+)
+
+# Wait before first retrying a failed background refresh, backing off for
+# further failures (seconds)
+_REFRESH_RETRY_INTERVAL = 30.0
+
+_LOGGER = logging.getLogger(__name__)
+
+SessionKey = Tuple[str, str]
+
+
+def _get_object_size(obj: Any, seen: Set[int]) -> int:
+    """Approximate the memory used by obj and everything it references, not
+    counting objects whose ids are already in seen."""
+    if id(obj) in seen or isinstance(obj, (type, type(sys))) or callable(obj):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(
+            _get_object_size(k, seen) + _get_object_size(v, seen)
+            for k, v in obj.items()
+        )
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_get_object_size(item, seen) for item in obj)
+    if hasattr(obj, "__dict__"):
+        size += _get_object_size(vars(obj), seen)
+    for slot in getattr(type(obj), "__slots__", ()):
+        if hasattr(obj, slot):
+            size += _get_object_size(getattr(obj, slot), seen)
+    return size
+
+
+class SessionPool(object):
+    """Pool of Sessions for many accounts in one process.
+
+    Sessions for the same API host share a requests.Session, and so its
+    connection pools (and TLS connections). Cookies are disabled on the shared
+    requests sessions so that they can't leak between accounts.
+
+    Tokens for all accounts are refreshed refresh_lead_time seconds (or half
+    their lifetime, if shorter) before they expire by a single background
+    thread (see start_refresh_scheduler), backing off on failure.
+    If max_sessions is set, the least recently used sessions are evicted when
+    it is exceeded, and if idle_timeout is set, evict_idle() evicts sessions
+    which have not been used for that many seconds (the refresh thread also
+    does this periodically). Evicted sessions are closed, but can still be
+    used by anyone holding a reference, and get_session() will create a new
+    one (using a token store avoids a new password grant in that case).
+
+    Other keyword arguments are passed to each Session.
+    """
+
+    def __init__(
+        self,
+        max_sessions: Optional[int] = None,
+        idle_timeout: Optional[float] = None,
+        refresh_lead_time: float = _DEFAULT_REFRESH_LEAD_TIME,
+        retry_attempts: int = _DEFAULT_RETRY_ATTEMPTS,
+        backoff_factor: float = _DEFAULT_BACKOFF_FACTOR,
+        pool_connections: int = _DEFAULT_POOL_CONNECTIONS,
+        pool_maxsize: int = _DEFAULT_POOL_MAXSIZE,
+        pool_block: bool = False,
+        tcp_keepalive: Optional[int] = None,
+        **session_kwargs: Any,
+    ) -> None:
+        """Create an empty pool."""
+        if max_sessions is not None and max_sessions < 1:
+            raise ValueError("max_sessions must be at least 1")
+        self._max_sessions = max_sessions
+        self._idle_timeout = idle_timeout
+        self._refresh_lead_time = refresh_lead_time
+        self._retry_attempts = retry_attempts
+        self._backoff_factor = backoff_factor
+        self._pool_options: Dict[str, Any] = {
+            "pool_connections": pool_connections,
+            "pool_maxsize": pool_maxsize,
+            "pool_block": pool_block,
+            "tcp_keepalive": tcp_keepalive,
+        }
+        self._session_kwargs = session_kwargs
+
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[SessionKey, Session]" = OrderedDict()
+        self._requests_sessions: Dict[str, requests.Session] = {}
+        self._evictions = 0
+        self._refreshes = 0
+        self._refresh_failures = 0
+
+        # Refresh schedule, a heap of (refresh time, key)
+        self._refresh_heap: List[Tuple[float, SessionKey]] = []
+        self._refresh_at: Dict[SessionKey, float] = {}
+        # Lead time the refresh was scheduled with, and consecutive failures
+        self._refresh_lead: Dict[SessionKey, float] = {}
+        self._refresh_retries: Dict[SessionKey, int] = {}
+        self._refresh_cond = threading.Condition(self._lock)
+        self._refresh_thread: Optional[threading.Thread] = None
+        self._stop_refresh = False
+
+    def _get_requests_session(self, api_host: str) -> requests.Session:
+        requests_session = self._requests_sessions.get(api_host)
+        if requests_session is None:
+            requests_session = create_requests_session(
+                self._retry_attempts,
+                self._backoff_factor,
+                retry_rate_limited=self._session_kwargs.get("rate_limit") is None,
+                **self._pool_options,
+            )
+            requests_session.cookies.set_policy(
+                http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+            )
+            self._requests_sessions[api_host] = requests_session
+        return requests_session
+
+    def _schedule_refresh(self, key: SessionKey, session: Session) -> None:
+        expires_at = session.get_expiry_time()
+        lead_time = _get_refresh_lead_time(self._refresh_lead_time, expires_at)
+        self._refresh_lead[key] = lead_time
+        refresh_at = (expires_at - datetime.timedelta(seconds=lead_time)).timestamp()
+        self._push_refresh(key, refresh_at)
+
+    def _unschedule_refresh(self, key: SessionKey) -> None:
+        self._refresh_at.pop(key, None)
+        self._refresh_lead.pop(key, None)
+        self._refresh_retries.pop(key, None)
+
+    def _push_refresh(self, key: SessionKey, refresh_at: float) -> None:
+        # Only the latest entry for each key is live, older ones are skipped
+        self._refresh_at[key] = refresh_at
+        heapq.heappush(self._refresh_heap, (refresh_at, key))
+        if self._refresh_heap[0] == (refresh_at, key):
+            self._refresh_cond.notify_all()
+
+    def get_session(
+        self,
+        api_name: str,
+        basic_auth_credentials: str,
+        username: str,
+        password: str,
+        api_host: Optional[str] = None,
+    ) -> Session:
+        """Get the session for an account, creating (and authenticating) it if
+        it isn't in the pool."""
+        key = (api_name, username)
+        if api_host is None:
+            api_host = f"https://{api_name}.helki.com"
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None:
+                self._sessions.move_to_end(key)
+                return session
+            requests_session = self._get_requests_session(api_host)
+
+        # Authenticate outside the lock so accounts can be added concurrently
+        session = Session(
+            api_name,
+            basic_auth_credentials,
+            username,
+            password,
+            retry_attempts=self._retry_attempts,
+            backoff_factor=self._backoff_factor,
+            api_host=api_host,
+            requests_session=requests_session,
+            **self._session_kwargs,
+        )
+
+        evicted = []
+        with self._lock:
+            existing = self._sessions.get(key)
+            if existing is not None:
+                # Lost a race with another caller
+                self._sessions.move_to_end(key)
+                evicted.append(session)
+                session = existing
+            else:
+                self._sessions[key] = session
+                self._schedule_refresh(key, session)
+                while (
+                    self._max_sessions is not None
+                    and len(self._sessions) > self._max_sessions
+                ):
+                    evicted_key, evicted_session = self._sessions.popitem(last=False)
+                    self._unschedule_refresh(evicted_key)
+                    _LOGGER.debug(f"Evicting least recently used session {evicted_key}")
+                    self._evictions += 1
+                    evicted.append(evicted_session)
+        for s in evicted:
+            s.close()
+        return session
+
+    def remove(self, api_name: str, username: str) -> bool:
+        """Remove and close the session for an account, if present."""
+        with self._lock:
+            session = self._sessions.pop((api_name, username), None)
+            self._unschedule_refresh((api_name, username))
+        if session is None:
+            return False
+        session.close()
+        return True
+
+    def evict_idle(self) -> int:
+        """Evict sessions which haven't been used for idle_timeout seconds.
+
+        Returns the number of sessions evicted.
+        """
+        if self._idle_timeout is None:
+            return 0
+        cutoff = time.monotonic() - self._idle_timeout
+        with self._lock:
+            idle = [k for k, s in self._sessions.items() if s.last_used < cutoff]
+            evicted = [self._sessions.pop(k) for k in idle]
+            for k in idle:
+                self._unschedule_refresh(k)
+            self._evictions += len(evicted)
+        for session in evicted:
+            session.close()
+        if evicted:
+            _LOGGER.debug(f"Evicted {len(evicted)} idle sessions")
+        return len(evicted)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def __contains__(self, key: SessionKey) -> bool:
+        with self._lock:
+            return key in self._sessions
+
+    def _refresh_due(self) -> None:
+        now = time.time()
+        due: List[Tuple[SessionKey, Session, float]] = []
+        with self._lock:
+            while self._refresh_heap and self._refresh_heap[0][0] <= now:
+                refresh_at, key = heapq.heappop(self._refresh_heap)
+                # Skip stale entries (e.g. for evicted sessions)
+                if self._refresh_at.get(key) == refresh_at:
+                    del self._refresh_at[key]
+                    lead_time = self._refresh_lead.get(key, self._refresh_lead_time)
+                    due.append((key, self._sessions[key], lead_time))
+        for key, session, lead_time in due:
+            try:
+                # A little over the lead time, so the refresh is due now
+                session._refresh(lead_time + _MIN_REFRESH_INTERVAL)
+            except Exception:
+                # Requests will still refresh on demand if we keep failing
+                _LOGGER.exception(f"Background token refresh failed for {key}")
+                with self._lock:
+                    self._refresh_failures += 1
+                    if self._sessions.get(key) is session:
+                        retries = self._refresh_retries.get(key, 0) + 1
+                        self._refresh_retries[key] = retries
+                        retry_interval = _get_refresh_retry_interval(
+                            retries,
+                            _REFRESH_RETRY_INTERVAL,
+                            _MAX_REFRESH_RETRY_INTERVAL,
+                        )
+                        self._push_refresh(key, now + retry_interval)
+                continue
+            with self._lock:
+                self._refreshes += 1
+                if self._sessions.get(key) is session:
+                    self._refresh_retries.pop(key, None)
+                    self._schedule_refresh(key, session)
+
+    def _refresh_loop(self) -> None:
+        _LOGGER.debug("Starting session pool refresh scheduler")
+        while True:
+            with self._lock:
+                if self._stop_refresh:
+                    break
+                wait: Optional[float] = None
+                if self._refresh_heap:
+                    wait = self._refresh_heap[0][0] - time.time()
+                if self._idle_timeout is not None:
+                    wait = (
+                        self._idle_timeout
+                        if wait is None
+                        else min(wait, self._idle_timeout)
+                    )
+                if wait is None or wait > 0:
+                    self._refresh_cond.wait(wait)
+                if self._stop_refresh:
+                    break
+            self._refresh_due()
+            self.evict_idle()
+        _LOGGER.debug("Stopped session pool refresh scheduler")
+
+    def start_refresh_scheduler(self) -> None:
+        """Refresh tokens for all sessions in the background, using a single
+        thread."""
+        with self._lock:
+            if self._refresh_thread is not None:
+                return
+            self._stop_refresh = False
+            self._refresh_thread = threading.Thread(
+                target=self._refresh_loop,
+                name="smartbox-session-pool-refresh",
+                daemon=True,
+            )
+        self._refresh_thread.start()
+
+    def stop_refresh_scheduler(self) -> None:
+        """Stop the background refresh scheduler, if running."""
+        with self._lock:
+            thread = self._refresh_thread
+            if thread is None:
+                return
+            self._stop_refresh = True
+            self._refresh_cond.notify_all()
+        thread.join()
+        self._refresh_thread = None
+
+    def get_memory_usage(self) -> Dict[SessionKey, int]:
+        """Estimate the memory used by each account's session, in bytes.
+
+        Objects shared between sessions (e.g. the requests sessions, token
+        stores and metrics) are not counted.
+        """
+        with self._lock:
+            sessions = list(self._sessions.items())
+            shared = [self, *self._requests_sessions.values()]
+            shared += self._session_kwargs.values()
+        usage = {}
+        for key, session in sessions:
+            seen = {id(obj) for obj in shared}
+            if session._request_scheduler is not None:
+                seen.add(id(session._request_scheduler))
+            usage[key] = _get_object_size(session, seen)
+        return usage
+
+    def stats(self) -> Dict[str, int]:
+        """Get pool size, eviction and background refresh counts."""
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "hosts": len(self._requests_sessions),
+                "evictions": self._evictions,
+                "refreshes": self._refreshes,
+                "refresh_failures": self._refresh_failures,
+                "scheduled_refreshes": len(self._refresh_at),
+            }
+
+    def close(self) -> None:
+        """Stop the refresh scheduler and close all sessions and connection
+        pools."""
+        self.stop_refresh_scheduler()
+        with self._lock:
+            sessions = list(self._sessions.values())
+            requests_sessions = list(self._requests_sessions.values())
+            self._sessions.clear()
+            self._requests_sessions.clear()
+            self._refresh_heap.clear()
+            self._refresh_at.clear()
+        for session in sessions:
+            session.close()
+        for requests_session in requests_sessions:
+            requests_session.close()
@@ -1,10 +1,20 @@
 import asyncio
+from collections import deque
+import datetime
+from enum import Enum
+import inspect
 import logging
 import signal
 import socketio
-from typing import Any, Callable, Dict, Optional
+import time
+from typing import Any, Callable, Deque, Dict, Optional, Tuple, Union
 import urllib
 
+from . import codec
+from .async_session import AsyncSession
+from .circuit_breaker import CircuitBreaker, CircuitState
+from .dispatch import DispatchQueue
+from .error import CircuitOpenError
 from .session import Session
 
 _API_V2_NAMESPACE = "/api/v2/socket_io"
@@ -12,14 +22,47 @@ _API_V2_NAMESPACE = "/api/v2/socket_io"
 # expires, so we don't want to try many times
 _DEFAULT_RECONNECT_ATTEMPTS = 3
 _DEFAULT_BACKOFF_FACTOR = 0.1
+# How often to check whether another request has closed an open circuit
+_CIRCUIT_PROBE_POLL_INTERVAL = 1.0
+# How long to wait for a rotated connection to receive dev_data
+_ROTATION_TIMEOUT = 30.0
+# Minimum time between rotation attempts
+_ROTATION_RETRY_INTERVAL = 10.0
+# How long after switching connections to dedupe updates, and how many to
+# remember
+_ROTATION_DEDUPE_WINDOW = 10.0
+_ROTATION_DEDUPE_HISTORY = 64
+# Connection errors with these (engineio) statuses are due to the token
+_AUTH_FAILURE_STATUSES = (401, 403)
 
 _LOGGER = logging.getLogger(__name__)
 
 
+class SocketState(str, Enum):
+    """Connection state of a SocketSession."""
+
+    DISCONNECTED = "disconnected"
+    # Waiting for the device's circuit breaker to allow a connection
+    WAITING = "waiting"
+    CONNECTING = "connecting"
+    CONNECTED = "connected"
+    CLOSED = "closed"
+
+
+def _merge_updates(queued: tuple, new: tuple) -> tuple:
+    """Merge a coalesced update into the queued one for the same path, as
+    update bodies may only include changed fields."""
+    (queued_data,), (new_data,) = queued, new
+    queued_body, new_body = queued_data.get("body"), new_data.get("body")
+    if isinstance(queued_body, dict) and isinstance(new_body, dict):
+        return ({**new_data, "body": {**queued_body, **new_body}},)
+    return new
+
+
 class SmartboxAPIV2Namespace(socketio.AsyncClientNamespace):
     def __init__(
         self,
-        session: Session,
+        session: Union[Session, AsyncSession],
         namespace: str,
         dev_data_callback: Optional[Callable] = None,
         node_update_callback: Optional[Callable] = None,
@@ -54,7 +97,9 @@ class SmartboxAPIV2Namespace(socketio.AsyncClientNamespace):
         self._received_message = True
         self._received_dev_data = True
         if self._dev_data_callback is not None:
-            self._dev_data_callback(data)
+            result = self._dev_data_callback(data)
+            if inspect.isawaitable(result):
+                await result
 
     async def on_update(self, data: Dict[str, Any]) -> None:
         _LOGGER.debug(f"Received update: {data}")
@@ -68,13 +113,15 @@ class SmartboxAPIV2Namespace(socketio.AsyncClientNamespace):
             _LOGGER.debug("Dev data not received yet, ignoring update")
             return
         if self._node_update_callback is not None:
-            self._node_update_callback(data)
+            result = self._node_update_callback(data)
+            if inspect.isawaitable(result):
+                await result
 
 
 class SocketSession(object):
     def __init__(
         self,
-        session: Session,
+        session: Union[Session, AsyncSession],
         device_id: str,
         dev_data_callback: Optional[Callable] = None,
         node_update_callback: Optional[Callable] = None,
@@ -83,33 +130,88 @@ class SocketSession(object):
         ping_interval: int = 20,
         reconnect_attempts: int = _DEFAULT_RECONNECT_ATTEMPTS,
         backoff_factor: float = _DEFAULT_BACKOFF_FACTOR,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        send_pings: bool = True,
+        connect_semaphore: Optional[asyncio.Semaphore] = None,
+        rotate_before_expiry: Optional[float] = None,
+        dispatch_queue: Optional[DispatchQueue] = None,
     ) -> None:
         self._session = session
+        # An AsyncSession can refresh its token on our event loop, whereas a
+        # (blocking) Session needs to go via an executor
+        self._session_is_async = asyncio.iscoroutinefunction(session._check_refresh)
         self._device_id = device_id
         self._ping_interval = ping_interval
+        # Pings can instead be sent by calling send_ping (e.g. from
+        # SocketFleet), and connection attempts limited by a shared semaphore
+        self._send_pings = send_pings
+        self._connect_semaphore = connect_semaphore
+        self._ping_task: Optional[asyncio.Task] = None
+        self._state = SocketState.DISCONNECTED
         self._reconnect_attempts = reconnect_attempts
         self._backoff_factor = backoff_factor
+        # Share the device's circuit breaker with the REST session by default,
+        # so we stop reconnecting while the device is known to be offline
+        if circuit_breaker is None and isinstance(session, Session):
+            circuit_breaker = session.get_circuit_breaker(device_id)
+        self._circuit_breaker = circuit_breaker
+
+        # If set, a new connection is made this many seconds before the
+        # token expires and swapped in once it has received dev_data
+        self._rotate_before_expiry = rotate_before_expiry
+        self._connected_expiry: Optional[datetime.datetime] = None
+        self._rotation_task: Optional[asyncio.Future] = None
+        self._rotation: Optional[asyncio.Future] = None
+        self._rotation_ready: Optional[asyncio.Event] = None
+        self._pending_sio: Optional[socketio.AsyncClient] = None
+        self._pending_ns: Optional[SmartboxAPIV2Namespace] = None
+        # Fingerprints of the updates delivered by each connection around a
+        # rotation, so those the other connection repeats can be dropped
+        self._delivered_updates: Dict[SmartboxAPIV2Namespace, Deque[str]] = {}
+        self._dedupe_until = 0.0
+        self._rotations = 0
+
+        self._dev_data_callback = dev_data_callback
+        self._node_update_callback = node_update_callback
+        # If set, callbacks are queued rather than run in the receive loop
+        self._dispatch_queue = dispatch_queue
+        self._verbose = verbose
+        self._add_sigint_handler = add_sigint_handler
+        if not verbose:
+            logging.getLogger("socketio").setLevel(logging.ERROR)
+            logging.getLogger("engineio").setLevel(logging.ERROR)
+        self._sio, self._api_v2_ns = self._create_client()
 
-        if verbose:
-            self._sio = socketio.AsyncClient(
+    def _create_client(
+        self,
+    ) -> Tuple[socketio.AsyncClient, SmartboxAPIV2Namespace]:
+        # Passing json sets it for every socketio client in the process, so
+        # only do so if a codec has been explicitly selected
+        kwargs: Dict[str, Any] = (
+            {"json": codec} if codec.is_json_codec_selected() else {}
+        )
+        if self._verbose:
+            sio = socketio.AsyncClient(
                 logger=True,
                 engineio_logger=True,
-                reconnection_attempts=reconnect_attempts,
+                reconnection_attempts=self._reconnect_attempts,
+                **kwargs,
             )
         else:
-            logging.getLogger("socketio").setLevel(logging.ERROR)
-            logging.getLogger("engineio").setLevel(logging.ERROR)
-            self._sio = socketio.AsyncClient()
+            sio = socketio.AsyncClient(**kwargs)
 
-        self._api_v2_ns = SmartboxAPIV2Namespace(
-            session, _API_V2_NAMESPACE, dev_data_callback, node_update_callback
+        namespace = SmartboxAPIV2Namespace(
+            self._session,
+            _API_V2_NAMESPACE,
+            lambda data: self._on_dev_data(namespace, data),
+            lambda data: self._on_update(namespace, data),
         )
-        self._sio.register_namespace(self._api_v2_ns)
+        sio.register_namespace(namespace)
 
-        @self._sio.event
+        @sio.event
         async def connect():
             _LOGGER.debug("Received connect socket event")
-            if add_sigint_handler:
+            if self._add_sigint_handler:
                 # engineio sets a signal handler on connect, which means we
                 # have to set our own in the connect callback if we want to
                 # override it
@@ -122,47 +224,271 @@ class SocketSession(object):
 
                 event_loop.add_signal_handler(signal.SIGINT, sigint_handler)
 
+        return sio, namespace
+
+    async def _dispatch(
+        self,
+        callback: Optional[Callable],
+        data: Dict[str, Any],
+        key: Any,
+        merge: Optional[Callable[[tuple, tuple], tuple]] = None,
+    ) -> None:
+        if callback is None:
+            return
+        if self._dispatch_queue is not None:
+            # Keys are per device, as the queue may be shared
+            await self._dispatch_queue.put(
+                callback,
+                data,
+                key=None if key is None else (self._device_id, key),
+                merge=merge,
+            )
+        else:
+            result = callback(data)
+            if inspect.isawaitable(result):
+                await result
+
+    async def _on_dev_data(
+        self, namespace: SmartboxAPIV2Namespace, data: Dict[str, Any]
+    ) -> None:
+        if namespace is self._pending_ns:
+            # The old connection has kept us up to date, so switch over
+            # without a resync
+            self._switch_to_pending()
+            return
+        if namespace is self._api_v2_ns:
+            await self._dispatch(self._dev_data_callback, data, "dev_data")
+
+    async def _on_update(
+        self, namespace: SmartboxAPIV2Namespace, data: Dict[str, Any]
+    ) -> None:
+        if namespace is not self._api_v2_ns:
+            # From the old connection after switching (or the new one before)
+            return
+        if self._pending_ns is not None or time.monotonic() < self._dedupe_until:
+            # Both connections may deliver the same update around the switch.
+            # Only updates already delivered by the other connection are
+            # duplicates, as one connection can legitimately repeat itself
+            # (e.g. a value changing and changing back).
+            fingerprint = codec.dumps(data, sort_keys=True)
+            for other, delivered in self._delivered_updates.items():
+                if other is not namespace and fingerprint in delivered:
+                    delivered.remove(fingerprint)
+                    _LOGGER.debug(f"Ignoring duplicate update: {data}")
+                    return
+            self._delivered_updates.setdefault(
+                namespace, deque(maxlen=_ROTATION_DEDUPE_HISTORY)
+            ).append(fingerprint)
+        await self._dispatch(
+            self._node_update_callback, data, data.get("path"), _merge_updates
+        )
+
+    def _switch_to_pending(self) -> None:
+        assert self._pending_sio is not None and self._pending_ns is not None
+        _LOGGER.info("Switching to rotated connection")
+        old_ns = self._api_v2_ns
+        self._sio, self._api_v2_ns = self._pending_sio, self._pending_ns
+        self._pending_sio = self._pending_ns = None
+        self._delivered_updates = {
+            ns: delivered
+            for ns, delivered in self._delivered_updates.items()
+            if ns is old_ns
+        }
+        self._dedupe_until = time.monotonic() + _ROTATION_DEDUPE_WINDOW
+        if self._rotation_ready is not None:
+            self._rotation_ready.set()
+
+    async def send_ping(self) -> bool:
+        """Send a ping if connected, returning whether it was sent."""
+        if not self._api_v2_ns.connected:
+            _LOGGER.debug("Namespace disconnected, not sending ping")
+            return False
+        _LOGGER.debug("Sending ping")
+        await self._sio.send("ping", namespace=_API_V2_NAMESPACE)
+        return True
+
     async def _send_ping(self):
         _LOGGER.debug(f"Starting ping task every {self._ping_interval}s")
         while True:
             await asyncio.sleep(self._ping_interval)
-            if not self._api_v2_ns.connected:
-                _LOGGER.debug("Namespace disconnected, not sending ping")
+            await self.send_ping()
+
+    async def _check_session_refresh(self) -> None:
+        if self._session_is_async:
+            await self._session._check_refresh()  # type: ignore
+        else:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self._session._check_refresh)
+
+    async def _refresh_token_if_expiring(self, min_lifetime: float) -> None:
+        if self._session_is_async:
+            await self._session.refresh_token_if_expiring(min_lifetime)  # type: ignore
+        else:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(
+                None, self._session.refresh_token_if_expiring, min_lifetime
+            )
+
+    async def _check_device_connected(self) -> bool:
+        try:
+            if self._session_is_async:
+                return await self._session.get_device_connected(  # type: ignore
+                    self._device_id
+                )
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                None, self._session.get_device_connected, self._device_id  # type: ignore
+            )
+        except Exception as e:
+            _LOGGER.debug(f"Device connected check failed: {e}")
+            return False
+
+    async def _wait_for_circuit(self) -> CircuitState:
+        if self._circuit_breaker is None:
+            return CircuitState.CLOSED
+        while True:
+            delay = self._circuit_breaker.retry_delay()
+            if delay > 0:
+                self._state = SocketState.WAITING
+                _LOGGER.info(f"Circuit open, waiting {delay:.1f}s before connecting")
+                await asyncio.sleep(delay)
+            try:
+                state = self._circuit_breaker.before_request()
+            except CircuitOpenError:
+                # Another request is probing the device
+                await asyncio.sleep(_CIRCUIT_PROBE_POLL_INTERVAL)
                 continue
-            _LOGGER.debug("Sending ping")
-            await self._sio.send("ping", namespace=_API_V2_NAMESPACE)
+            if state != CircuitState.HALF_OPEN or await self._check_device_connected():
+                return state
+            self._circuit_breaker.record_failure()
+
+    def _is_token_failure(self, e: socketio.exceptions.ConnectionError) -> bool:
+        # An expired or rejected token says nothing about the health of the
+        # device (or server), so mustn't count towards opening the circuit
+        # shared with the REST session
+        expiry = self._session.get_expiry_time()
+        if isinstance(expiry, datetime.datetime) and expiry <= datetime.datetime.now():
+            return True
+        message = str(e.args[0]) if e.args else ""
+        return any(
+            f"status code {status}" in message for status in _AUTH_FAILURE_STATUSES
+        )
+
+    def _get_connect_urls(self) -> Tuple[str, str]:
+        # TODO: accessors in session
+        encoded_token = urllib.parse.quote(
+            self._session._access_token, safe="~()*!.'"  # type: ignore
+        )
+        url = (
+            f"{self._session._api_host}"
+            + f"/?token={encoded_token}&dev_id={self._device_id}"
+        )
+        namespace = (
+            f"{_API_V2_NAMESPACE}?token={encoded_token}&dev_id={self._device_id}"
+        )
+        return url, namespace
+
+    async def _connect(
+        self, sio: socketio.AsyncClient, url: str, namespace: str
+    ) -> None:
+        if self._connect_semaphore is None:
+            await sio.connect(url, namespaces=[namespace])
+            return
+        async with self._connect_semaphore:
+            await sio.connect(url, namespaces=[namespace])
+
+    async def _rotate(self) -> None:
+        assert self._rotate_before_expiry is not None
+        _LOGGER.info("Token expiring soon, rotating socket connection")
+        await self._refresh_token_if_expiring(self._rotate_before_expiry)
+        old_sio = self._sio
+        sio, namespace = self._create_client()
+        self._rotation_ready = asyncio.Event()
+        self._delivered_updates = {}
+        self._pending_sio, self._pending_ns = sio, namespace
+        expiry = self._session.get_expiry_time()
+        url, namespace_url = self._get_connect_urls()
+        try:
+            await self._connect(sio, url, namespace_url)
+            await asyncio.wait_for(self._rotation_ready.wait(), _ROTATION_TIMEOUT)
+        except BaseException:
+            if self._pending_sio is sio:
+                self._pending_sio = self._pending_ns = None
+                await sio.disconnect()
+            raise
+        self._connected_expiry = expiry
+        self._rotations += 1
+        await old_sio.disconnect()
+
+    async def _rotate_loop(self) -> None:
+        assert self._rotate_before_expiry is not None
+        while True:
+            delay = _ROTATION_RETRY_INTERVAL
+            if (
+                self._state == SocketState.CONNECTED
+                and self._connected_expiry is not None
+            ):
+                remaining = (
+                    self._connected_expiry - datetime.datetime.now()
+                ).total_seconds() - self._rotate_before_expiry
+                if remaining > 0:
+                    delay = remaining
+                else:
+                    self._rotation = asyncio.ensure_future(self._rotate())
+                    try:
+                        await self._rotation
+                    except Exception:
+                        _LOGGER.exception("Socket rotation failed, will retry")
+            await asyncio.sleep(delay)
+
+    async def _wait(self) -> None:
+        while True:
+            sio = self._sio
+            await sio.wait()
+            if self._rotation is not None and not self._rotation.done():
+                # The old connection dropped mid-rotation, which may still
+                # succeed
+                await asyncio.wait([self._rotation])
+            if self._sio is sio:
+                return
+            # Rotated, so wait on the new connection
 
     async def run(self) -> None:
-        self._ping_task = self._sio.start_background_task(self._send_ping)
+        if self._session_is_async:
+            # Make sure we have an access token before the first connection
+            await self._check_session_refresh()
+
+        if self._send_pings:
+            self._ping_task = self._sio.start_background_task(self._send_ping)
+        if self._rotate_before_expiry is not None:
+            self._rotation_task = asyncio.ensure_future(self._rotate_loop())
 
         # Will loop indefinitely unless our signal handler is set and called
         self._loop_should_exit = False
 
         _LOGGER.debug("Starting main loop")
         while not self._loop_should_exit:
-            # TODO: accessors in session
-            encoded_token = urllib.parse.quote(
-                self._session._access_token, safe="~()*!.'"
-            )
-            url = (
-                f"{self._session._api_host}"
-                + f"/?token={encoded_token}&dev_id={self._device_id}"
-            )
+            url, namespace = self._get_connect_urls()
+            if self._rotate_before_expiry is not None:
+                expiry = self._session.get_expiry_time()
 
             # Try to connect
             _LOGGER.debug(
                 f"Connecting to {url} (will try {self._reconnect_attempts} times)"
             )
             for attempt in range(self._reconnect_attempts):
+                circuit_state = await self._wait_for_circuit()
                 _LOGGER.debug(f"Connecting to {url} (attempt #{attempt})")
+                self._state = SocketState.CONNECTING
                 try:
-                    await self._sio.connect(
-                        url,
-                        namespaces=[
-                            f"{_API_V2_NAMESPACE}?token={encoded_token}&dev_id={self._device_id}"
-                        ],
-                    )
-                except socketio.exceptions.ConnectionError:
+                    await self._connect(self._sio, url, namespace)
+                except socketio.exceptions.ConnectionError as e:
+                    self._state = SocketState.DISCONNECTED
+                    if self._circuit_breaker is not None:
+                        if not self._is_token_failure(e):
+                            self._circuit_breaker.record_failure()
+                        elif circuit_state == CircuitState.HALF_OPEN:
+                            self._circuit_breaker.release_probe()
                     remaining = self._reconnect_attempts - attempt - 1
                     sleep_time = self._backoff_factor * (2**attempt)
                     _LOGGER.error(
@@ -178,23 +504,49 @@ class SocketSession(object):
                             " attempts, falling through to refresh token"
                         )
                 else:
+                    if self._circuit_breaker is not None:
+                        self._circuit_breaker.record_success()
                     _LOGGER.info(f"Successfully connected to {url}")
-                    await self._sio.wait()
+                    self._state = SocketState.CONNECTED
+                    if self._rotate_before_expiry is not None:
+                        self._connected_expiry = expiry
+                    await self._wait()
+                    if not self._loop_should_exit:
+                        self._state = SocketState.DISCONNECTED
                     _LOGGER.info("Socket loop exited, disconnecting")
                     await self._sio.disconnect()
                     _LOGGER.debug("Breaking loop to refresh token")
                     break
 
             # Refresh token
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, self._session._check_refresh)
+            await self._check_session_refresh()
 
     async def cancel(self) -> None:
         _LOGGER.debug("Disconnecting and cancelling tasks")
         self._loop_should_exit = True
+        self._state = SocketState.CLOSED
+        if self._rotation_task is not None:
+            self._rotation_task.cancel()
+        if self._pending_sio is not None:
+            await self._pending_sio.disconnect()
         await self._sio.disconnect()
-        self._ping_task.cancel()
+        if self._ping_task is not None:
+            self._ping_task.cancel()
 
     @property
     def namespace(self):
         return self._api_v2_ns
+
+    @property
+    def device_id(self) -> str:
+        return self._device_id
+
+    @property
+    def state(self) -> SocketState:
+        """Get the connection state."""
+        return self._state
+
+    @property
+    def rotations(self) -> int:
+        """Get the number of times the connection has been rotated."""
+        return self._rotations
@@ -0,0 +1,197 @@
+"""Management of many device sockets on one event loop."""
+
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Set, Union
+
+from .async_session import AsyncSession
+from .session import Session
+from .socket import SocketSession, SocketState
+from .update_manager import UpdateManager
+
+_DEFAULT_PING_INTERVAL = 20
+_DEFAULT_MAX_CONCURRENT_CONNECTS = 10
+_DEFAULT_WHEEL_SLOTS = 20
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class SocketFleet(object):
+    """Runs sockets for many devices on one event loop.
+
+    Rather than each SocketSession running its own ping task, pings are sent
+    from a single timer wheel: devices are spread across wheel_slots slots,
+    and every ping_interval / wheel_slots seconds the devices in the next slot
+    are pinged, so each device is pinged once per ping_interval and pings are
+    spread evenly over time. At most max_concurrent_connects connection
+    attempts run at once, to avoid a thundering herd on startup or after an
+    outage.
+
+    Must be created on the event loop it will run on. Further keyword
+    arguments are passed to each SocketSession.
+    """
+
+    def __init__(
+        self,
+        session: Union[Session, AsyncSession],
+        ping_interval: float = _DEFAULT_PING_INTERVAL,
+        max_concurrent_connects: int = _DEFAULT_MAX_CONCURRENT_CONNECTS,
+        wheel_slots: int = _DEFAULT_WHEEL_SLOTS,
+        **socket_kwargs: Any,
+    ) -> None:
+        """Create an empty fleet."""
+        if wheel_slots < 1:
+            raise ValueError("wheel_slots must be at least 1")
+        self._session = session
+        self._ping_interval = ping_interval
+        self._socket_kwargs = socket_kwargs
+        self._connect_semaphore = asyncio.Semaphore(max_concurrent_connects)
+        self._sockets: Dict[str, SocketSession] = {}
+        self._tasks: Dict[str, asyncio.Future] = {}
+        self._wheel: List[Set[str]] = [set() for _ in range(wheel_slots)]
+        self._wheel_slot: Dict[str, int] = {}
+        self._wheel_task: Optional[asyncio.Future] = None
+        self._running = False
+        self._pings = 0
+        self._ping_errors = 0
+
+    def _socket_session_kwargs(self) -> Dict[str, Any]:
+        return dict(
+            self._socket_kwargs,
+            send_pings=False,
+            connect_semaphore=self._connect_semaphore,
+        )
+
+    def _add(self, socket_session: SocketSession) -> None:
+        device_id = socket_session.device_id
+        if device_id in self._sockets:
+            raise ValueError(f"Device {device_id} is already in the fleet")
+        self._sockets[device_id] = socket_session
+        # Least loaded slot, to keep pings evenly spread
+        slot = min(range(len(self._wheel)), key=lambda i: len(self._wheel[i]))
+        self._wheel[slot].add(device_id)
+        self._wheel_slot[device_id] = slot
+        if self._running:
+            self._start(device_id)
+
+    def add_device(
+        self,
+        device_id: str,
+        dev_data_callback: Optional[Callable] = None,
+        node_update_callback: Optional[Callable] = None,
+    ) -> SocketSession:
+        """Add a device, returning its socket session. The socket is started
+        immediately if the fleet is running."""
+        socket_session = SocketSession(
+            self._session,
+            device_id,
+            dev_data_callback,
+            node_update_callback,
+            **self._socket_session_kwargs(),
+        )
+        self._add(socket_session)
+        return socket_session
+
+    def add_update_manager(self, device_id: str) -> UpdateManager:
+        """Add a device, returning an UpdateManager for its socket."""
+        update_manager = UpdateManager(
+            self._session, device_id, **self._socket_session_kwargs()
+        )
+        self._add(update_manager.socket_session)
+        return update_manager
+
+    async def remove_device(self, device_id: str) -> None:
+        """Disconnect and remove a device."""
+        socket_session = self._sockets.pop(device_id)
+        self._wheel[self._wheel_slot.pop(device_id)].discard(device_id)
+        task = self._tasks.pop(device_id, None)
+        await socket_session.cancel()
+        if task is not None:
+            task.cancel()
+
+    def _start(self, device_id: str) -> None:
+        self._tasks[device_id] = asyncio.ensure_future(
+            self._run_socket(self._sockets[device_id])
+        )
+
+    async def _run_socket(self, socket_session: SocketSession) -> None:
+        try:
+            await socket_session.run()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            _LOGGER.exception(f"Socket for {socket_session.device_id} failed")
+
+    async def _ping(self, socket_session: SocketSession) -> None:
+        try:
+            if await socket_session.send_ping():
+                self._pings += 1
+        except Exception as e:
+            self._ping_errors += 1
+            _LOGGER.debug(f"Ping to {socket_session.device_id} failed: {e}")
+
+    async def _run_wheel(self) -> None:
+        loop = asyncio.get_running_loop()
+        tick = self._ping_interval / len(self._wheel)
+        slot = 0
+        next_tick = loop.time()
+        while True:
+            next_tick += tick
+            await asyncio.sleep(max(next_tick - loop.time(), 0))
+            sockets = [self._sockets[device_id] for device_id in self._wheel[slot]]
+            slot = (slot + 1) % len(self._wheel)
+            if sockets:
+                await asyncio.gather(*[self._ping(s) for s in sockets])
+
+    async def run(self) -> None:
+        """Run the sockets for all devices, and the ping scheduler, until
+        cancelled."""
+        self._running = True
+        for device_id in self._sockets:
+            self._start(device_id)
+        self._wheel_task = asyncio.ensure_future(self._run_wheel())
+        try:
+            await self._wheel_task
+        except asyncio.CancelledError:
+            if self._running:
+                # Cancelled from outside rather than by cancel()
+                await self.cancel()
+                raise
+
+    async def cancel(self) -> None:
+        """Disconnect all devices and stop the ping scheduler."""
+        _LOGGER.debug("Cancelling socket fleet")
+        self._running = False
+        await asyncio.gather(*[s.cancel() for s in self._sockets.values()])
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        if self._wheel_task is not None:
+            self._wheel_task.cancel()
+
+    def __len__(self) -> int:
+        return len(self._sockets)
+
+    def __contains__(self, device_id: str) -> bool:
+        return device_id in self._sockets
+
+    def get_socket_session(self, device_id: str) -> SocketSession:
+        """Get the socket session for a device."""
+        return self._sockets[device_id]
+
+    def get_states(self) -> Dict[str, SocketState]:
+        """Get the connection state of each device."""
+        return {device_id: s.state for device_id, s in self._sockets.items()}
+
+    def stats(self) -> Dict[str, int]:
+        """Get the number of devices in each connection state, and pings
+        sent."""
+        stats = {state.value: 0 for state in SocketState}
+        for socket_session in self._sockets.values():
+            stats[socket_session.state.value] += 1
+        stats.update(
+            devices=len(self._sockets),
+            pings=self._pings,
+            ping_errors=self._ping_errors,
+        )
+        return stats
@@ -0,0 +1,231 @@
+"""Incremental parsing of large JSON array responses."""
+
+import codecs
+from enum import Enum
+import json
+import re
+from typing import Any, Iterable, Iterator, List, Optional
+
+# Large enough that elements rarely span chunks, small enough to keep memory
+# use flat
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
+# Characters which matter when finding the end of a value: inside a string,
+# and outside strings in an object or array
+_STRING_SPECIAL_RE = re.compile(r'["\\]')
+_STRUCTURE_RE = re.compile(r'["{}\[\]]')
+_SCALAR_END_RE = re.compile(r"[ \t\n\r,\]}]")
+_DECODER = json.JSONDecoder()
+_INCOMPLETE = object()
+
+
+class _State(Enum):
+    OBJECT_START = 0
+    KEY_OR_END = 1
+    KEY = 2
+    COLON = 3
+    VALUE = 4
+    AFTER_VALUE = 5
+    ARRAY_START = 6
+    ITEM_OR_END = 7
+    ITEM = 8
+    AFTER_ITEM = 9
+    DONE = 10
+
+
+class JSONArrayParser(object):
+    """Push parser for a JSON array, either the whole document or the value of
+    key in a top-level object (e.g. {"devs": [...]}).
+
+    Feed it the response body in chunks, and it returns each element of the
+    array as soon as it is complete, so only the current element needs to be
+    held in memory. Other values in the top-level object are parsed and
+    discarded; anything after the array is ignored. Raises KeyError if key
+    isn't in the object, and ValueError on invalid or incomplete JSON.
+    """
+
+    def __init__(self, key: Optional[str] = None) -> None:
+        """Create a parser for the array at key (or the top level)."""
+        self._key = key
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._final = False
+        self._state = _State.OBJECT_START if key is not None else _State.ARRAY_START
+        self._current_key: Optional[str] = None
+        # Progress scanning for the end of the value at self._pos, so that a
+        # value spanning many chunks is only scanned once
+        self._scan_pos: Optional[int] = None
+        self._depth = 0
+        self._in_string = False
+
+    @property
+    def done(self) -> bool:
+        """Whether the end of the array has been reached."""
+        return self._state == _State.DONE
+
+    def _append(self, text: str) -> None:
+        self._buffer = self._buffer[self._pos :] + text
+        if self._scan_pos is not None:
+            self._scan_pos -= self._pos
+        self._pos = 0
+
+    def feed(self, data: bytes) -> List[Any]:
+        """Parse a chunk of the body, returning any completed elements."""
+        self._append(self._text_decoder.decode(data))
+        return self._parse()
+
+    def close(self) -> List[Any]:
+        """Signal the end of the body, returning any remaining elements."""
+        self._final = True
+        self._append(self._text_decoder.decode(b"", final=True))
+        items = self._parse()
+        if not self.done:
+            raise ValueError("Incomplete JSON array")
+        return items
+
+    def _error(self, expected: str) -> ValueError:
+        return json.JSONDecodeError(f"Expected {expected}", self._buffer, self._pos)
+
+    def _next_char(self) -> Optional[str]:
+        match = _WHITESPACE_RE.match(self._buffer, self._pos)
+        assert match is not None
+        self._pos = match.end()
+        if self._pos == len(self._buffer):
+            return None
+        return self._buffer[self._pos]
+
+    def _scan(self) -> Optional[int]:
+        """Find the end of the value at self._pos, or None if it continues in
+        the next chunk, carrying on from where the last call stopped."""
+        buffer = self._buffer
+        if self._scan_pos is None:
+            self._scan_pos = self._pos
+            self._depth = 0
+            self._in_string = False
+        pos = self._scan_pos
+        if buffer[self._pos] not in '{["':
+            # A number or literal, which ends at a delimiter
+            match = _SCALAR_END_RE.search(buffer, pos)
+            if match is not None:
+                return match.start()
+            pos = len(buffer)
+        else:
+            while True:
+                if self._in_string:
+                    match = _STRING_SPECIAL_RE.search(buffer, pos)
+                    if match is None:
+                        pos = len(buffer)
+                        break
+                    if match.group() == "\\":
+                        if match.end() == len(buffer):
+                            # Rescan the escape once the next chunk arrives
+                            pos = match.start()
+                            break
+                        pos = match.end() + 1
+                        continue
+                    self._in_string = False
+                    pos = match.end()
+                    if self._depth == 0:
+                        return pos
+                else:
+                    match = _STRUCTURE_RE.search(buffer, pos)
+                    if match is None:
+                        pos = len(buffer)
+                        break
+                    char = match.group()
+                    pos = match.end()
+                    if char == '"':
+                        self._in_string = True
+                    elif char in "{[":
+                        self._depth += 1
+                    else:
+                        self._depth -= 1
+                        if self._depth == 0:
+                            return pos
+        self._scan_pos = pos
+        return len(buffer) if self._final else None
+
+    def _decode(self) -> Any:
+        if self._scan() is None:
+            return _INCOMPLETE
+        self._scan_pos = None
+        value, self._pos = _DECODER.raw_decode(self._buffer, self._pos)
+        return value
+
+    def _parse(self) -> List[Any]:
+        items = []
+        while self._state != _State.DONE:
+            char = self._next_char()
+            if char is None:
+                break
+            state = self._state
+            if state == _State.OBJECT_START:
+                if char != "{":
+                    raise self._error("'{'")
+                self._pos += 1
+                self._state = _State.KEY_OR_END
+            elif state == _State.KEY_OR_END and char == "}":
+                raise KeyError(self._key)
+            elif state in (_State.KEY_OR_END, _State.KEY):
+                if char != '"':
+                    raise self._error("key")
+                key = self._decode()
+                if key is _INCOMPLETE:
+                    break
+                self._current_key = key
+                self._state = _State.COLON
+            elif state == _State.COLON:
+                if char != ":":
+                    raise self._error("':'")
+                self._pos += 1
+                self._state = (
+                    _State.ARRAY_START
+                    if self._current_key == self._key
+                    else _State.VALUE
+                )
+            elif state == _State.VALUE:
+                if self._decode() is _INCOMPLETE:
+                    break
+                self._state = _State.AFTER_VALUE
+            elif state == _State.AFTER_VALUE:
+                if char == "}":
+                    raise KeyError(self._key)
+                if char != ",":
+                    raise self._error("',' or '}'")
+                self._pos += 1
+                self._state = _State.KEY
+            elif state == _State.ARRAY_START:
+                if char != "[":
+                    raise self._error("'['")
+                self._pos += 1
+                self._state = _State.ITEM_OR_END
+            elif state == _State.ITEM_OR_END and char == "]":
+                self._pos += 1
+                self._state = _State.DONE
+            elif state in (_State.ITEM_OR_END, _State.ITEM):
+                item = self._decode()
+                if item is _INCOMPLETE:
+                    break
+                items.append(item)
+                self._state = _State.AFTER_ITEM
+            elif state == _State.AFTER_ITEM:
+                if char not in ",]":
+                    raise self._error("',' or ']'")
+                self._pos += 1
+                self._state = _State.ITEM if char == "," else _State.DONE
+        return items
+
+
+def iter_json_array(
+    chunks: Iterable[bytes], key: Optional[str] = None
+) -> Iterator[Any]:
+    """Iterate over the elements of a JSON array (see JSONArrayParser) as
+    chunks of the document are read."""
+    parser = JSONArrayParser(key)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+        if parser.done:
+            return
+    yield from parser.close()
@@ -0,0 +1,193 @@
+"""Persistent token stores, allowing sessions to be resumed and tokens to be
+shared between processes."""
+
+import abc
+import contextlib
+import datetime
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from typing import ContextManager, Dict, Iterator, NamedTuple, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Not available on Windows, where we fall back to in-process locking only
+    fcntl = None  # type: ignore
+
+# Stores hold refresh tokens, so are only readable by their owner
+_FILE_MODE = 0o600
+
+
+class TokenData(NamedTuple):
+    """Access/refresh token pair with its expiry time."""
+
+    access_token: str
+    refresh_token: str
+    expires_at: datetime.datetime
+
+
+def _create_private_file(path: str) -> None:
+    """Create path (if it doesn't exist) readable only by its owner."""
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT, _FILE_MODE))
+
+
+class TokenStore(abc.ABC):
+    """Base class for token stores.
+
+    Tokens are stored per key (Session uses '<api_name>:<username>'). lock()
+    must exclude other threads and processes using the same store, and is held
+    by Session while it checks for and performs a token refresh.
+    """
+
+    @abc.abstractmethod
+    def lock(self) -> ContextManager[None]:
+        """Hold an exclusive lock on the store."""
+
+    @abc.abstractmethod
+    def load(self, key: str) -> Optional[TokenData]:
+        """Load the token for key, if any."""
+
+    @abc.abstractmethod
+    def save(self, key: str, token: TokenData) -> None:
+        """Save the token for key."""
+
+
+class FileTokenStore(TokenStore):
+    """Token store backed by a JSON file, locked with flock."""
+
+    def __init__(self, path: str) -> None:
+        """Create a token store using the JSON file at path."""
+        self._path = path
+        self._lock_path = f"{path}.lock"
+        self._thread_lock = threading.RLock()
+        self._locked = False
+
+    @contextlib.contextmanager
+    def lock(self) -> Iterator[None]:
+        with self._thread_lock:
+            if self._locked:
+                # Already locked by this thread
+                yield
+                return
+            _create_private_file(self._lock_path)
+            with open(self._lock_path, "a") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._locked = True
+                try:
+                    yield
+                finally:
+                    self._locked = False
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self) -> Dict[str, Dict[str, object]]:
+        try:
+            with open(self._path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def load(self, key: str) -> Optional[TokenData]:
+        entry = self._read().get(key)
+        if entry is None:
+            return None
+        return TokenData(
+            str(entry["access_token"]),
+            str(entry["refresh_token"]),
+            datetime.datetime.fromtimestamp(float(entry["expires_at"])),  # type: ignore
+        )
+
+    def save(self, key: str, token: TokenData) -> None:
+        with self._thread_lock:
+            entries = self._read()
+            entries[key] = {
+                "access_token": token.access_token,
+                "refresh_token": token.refresh_token,
+                "expires_at": token.expires_at.timestamp(),
+            }
+            # Write atomically so readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self._path))
+            )
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(entries, f)
+                os.chmod(tmp_path, _FILE_MODE)
+                os.replace(tmp_path, self._path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+
+class SqliteTokenStore(TokenStore):
+    """Token store backed by an SQLite database.
+
+    Locking uses an immediate (write) transaction, which SQLite serialises
+    across processes.
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0) -> None:
+        """Create a token store using the SQLite database at path."""
+        if path != ":memory:" and not path.startswith("file:"):
+            _create_private_file(path)
+        self._conn = sqlite3.connect(
+            path, timeout=timeout, isolation_level=None, check_same_thread=False
+        )
+        self._thread_lock = threading.RLock()
+        self._in_transaction = False
+        with self._thread_lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tokens ("
+                "key TEXT PRIMARY KEY, access_token TEXT NOT NULL, "
+                "refresh_token TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    @contextlib.contextmanager
+    def lock(self) -> Iterator[None]:
+        with self._thread_lock:
+            if self._in_transaction:
+                # Already locked by this thread
+                yield
+                return
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._in_transaction = True
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            else:
+                self._conn.execute("COMMIT")
+            finally:
+                self._in_transaction = False
+
+    def load(self, key: str) -> Optional[TokenData]:
+        with self._thread_lock:
+            row = self._conn.execute(
+                "SELECT access_token, refresh_token, expires_at FROM tokens "
+                "WHERE key = ?",
+                (key,),
+            ).fetchone()
+        if row is None:
+            return None
+        return TokenData(row[0], row[1], datetime.datetime.fromtimestamp(row[2]))
+
+    def save(self, key: str, token: TokenData) -> None:
+        with self._thread_lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tokens "
+                "(key, access_token, refresh_token, expires_at) VALUES (?, ?, ?, ?)",
+                (
+                    key,
+                    token.access_token,
+                    token.refresh_token,
+                    token.expires_at.timestamp(),
+                ),
+            )
+
+    def close(self) -> None:
+        self._conn.close()
@@ -1,16 +1,39 @@
 """Smartbox socket update manager."""
 
+import asyncio
+from collections import deque
+import concurrent.futures
+import copy
+import functools
+import inspect
 import jq
 import logging
 import re
-from typing import Any, Callable, Dict, Iterable, List
-
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from . import codec
+from .async_session import AsyncSession
 from .session import Session
 from .socket import SocketSession
 
 _LOGGER = logging.getLogger(__name__)
 
 _SIMPLE_JQ_RE = re.compile(r"^\.(\w+)$")
+_DEFAULT_MAX_CONCURRENT_CALLBACKS = 10
+_DEFAULT_MAX_PENDING_CALLBACKS = 1000
 
 
 class OptimisedJQMatcher(object):
@@ -46,36 +69,255 @@ class OptimisedJQMatcher(object):
             return str(self._compiled_jq)
 
 
-class DevDataSubscription(object):
-    """Subscription for dev data callbacks."""
+def _close(awaitable: Awaitable) -> None:
+    if inspect.iscoroutine(awaitable):
+        # Avoid a warning about it never being awaited
+        awaitable.close()
 
-    def __init__(self, jq_expr: str, callback: Callable[[Dict[str, Any]], None]):
-        """Create a dev data subscription for the given jq expression."""
-        self._jq_matcher = OptimisedJQMatcher(jq_expr)
+
+class _CallbackRunner(object):
+    """Runs awaitables returned by subscription callbacks as tasks on the
+    event loop, with at most max_concurrency running at once (if set), and
+    blocking callbacks in executor (if set).
+
+    Awaitables with the same order key run one at a time in the order they
+    were scheduled. If more than max_pending_per_key (if set) are waiting, the
+    oldest is dropped, so a slow callback can't build up an unbounded
+    backlog. Errors are logged rather than affecting other callbacks.
+
+    Awaitables may be scheduled from any thread once the runner knows its
+    event loop (from bind, or the first use on the loop).
+    """
+
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        executor: Optional[concurrent.futures.Executor] = None,
+        max_pending_per_key: Optional[int] = None,
+    ) -> None:
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        if max_pending_per_key is not None and max_pending_per_key < 1:
+            raise ValueError("max_pending_per_key must be at least 1")
+        self._max_concurrency = max_concurrency
+        self.executor = executor
+        self._max_pending_per_key = max_pending_per_key
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # Awaitables waiting to run, and the task running them, for each
+        # order key
+        self._queues: Dict[Any, Deque[Awaitable]] = {}
+        self._workers: Dict[Any, asyncio.Future] = {}
+        self._running = 0
+        self._completed = 0
+        self._errors = 0
+        self._dropped = 0
+
+    def bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Set the event loop to run awaitables on, if not already known."""
+        if self._loop is None:
+            self._loop = loop
+
+    def schedule(self, awaitable: Awaitable, order_key: Any) -> None:
+        try:
+            running_loop: Optional[asyncio.AbstractEventLoop] = (
+                asyncio.get_running_loop()
+            )
+        except RuntimeError:
+            running_loop = None
+        if running_loop is not None and self._loop in (None, running_loop):
+            self._loop = running_loop
+            self._enqueue(awaitable, order_key)
+        elif self._loop is not None:
+            # Called from another thread (e.g. an executor)
+            self._loop.call_soon_threadsafe(self._enqueue, awaitable, order_key)
+        else:
+            _close(awaitable)
+            raise RuntimeError("No event loop to run callbacks on")
+
+    def _enqueue(self, awaitable: Awaitable, order_key: Any) -> None:
+        queue = self._queues.setdefault(order_key, deque())
+        queue.append(awaitable)
+        if (
+            self._max_pending_per_key is not None
+            and len(queue) > self._max_pending_per_key
+        ):
+            _close(queue.popleft())
+            self._dropped += 1
+            _LOGGER.warning(
+                f"Dropped subscription callback, {len(queue)} already pending"
+                f" for {order_key}"
+            )
+        if order_key not in self._workers:
+            self._workers[order_key] = asyncio.ensure_future(self._work(order_key))
+
+    def call_in_executor(
+        self, callback: Callable[..., Any], args: tuple, kwargs: Dict[str, Any]
+    ) -> Awaitable:
+        """Get an awaitable calling callback in the executor (and awaiting the
+        result, for sync wrappers of coroutine functions)."""
+
+        async def run() -> None:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                self.executor, functools.partial(callback, *args, **kwargs)
+            )
+            if inspect.isawaitable(result):
+                await result
+
+        return run()
+
+    async def _work(self, order_key: Any) -> None:
+        queue = self._queues[order_key]
+        try:
+            while queue:
+                await self._run(queue.popleft())
+        finally:
+            del self._queues[order_key]
+            del self._workers[order_key]
+            for awaitable in queue:
+                _close(awaitable)
+
+    async def _run(self, awaitable: Awaitable) -> None:
+        self._running += 1
+        try:
+            if self._max_concurrency is not None and self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self._max_concurrency)
+            if self._semaphore is not None:
+                async with self._semaphore:
+                    await awaitable
+            else:
+                await awaitable
+        except asyncio.CancelledError:
+            # Cancelled before awaiting it
+            _close(awaitable)
+            raise
+        except Exception:
+            self._errors += 1
+            _LOGGER.exception("Error in subscription callback")
+        finally:
+            self._running -= 1
+        self._completed += 1
+
+    async def join(self) -> None:
+        while self._workers:
+            await asyncio.wait(list(self._workers.values()))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "callbacks_pending": self._running
+            + sum(len(queue) for queue in self._queues.values()),
+            "callbacks_completed": self._completed,
+            "callback_errors": self._errors,
+            "callbacks_dropped": self._dropped,
+        }
+
+
+class _Subscription(object):
+    def __init__(
+        self,
+        callback: Callable[..., Any],
+        runner: Optional[_CallbackRunner],
+        order_key: Any,
+        use_executor: bool,
+    ) -> None:
         self._callback = callback
+        self._runner = runner
+        self._order_key = order_key if order_key is not None else callback
+        self._use_executor = use_executor
+
+    def _call(self, *args: Any, **kwargs: Any) -> None:
+        if (
+            self._use_executor
+            and self._runner is not None
+            and self._runner.executor is not None
+            and not asyncio.iscoroutinefunction(self._callback)
+        ):
+            self._runner.schedule(
+                self._runner.call_in_executor(self._callback, args, kwargs),
+                self._order_key,
+            )
+            return
+        result = self._callback(*args, **kwargs)
+        if inspect.isawaitable(result):
+            if self._runner is None:
+                self._runner = _CallbackRunner()
+            self._runner.schedule(result, self._order_key)
+
+
+class DevDataSubscription(_Subscription):
+    """Subscription for dev data callbacks.
+
+    Callbacks may be coroutine functions, in which case they are run as tasks
+    (see UpdateManager), in order for each order_key (by default the
+    callback). Other callbacks are run the same way in the runner's executor
+    if it has one, unless use_executor is False.
+    """
 
-    def match(self, input_data: Dict[str, Any]) -> None:
-        """Return matches for this subscription for the given dev data."""
+    def __init__(
+        self,
+        jq_expr: str,
+        callback: Callable[[Dict[str, Any]], Any],
+        runner: Optional[_CallbackRunner] = None,
+        order_key: Any = None,
+        use_executor: bool = True,
+    ):
+        """Create a dev data subscription for the given jq expression."""
+        super().__init__(callback, runner, order_key, use_executor)
+        self._jq_matcher = OptimisedJQMatcher(jq_expr)
+        self._primed = False
+
+    def match(
+        self,
+        input_data: Dict[str, Any],
+        previous_data: Optional[Dict[str, Any]] = None,
+    ) -> int:
+        """Call the callback with matches for this subscription for the given
+        dev data, returning the number of calls.
+
+        If previous_data is given, matches which are unchanged from it are
+        skipped (unless this subscription hasn't seen dev data before).
+        """
         _LOGGER.debug("Matching jq %s", self._jq_matcher)
+        calls = 0
         try:
+            previous: Set[str] = set()
+            if previous_data is not None and self._primed:
+                previous = {
+                    codec.dumps(match, sort_keys=True)
+                    for match in self._jq_matcher.match(previous_data)
+                }
+            self._primed = True
             for match in self._jq_matcher.match(input_data):
-                if match is not None:
-                    self._callback(match)
+                if match is None:
+                    continue
+                if previous and codec.dumps(match, sort_keys=True) in previous:
+                    continue
+                self._call(match)
+                calls += 1
         except ValueError:
             _LOGGER.exception("Error evaluating jq on dev data %s", input_data)
+        return calls
 
 
-class UpdateSubscription(object):
-    """Subscription for updates."""
+class UpdateSubscription(_Subscription):
+    """Subscription for updates (callbacks are handled as for
+    DevDataSubscription)."""
 
     def __init__(
-        self, path_regex: str, jq_expr: str, callback: Callable[[Dict[str, Any]], None]
+        self,
+        path_regex: str,
+        jq_expr: str,
+        callback: Callable[..., Any],
+        runner: Optional[_CallbackRunner] = None,
+        order_key: Any = None,
+        use_executor: bool = True,
     ):
         """Create an update subscription for the given path regex and body jq
         expression."""
+        super().__init__(callback, runner, order_key, use_executor)
         self._path_regex = re.compile(path_regex)
         self._jq_matcher = OptimisedJQMatcher(jq_expr)
-        self._callback = callback
 
     def match(self, input_data: Dict[str, Any]) -> bool:
         """Return matches for this subscription for the given update."""
@@ -89,22 +331,104 @@ class UpdateSubscription(object):
             for data_match in self._jq_matcher.match(input_data):
                 if data_match is not None:
                     matched = True
-                    self._callback(data_match, **path_match_kwargs)
+                    self._call(data_match, **path_match_kwargs)
         except ValueError:
             _LOGGER.exception("Error evaluating jq on update %s", input_data)
         return matched
 
 
+class ResyncStats(NamedTuple):
+    """How many items (nodes and other top-level dev data entries) changed in
+    a resync, of the total."""
+
+    changed: int
+    total: int
+
+
+# Update paths for values kept elsewhere in dev data
+_UPDATE_PATH_ALIASES = {
+    "/mgr/away_status": ["away_status"],
+    "/htr_system/power_limit": ["htr_system", "setup"],
+}
+
+
+def _node_key(node: Dict[str, Any]) -> Tuple[str, str]:
+    return (node.get("type", ""), str(node.get("addr")))
+
+
+def _get_resync_stats(previous: Dict[str, Any], current: Dict[str, Any]) -> ResyncStats:
+    previous_nodes = {_node_key(n): n for n in previous.get("nodes", [])}
+    changed = total = 0
+    for node in current.get("nodes", []):
+        total += 1
+        if previous_nodes.get(_node_key(node)) != node:
+            changed += 1
+    for key, value in current.items():
+        if key == "nodes":
+            continue
+        total += 1
+        if previous.get(key) != value:
+            changed += 1
+    return ResyncStats(changed, total)
+
+
 class UpdateManager(object):
-    """Manages subscription callbacks to receive updates from a Smartbox socket."""
+    """Manages subscription callbacks to receive updates from a Smartbox socket.
+
+    The socket sends dev data on every (re)connection. Unless resync_diffing is
+    disabled, the last known state (dev data with later updates applied) is
+    kept, and on reconnection dev data subscriptions are only called for
+    matches which have changed.
+
+    Callbacks may be coroutine functions. These are run as tasks, at most
+    max_concurrent_callbacks at once (if set), so they don't hold up the
+    socket. Calls to the same callback run one at a time in the order the
+    data was received, with at most max_pending_callbacks_per_key waiting (if
+    set; beyond that the oldest are dropped), and errors are logged without
+    affecting other callbacks.
 
-    def __init__(self, session: Session, device_id: str, **kwargs):
+    If a dispatch_queue with an executor is given, other callbacks are run the
+    same way in the executor, so they can block. Dev data and updates are
+    still applied to the state on the event loop.
+    """
+
+    def __init__(
+        self,
+        session: Union[Session, AsyncSession],
+        device_id: str,
+        resync_diffing: bool = True,
+        max_concurrent_callbacks: Optional[int] = _DEFAULT_MAX_CONCURRENT_CALLBACKS,
+        max_pending_callbacks_per_key: Optional[int] = _DEFAULT_MAX_PENDING_CALLBACKS,
+        **kwargs,
+    ):
         """Create an UpdateManager for a smartbox socket."""
+        dispatch_queue = kwargs.get("dispatch_queue")
+        self._callback_runner = _CallbackRunner(
+            max_concurrent_callbacks,
+            dispatch_queue.executor if dispatch_queue is not None else None,
+            max_pending_callbacks_per_key,
+        )
         self._socket_session = SocketSession(
             session, device_id, self._dev_data_cb, self._update_cb, **kwargs
         )
         self._dev_data_subscriptions: List[DevDataSubscription] = []
         self._update_subscriptions: List[UpdateSubscription] = []
+        self._resync_diffing = resync_diffing
+        self._state: Optional[Dict[str, Any]] = None
+        self._state_nodes: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._last_resync: Optional[ResyncStats] = None
+        self._resyncs = 0
+        self._resync_changed = 0
+        self._resync_total = 0
+
+        if isinstance(session, Session) and session.setup_cache_enabled:
+            # Keep the session's setup cache fresh so set_setup doesn't need
+            # to fetch the current setup
+            self.subscribe_to_node_setup(
+                lambda node_type, addr, setup: session.update_setup_cache(
+                    device_id, node_type, addr, setup
+                )
+            )
 
     @property
     def socket_session(self) -> SocketSession:
@@ -113,84 +437,173 @@ class UpdateManager(object):
 
     async def run(self) -> None:
         """Run the socket session asynchronously, waiting for updates."""
+        # So callbacks can be scheduled from other threads
+        self._callback_runner.bind(asyncio.get_running_loop())
         await self._socket_session.run()
 
-    def subscribe_to_dev_data(self, jq_expr: str, callback: Callable) -> None:
-        """Subscribe to receive device data."""
-        sub = DevDataSubscription(jq_expr, callback)
+    async def wait_for_callbacks(self) -> None:
+        """Wait for any running coroutine callbacks to finish."""
+        await self._callback_runner.join()
+
+    def subscribe_to_dev_data(
+        self,
+        jq_expr: str,
+        callback: Callable,
+        order_key: Any = None,
+        use_executor: bool = True,
+    ) -> None:
+        """Subscribe to receive device data.
+
+        Coroutine callbacks (and callbacks run in the executor) with the same
+        order_key (by default the callback) run in order. Pass use_executor
+        False for quick callbacks which must run on the event loop.
+        """
+        sub = DevDataSubscription(
+            jq_expr, callback, self._callback_runner, order_key, use_executor
+        )
         self._dev_data_subscriptions.append(sub)
 
     def subscribe_to_updates(
-        self, path_regex: str, jq_expr: str, callback: Callable[..., None]
+        self,
+        path_regex: str,
+        jq_expr: str,
+        callback: Callable[..., Any],
+        order_key: Any = None,
+        use_executor: bool = True,
     ) -> None:
         """Subscribe to receive device and node data updates.
 
         Named groups in path_regex are passed as kwargs to callback.
+        Callbacks are ordered and run as for subscribe_to_dev_data.
         """
-        sub = UpdateSubscription(path_regex, jq_expr, callback)
+        sub = UpdateSubscription(
+            path_regex,
+            jq_expr,
+            callback,
+            self._callback_runner,
+            order_key,
+            use_executor,
+        )
         self._update_subscriptions.append(sub)
 
     def subscribe_to_device_away_status(
-        self, callback: Callable[[Dict[str, Any]], None]
+        self, callback: Callable[[Dict[str, Any]], Any]
     ) -> None:
         """Subscribe to device away status updates."""
         self.subscribe_to_dev_data(".away_status", callback)
         self.subscribe_to_updates(r"^/mgr/away_status", ".body", callback)
 
-    def subscribe_to_device_power_limit(self, callback: Callable[[int], None]) -> None:
+    def subscribe_to_device_power_limit(self, callback: Callable[[int], Any]) -> None:
         """Subscribe to device power limit updates."""
         self.subscribe_to_dev_data(
-            ".htr_system.setup.power_limit", lambda p: callback(int(p))
+            ".htr_system.setup.power_limit",
+            lambda p: callback(int(p)),
+            order_key=callback,
         )
         self.subscribe_to_updates(
             r"^/htr_system/(setup|power_limit)",
             ".body.power_limit",
             lambda p: callback(int(p)),
+            order_key=callback,
         )
 
     def subscribe_to_node_status(
-        self, callback: Callable[[str, int, Dict[str, Any]], None]
+        self, callback: Callable[[str, int, Dict[str, Any]], Any]
     ) -> None:
         """Subscribe to node status updates."""
 
-        def dev_data_wrapper(data: Dict[str, Any]) -> None:
-            callback(data["type"], int(data["addr"]), data["status"]),
+        def dev_data_wrapper(data: Dict[str, Any]) -> Any:
+            return callback(data["type"], int(data["addr"]), data["status"])
 
         self.subscribe_to_dev_data(
-            "(.nodes[] | {addr, type, status})?", dev_data_wrapper
+            "(.nodes[] | {addr, type, status})?", dev_data_wrapper, callback
         )
 
-        def update_wrapper(data: Dict[str, Any], node_type: str, addr: str) -> None:
-            callback(node_type, int(addr), data),
+        def update_wrapper(data: Dict[str, Any], node_type: str, addr: str) -> Any:
+            return callback(node_type, int(addr), data)
 
         self.subscribe_to_updates(
-            r"^/(?P<node_type>[^/]+)/(?P<addr>\d+)/status", ".body", update_wrapper
+            r"^/(?P<node_type>[^/]+)/(?P<addr>\d+)/status",
+            ".body",
+            update_wrapper,
+            callback,
         )
 
     def subscribe_to_node_setup(
-        self, callback: Callable[[str, int, Dict[str, Any]], None]
+        self, callback: Callable[[str, int, Dict[str, Any]], Any]
     ) -> None:
         """Subscribe to node setup updates."""
 
-        def dev_data_wrapper(data: Dict[str, Any]) -> None:
-            callback(data["type"], int(data["addr"]), data["setup"]),
+        def dev_data_wrapper(data: Dict[str, Any]) -> Any:
+            return callback(data["type"], int(data["addr"]), data["setup"])
 
         self.subscribe_to_dev_data(
-            "(.nodes[] | {addr, type, setup})?", dev_data_wrapper
+            "(.nodes[] | {addr, type, setup})?", dev_data_wrapper, callback
         )
 
-        def update_wrapper(data: Dict[str, Any], node_type: str, addr: str) -> None:
-            callback(node_type, int(addr), data),
+        def update_wrapper(data: Dict[str, Any], node_type: str, addr: str) -> Any:
+            return callback(node_type, int(addr), data)
 
         self.subscribe_to_updates(
-            r"^/(?P<node_type>[^/]+)/(?P<addr>\d+)/setup", ".body", update_wrapper
+            r"^/(?P<node_type>[^/]+)/(?P<addr>\d+)/setup",
+            ".body",
+            update_wrapper,
+            callback,
         )
 
-    def _dev_data_cb(self, data: Dict[str, Any]) -> None:
+    def _set_state(self, data: Dict[str, Any]) -> None:
+        # Copied, as subscribers may hold on to parts of the dev data
+        self._state = copy.deepcopy(data)
+        self._state_nodes = {
+            _node_key(node): node for node in self._state.get("nodes", [])
+        }
+
+    def _apply_update(self, path: str, body: Any) -> None:
+        assert self._state is not None
+        keys = _UPDATE_PATH_ALIASES.get(path) or [key for key in path.split("/") if key]
+        if not keys:
+            return
+        target = self._state
+        if len(keys) >= 3 and keys[1].isdigit():
+            # Node path, e.g. /htr/1/status
+            node = self._state_nodes.get((keys[0], keys[1]))
+            if node is None:
+                return
+            target = node
+            keys = keys[2:]
+        for key in keys[:-1]:
+            child = target.get(key)
+            if not isinstance(child, dict):
+                child = target[key] = {}
+            target = child
+        current = target.get(keys[-1])
+        if isinstance(current, dict) and isinstance(body, dict):
+            # Updates may only include changed fields
+            target[keys[-1]] = {**current, **body}
+        else:
+            target[keys[-1]] = copy.deepcopy(body)
+
+    async def _dev_data_cb(self, data: Dict[str, Any]) -> None:
+        # A coroutine function (as is _update_cb), so that a DispatchQueue
+        # runs it on the event loop rather than in its executor
+        previous = self._state
+        if previous is not None:
+            self._last_resync = _get_resync_stats(previous, data)
+            self._resyncs += 1
+            self._resync_changed += self._last_resync.changed
+            self._resync_total += self._last_resync.total
+            _LOGGER.info(
+                f"Resync changed {self._last_resync.changed}"
+                f" of {self._last_resync.total} items"
+            )
         for sub in self._dev_data_subscriptions:
-            sub.match(data)
+            sub.match(data, previous)
+        if self._resync_diffing:
+            self._set_state(data)
 
-    def _update_cb(self, data: Dict[str, Any]) -> None:
+    async def _update_cb(self, data: Dict[str, Any]) -> None:
+        if self._state is not None and "path" in data:
+            self._apply_update(data["path"], data.get("body"))
         matched = False
         for sub in self._update_subscriptions:
             if "path" not in data:
@@ -200,3 +613,20 @@ class UpdateManager(object):
                 matched = True
         if not matched:
             _LOGGER.debug("No matches for update %s", data)
+
+    @property
+    def last_resync(self) -> Optional[ResyncStats]:
+        """Get how much changed in the last resync (None until the first
+        reconnection)."""
+        return self._last_resync
+
+    def stats(self) -> Dict[str, int]:
+        """Get the number of resyncs, the total items changed and compared,
+        and the number of coroutine callbacks pending, completed and
+        failed."""
+        return {
+            "resyncs": self._resyncs,
+            "resync_changed": self._resync_changed,
+            "resync_total": self._resync_total,
+            **self._callback_runner.stats(),
+        }
@@ -0,0 +1,215 @@
+"""Coalescing of bursts of writes to the same node or device."""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from .session import Session
+
+_DEFAULT_WINDOW = 0.2
+_DEFAULT_MAX_CONCURRENT_SENDS = 4
+
+_LOGGER = logging.getLogger(__name__)
+
+WriteKey = Tuple[str, ...]
+
+
+class _PendingWrite(object):
+    def __init__(self, send: Callable[[Dict[str, Any]], Any], now: float) -> None:
+        self.send = send
+        self.data: Dict[str, Any] = {}
+        self.futures: List[Future] = []
+        self.first_write = now
+        self.due = now
+
+
+class WriteBuffer(object):
+    """Buffers set_status and set_device_away_status calls, merging changes
+    to the same node (or device) into a single POST.
+
+    A write is sent once window seconds have passed without another write to
+    the same node, or max_delay seconds after the first buffered write if
+    writes keep arriving. Later values for a field replace earlier ones. Each
+    call returns a concurrent.futures.Future which resolves to the response of
+    the merged POST (or its exception). Cancelling a future doesn't withdraw
+    its changes.
+
+    Sends are scheduled by a single background thread and run on a pool of
+    max_concurrent_sends threads. Only one POST per node (or device) is in
+    flight at a time, so writes land in order; writes buffered meanwhile are
+    sent once it completes.
+    """
+
+    def __init__(
+        self,
+        session: Session,
+        window: float = _DEFAULT_WINDOW,
+        max_delay: Optional[float] = None,
+        max_concurrent_sends: int = _DEFAULT_MAX_CONCURRENT_SENDS,
+    ) -> None:
+        """Create a write buffer sending via session."""
+        self._session = session
+        self._window = window
+        self._max_delay = max_delay if max_delay is not None else window * 5
+        self._max_concurrent_sends = max_concurrent_sends
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._pending: Dict[WriteKey, _PendingWrite] = {}
+        # Keys with a POST in progress
+        self._in_flight: Set[WriteKey] = set()
+        # Send schedule, a heap of (due time, sequence, key). Entries whose due
+        # time no longer matches the pending write are stale and skipped.
+        self._schedule: List[Tuple[float, int, WriteKey]] = []
+        self._seq = itertools.count()
+        self._scheduler: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._closed = False
+        self._writes = 0
+        self._posts = 0
+
+    def _push(self, key: WriteKey, due: float) -> None:
+        heapq.heappush(self._schedule, (due, next(self._seq), key))
+        self._cond.notify_all()
+
+    def _buffer(
+        self,
+        key: WriteKey,
+        send: Callable[[Dict[str, Any]], Any],
+        data: Dict[str, Any],
+    ) -> Future:
+        future: Future = Future()
+        now = time.monotonic()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("WriteBuffer is closed")
+            if self._scheduler is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._max_concurrent_sends,
+                    thread_name_prefix="smartbox-write",
+                )
+                self._scheduler = threading.Thread(
+                    target=self._run_scheduler,
+                    name="smartbox-write-scheduler",
+                    daemon=True,
+                )
+                self._scheduler.start()
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = _PendingWrite(send, now)
+                self._pending[key] = pending
+            pending.data.update({k: v for k, v in data.items() if v is not None})
+            pending.futures.append(future)
+            self._writes += 1
+            pending.due = min(now + self._window, pending.first_write + self._max_delay)
+            self._push(key, pending.due)
+        return future
+
+    def _run_scheduler(self) -> None:
+        with self._cond:
+            while not self._closed:
+                now = time.monotonic()
+                while self._schedule and self._schedule[0][0] <= now:
+                    due, _, key = heapq.heappop(self._schedule)
+                    pending = self._pending.get(key)
+                    if pending is None or pending.due != due:
+                        continue
+                    if key in self._in_flight:
+                        # Rescheduled when the POST in flight completes
+                        continue
+                    del self._pending[key]
+                    self._in_flight.add(key)
+                    self._posts += 1
+                    assert self._executor is not None
+                    self._executor.submit(self._send_in_flight, key, pending)
+                wait = self._schedule[0][0] - now if self._schedule else None
+                self._cond.wait(wait)
+
+    def _send_in_flight(self, key: WriteKey, pending: _PendingWrite) -> None:
+        try:
+            self._send(key, pending)
+        finally:
+            with self._lock:
+                self._in_flight.discard(key)
+                waiting = self._pending.get(key)
+                if waiting is not None:
+                    self._push(key, waiting.due)
+                self._cond.notify_all()
+
+    def _send(self, key: WriteKey, pending: _PendingWrite) -> None:
+        futures = [f for f in pending.futures if f.set_running_or_notify_cancel()]
+        _LOGGER.debug(
+            f"Sending {len(pending.futures)} coalesced writes to {key}: {pending.data}"
+        )
+        try:
+            result = pending.send(pending.data)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+        else:
+            for future in futures:
+                future.set_result(result)
+
+    def set_status(
+        self, device_id: str, node: Dict[str, Any], status_args: Dict[str, Any]
+    ) -> Future:
+        """Buffer a Session.set_status call."""
+        return self._buffer(
+            ("status", device_id, node["type"], str(node["addr"])),
+            lambda data: self._session.set_status(device_id, node, data),
+            status_args,
+        )
+
+    def set_device_away_status(
+        self, device_id: str, status_args: Dict[str, Any]
+    ) -> Future:
+        """Buffer a Session.set_device_away_status call."""
+        return self._buffer(
+            ("away_status", device_id),
+            lambda data: self._session.set_device_away_status(device_id, data),
+            status_args,
+        )
+
+    def flush(self) -> None:
+        """Send all buffered writes now, waiting for them to complete."""
+        while True:
+            with self._cond:
+                # Wait for POSTs in flight, so writes to a node stay in order
+                self._cond.wait_for(lambda: not self._in_flight)
+                if not self._pending:
+                    return
+                pending_writes = list(self._pending.items())
+                self._pending.clear()
+                self._in_flight.update(key for key, _ in pending_writes)
+                self._posts += len(pending_writes)
+            for key, pending in pending_writes:
+                self._send_in_flight(key, pending)
+
+    def close(self) -> None:
+        """Flush buffered writes and stop accepting new ones."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.flush()
+        if self._scheduler is not None:
+            self._scheduler.join()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    @property
+    def pending(self) -> int:
+        """Get the number of nodes/devices with buffered writes."""
+        with self._lock:
+            return len(self._pending)
+
+    def stats(self) -> Dict[str, int]:
+        """Get the number of writes buffered and POSTs sent."""
+        with self._lock:
+            return {
+                "writes": self._writes,
+                "posts": self._posts,
+                "pending": len(self._pending),
+            }
@@ -0,0 +1,128 @@
+import asyncio
+import pytest
+from typing import Any, Dict
+
+from smartbox.ack import AckTracker, _values_match
+from smartbox.session import Session
+from smartbox.update_manager import UpdateManager
+
+from const import MOCK_DEV_ID
+
+_NODE = {"addr": 1, "type": "htr"}
+
+
+async def _socket_update(update_manager: UpdateManager, data: Dict[str, Any]) -> None:
+    await update_manager.socket_session.namespace.on_update(data)
+
+
+@pytest.fixture
+async def update_manager(mock_session):
+    update_manager = UpdateManager(mock_session, MOCK_DEV_ID)
+    await update_manager.socket_session.namespace.on_dev_data({"nodes": []})
+    return update_manager
+
+
+def test_values_match():
+    assert _values_match("21.0", "21.0")
+    assert _values_match("21", 21.0)
+    assert _values_match(True, 1)
+    assert _values_match("auto", "AUTO")
+    assert not _values_match("21.0", "21.5")
+    assert not _values_match("auto", "manual")
+
+
+async def test_ack(mocker, update_manager):
+    session = mocker.MagicMock()
+    session.set_status = mocker.AsyncMock(return_value={})
+    tracker = AckTracker(update_manager)
+    task = asyncio.create_task(
+        tracker.set_status(
+            session, _NODE, {"stemp": "21.0", "units": "C", "mode": None}
+        )
+    )
+    await asyncio.sleep(0.01)
+    session.set_status.assert_awaited_with(
+        MOCK_DEV_ID, _NODE, {"stemp": "21.0", "units": "C", "mode": None}
+    )
+    assert tracker.stats()["pending"] == 1
+
+    # Not the value we wrote, or a different path
+    await _socket_update(
+        update_manager,
+        {"path": "/htr/1/status", "body": {"stemp": "20.0", "units": "C"}},
+    )
+    await _socket_update(
+        update_manager,
+        {"path": "/htr/2/status", "body": {"stemp": "21.0", "units": "C"}},
+    )
+    await asyncio.sleep(0)
+    assert not task.done()
+
+    body = {"stemp": "21", "units": "C", "mode": "manual"}
+    await _socket_update(update_manager, {"path": "/htr/1/status", "body": body})
+    result = await asyncio.wait_for(task, 1)
+    assert result.body == body
+    assert result.latency >= 0.01
+
+    assert tracker.stats() == {"acked": 1, "timeouts": 0, "pending": 0}
+    assert tracker.get_latency("status").count == 1
+    assert tracker.get_latency("setup") is None
+    exported = tracker.export_prometheus()
+    assert 'smartbox_ack_latency_seconds_count{endpoint="status"} 1' in exported
+    assert "smartbox_ack_timeouts_total 0" in exported
+
+
+async def test_ack_blocking_session(mocker, update_manager):
+    session = mocker.MagicMock(spec=Session)
+    session.set_device_away_status.return_value = {}
+    tracker = AckTracker(update_manager)
+
+    async def ack() -> None:
+        while (
+            not tracker.stats()["pending"] or not session.set_device_away_status.called
+        ):
+            await asyncio.sleep(0.01)
+        await _socket_update(
+            update_manager,
+            {"path": "/mgr/away_status", "body": {"away": True, "enabled": True}},
+        )
+
+    ack_task = asyncio.create_task(ack())
+    result = await asyncio.wait_for(
+        tracker.set_device_away_status(session, {"away": True}), 5
+    )
+    await ack_task
+    assert result.body == {"away": True, "enabled": True}
+    assert tracker.get_latency("away_status").count == 1
+
+
+async def test_ack_timeout(mocker, update_manager):
+    session = mocker.MagicMock()
+    session.set_setup = mocker.AsyncMock(return_value={})
+    tracker = AckTracker(update_manager, timeout=0.05)
+    with pytest.raises(asyncio.TimeoutError):
+        await tracker.set_setup(session, _NODE, {"units": "F"})
+    await asyncio.sleep(0)
+    assert tracker.stats() == {"acked": 0, "timeouts": 1, "pending": 0}
+
+    # A late update is ignored
+    await _socket_update(
+        update_manager, {"path": "/htr/1/setup", "body": {"units": "F"}}
+    )
+    assert tracker.stats()["acked"] == 0
+
+    future = tracker.expect("/htr/1/setup", {"units": "C"}, timeout=1)
+    await _socket_update(
+        update_manager, {"path": "/htr/1/setup", "body": {"units": "C"}}
+    )
+    assert (await future).body == {"units": "C"}
+
+
+async def test_ack_write_failure(mocker, update_manager):
+    session = mocker.MagicMock()
+    session.set_status = mocker.AsyncMock(side_effect=ValueError("bad"))
+    tracker = AckTracker(update_manager)
+    with pytest.raises(ValueError):
+        await tracker.set_status(session, _NODE, {"stemp": "21.0"})
+    await asyncio.sleep(0)
+    assert tracker.stats() == {"acked": 0, "timeouts": 0, "pending": 0}
@@ -0,0 +1,193 @@
+from aiohttp import web
+import asyncio
+import json
+import pytest
+
+import smartbox
+
+_MOCK_API_NAME = "myapi"
+_MOCK_BASIC_AUTH_CREDS = "sldjfls93r2lkj"
+_MOCK_USERNAME = "xxxxx"
+_MOCK_PASSWORD = "yyyyy"
+_MOCK_TOKEN_TYPE = "bearer"
+_MOCK_ACCESS_TOKEN = "sj32oj2lkwjf"
+_MOCK_REFRESH_TOKEN = "23ij2oij324j3423"
+_MOCK_EXPIRES_IN = 14400
+_MOCK_DEV_ID = "2o3jo2jkj"
+_MOCK_DEV_NAME = "My device"
+
+
+class MockAPIServer(object):
+    def __init__(self, port):
+        self._port = port
+        self.token_requests = []
+        self.posts = []
+        self.fail_count = 0
+        self.setup = {"away_mode": 0, "units": "C"}
+        self._app = web.Application()
+        self._app.router.add_post("/client/token", self._token)
+        self._app.router.add_get("/api/v2/devs", self._devs)
+        self._app.router.add_get("/api/v2/grouped_devs", self._grouped_devs)
+        self._app.router.add_get("/api/v2/devs/{dev_id}/mgr/nodes", self._nodes)
+        self._app.router.add_get(
+            "/api/v2/devs/{dev_id}/{type}/{addr}/status", self._status
+        )
+        self._app.router.add_post(
+            "/api/v2/devs/{dev_id}/{type}/{addr}/{endpoint}", self._post
+        )
+        self._app.router.add_get(
+            "/api/v2/devs/{dev_id}/{type}/{addr}/setup", self._get_setup
+        )
+
+    async def _token(self, request):
+        self.token_requests.append(await request.text())
+        return web.json_response(
+            {
+                "token_type": _MOCK_TOKEN_TYPE,
+                "access_token": _MOCK_ACCESS_TOKEN,
+                "expires_in": _MOCK_EXPIRES_IN,
+                "refresh_token": _MOCK_REFRESH_TOKEN,
+            }
+        )
+
+    async def _devs(self, request):
+        assert request.headers["Authorization"] == f"Bearer {_MOCK_ACCESS_TOKEN}"
+        if self.fail_count > 0:
+            self.fail_count -= 1
+            return web.Response(status=503)
+        return web.json_response(
+            {"devs": [{"dev_id": _MOCK_DEV_ID, "name": _MOCK_DEV_NAME}]}
+        )
+
+    async def _grouped_devs(self, request):
+        # Stream the response in small chunks
+        response = web.StreamResponse()
+        await response.prepare(request)
+        body = json.dumps(
+            [
+                {"id": i, "name": f"Group {i}", "devs": [{"dev_id": f"dev{i}"}]}
+                for i in range(50)
+            ]
+        ).encode()
+        for i in range(0, len(body), 100):
+            await response.write(body[i : i + 100])
+        await response.write_eof()
+        return response
+
+    async def _nodes(self, request):
+        # simulate some latency so concurrent requests overlap
+        await asyncio.sleep(0.01)
+        return web.json_response(
+            {"nodes": [{"addr": 1, "name": "My heater", "type": "htr"}]}
+        )
+
+    async def _status(self, request):
+        if request.match_info["type"] == "pmo":
+            return web.Response(status=404)
+        return web.json_response({"mode": "auto", "stemp": "16.0"})
+
+    async def _get_setup(self, request):
+        return web.json_response(self.setup)
+
+    async def _post(self, request):
+        data = await request.json()
+        self.posts.append((request.match_info["endpoint"], data))
+        return web.json_response(data)
+
+    async def start(self):
+        self._runner = web.AppRunner(self._app)
+        await self._runner.setup()
+        self._site = web.TCPSite(self._runner, "localhost", self._port)
+        await self._site.start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+@pytest.fixture
+async def server(unused_tcp_port):
+    server = MockAPIServer(unused_tcp_port)
+    await server.start()
+    yield server
+    await server.stop()
+
+
+@pytest.fixture
+async def async_session(server, unused_tcp_port):
+    session = smartbox.AsyncSession(
+        _MOCK_API_NAME,
+        _MOCK_BASIC_AUTH_CREDS,
+        _MOCK_USERNAME,
+        _MOCK_PASSWORD,
+        backoff_factor=0.001,
+    )
+    session._api_host = f"http://localhost:{unused_tcp_port}"
+    yield session
+    await session.close()
+
+
+async def test_lazy_auth(server, async_session):
+    assert async_session.get_access_token() is None
+    devices = await async_session.get_devices()
+    assert devices == [{"dev_id": _MOCK_DEV_ID, "name": _MOCK_DEV_NAME}]
+    assert server.token_requests == [
+        f"grant_type=password&username={_MOCK_USERNAME}&password={_MOCK_PASSWORD}"
+    ]
+    assert async_session.get_access_token() == _MOCK_ACCESS_TOKEN
+    assert async_session.get_refresh_token() == _MOCK_REFRESH_TOKEN
+
+
+async def test_concurrent_requests_single_auth(server, async_session):
+    results = await asyncio.gather(
+        *[async_session.get_nodes(_MOCK_DEV_ID) for _ in range(50)]
+    )
+    assert len(results) == 50
+    assert all(r[0]["addr"] == 1 for r in results)
+    assert len(server.token_requests) == 1
+
+
+async def test_retry(server, async_session):
+    server.fail_count = 2
+    devices = await async_session.get_devices()
+    assert devices[0]["dev_id"] == _MOCK_DEV_ID
+
+
+async def test_status_and_setup(server, async_session):
+    node = {"addr": 1, "type": "htr"}
+    status = await async_session.get_status(_MOCK_DEV_ID, node)
+    assert status["mode"] == "auto"
+    assert (
+        await async_session.get_status(_MOCK_DEV_ID, {"addr": 2, "type": "pmo"}) == {}
+    )
+
+    with pytest.raises(ValueError):
+        await async_session.set_status(_MOCK_DEV_ID, node, {"stemp": "17.0"})
+    await async_session.set_status(_MOCK_DEV_ID, node, {"stemp": "17.0", "units": "C"})
+    assert server.posts[-1] == ("status", {"stemp": "17.0", "units": "C"})
+
+    await async_session.set_setup(_MOCK_DEV_ID, node, {"units": "F"})
+    assert server.posts[-1] == ("setup", {"away_mode": 0, "units": "F"})
+
+
+async def test_get_all_node_states(server, async_session, mocker):
+    resp = await async_session.get_all_node_states("status", max_concurrency=2)
+    assert resp == {(_MOCK_DEV_ID, "htr", 1): {"mode": "auto", "stemp": "16.0"}}
+
+    resp = await async_session.get_all_node_states("setup")
+    assert resp == {(_MOCK_DEV_ID, "htr", 1): server.setup}
+
+    # Failing nodes are None, rather than losing the rest
+    mocker.patch.object(async_session, "get_setup", side_effect=ValueError("bad"))
+    resp = await async_session.get_all_node_states("setup")
+    assert resp == {(_MOCK_DEV_ID, "htr", 1): None}
+
+    with pytest.raises(ValueError):
+        await async_session.get_all_node_states("foo")
+
+
+async def test_iter_devices(server, async_session):
+    devs = [dev async for dev in async_session.iter_devices()]
+    assert devs == [{"dev_id": _MOCK_DEV_ID, "name": _MOCK_DEV_NAME}]
+    groups = [group async for group in async_session.iter_grouped_devices()]
+    assert len(groups) == 50
+    assert groups[49] == {"id": 49, "name": "Group 49", "devs": [{"dev_id": "dev49"}]}
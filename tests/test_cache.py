@@ -0,0 +1,47 @@
+from freezegun import freeze_time
+import pytest
+
+from smartbox.cache import TTLCache
+
+
+def test_ttl_cache():
+    with freeze_time("2021-01-15 23:23:45") as frozen_datetime:
+        cache = TTLCache(ttl=10, maxsize=2)
+        assert cache.get("a") is None
+        cache.set("a", 1)
+        assert cache.get("a") == 1
+        assert cache.stats() == {"hits": 1, "misses": 1, "evictions": 0, "size": 1}
+
+        frozen_datetime.tick(11)
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(ttl=60, maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # touch a so b is least recently used
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_ttl_cache_invalidate():
+    cache = TTLCache(ttl=60, maxsize=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.invalidate("a")
+    cache.invalidate("missing")
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    cache.clear()
+    assert cache.get("b") is None
+
+
+def test_ttl_cache_invalid_size():
+    with pytest.raises(ValueError):
+        TTLCache(ttl=60, maxsize=0)
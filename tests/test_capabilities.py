@@ -0,0 +1,106 @@
+import math
+import pytest
+
+from smartbox.capabilities import NODE_ENDPOINTS, CapabilityMap, EndpointState
+
+
+def test_known_unsupported():
+    capabilities = CapabilityMap()
+    assert not capabilities.should_request("pmo", "status")
+    assert not capabilities.is_supported("pmo", "status")
+    assert capabilities.get_state("pmo", "status").retry_at == math.inf
+    assert capabilities.should_request("pmo", "setup")
+    assert capabilities.should_request("htr", "status")
+    assert capabilities.skipped == 1
+
+    capabilities = CapabilityMap(known_unsupported=[])
+    assert capabilities.should_request("pmo", "status")
+
+
+def test_failure_backoff(mocker):
+    now = 1000.0
+    mocker.patch("smartbox.capabilities.time.monotonic", side_effect=lambda: now)
+    capabilities = CapabilityMap(initial_backoff=10, max_backoff=25)
+    assert capabilities.get_state("acm", "prog") == EndpointState(None, 0, 0.0, None)
+
+    # Auth errors etc don't say anything about the endpoint
+    assert not capabilities.record_failure("acm", "prog", 401)
+    assert capabilities.should_request("acm", "prog")
+
+    assert capabilities.record_failure("acm", "prog", 404)
+    assert capabilities.get_state("acm", "prog") == EndpointState(False, 1, 1010.0, 404)
+    assert not capabilities.should_request("acm", "prog")
+    assert not capabilities.is_supported("acm", "prog")
+
+    # After the backoff, only one caller retries
+    now = 1010.0
+    assert capabilities.is_supported("acm", "prog")
+    assert capabilities.should_request("acm", "prog")
+    assert not capabilities.should_request("acm", "prog")
+
+    capabilities.record_failure("acm", "prog", 404)
+    assert capabilities.get_state("acm", "prog").retry_at == 1030.0
+    capabilities.record_failure("acm", "prog", 404)
+    # Capped at max_backoff
+    assert capabilities.get_state("acm", "prog").retry_at == 1035.0
+
+    now = 1035.0
+    assert capabilities.should_request("acm", "prog")
+    capabilities.record_success("acm", "prog")
+    assert capabilities.get_state("acm", "prog") == EndpointState(True, 0, 0.0, None)
+    assert capabilities.should_request("acm", "prog")
+    assert capabilities.skipped == 2
+
+
+def test_get_capabilities():
+    capabilities = CapabilityMap()
+    capabilities.record_success("htr", "status")
+    capabilities.record_failure("htr", "version", 404)
+    assert capabilities.get_capabilities() == {
+        "pmo": {"status": False, "setup": None, "prog": None, "version": None},
+        "htr": {"status": True, "setup": None, "prog": None, "version": False},
+    }
+    assert set(capabilities.get_capabilities()["htr"]) == set(NODE_ENDPOINTS)
+
+
+def test_per_node(mocker):
+    now = 1000.0
+    mocker.patch("smartbox.capabilities.time.monotonic", side_effect=lambda: now)
+    capabilities = CapabilityMap(initial_backoff=10, node_type_threshold=2)
+
+    # Only server errors indicating the endpoint is unsupported count
+    assert not capabilities.record_failure("htr", "status", 400, "dev1", 1)
+    assert not capabilities.record_failure("htr", "status", 500, "dev1", 1)
+    assert capabilities.should_request("htr", "status", "dev1", 1)
+
+    # A failing node doesn't affect other nodes of its type
+    assert capabilities.record_failure("htr", "status", 404, "dev1", 1)
+    assert capabilities.get_state("htr", "status", "dev1", 1).supported is False
+    assert not capabilities.should_request("htr", "status", "dev1", 1)
+    assert not capabilities.is_supported("htr", "status", "dev1", 1)
+    assert capabilities.should_request("htr", "status", "dev2", 1)
+    assert capabilities.should_request("htr", "status", "dev1", 2)
+    assert capabilities.is_supported("htr", "status")
+    assert capabilities.get_capabilities() == {
+        "pmo": {"status": False, "setup": None, "prog": None, "version": None}
+    }
+
+    # Until enough nodes of the type fail
+    assert capabilities.record_failure("htr", "status", 404, "dev2", 1)
+    assert not capabilities.is_supported("htr", "status")
+    assert not capabilities.should_request("htr", "status", "dev3", 1)
+    assert capabilities.get_capabilities()["htr"]["status"] is False
+
+    # Any success means the type supports it
+    now = 1010.0
+    assert capabilities.should_request("htr", "status", "dev3", 1)
+    capabilities.record_success("htr", "status", "dev3", 1)
+    assert capabilities.is_supported("htr", "status")
+    assert capabilities.is_supported("htr", "status", "dev3", 1)
+    assert capabilities.record_failure("htr", "status", 404, "dev4", 1)
+    assert capabilities.is_supported("htr", "status")
+
+
+def test_invalid_threshold():
+    with pytest.raises(ValueError):
+        CapabilityMap(node_type_threshold=0)
@@ -0,0 +1,160 @@
+import pytest
+
+from smartbox.circuit_breaker import (
+    CircuitBreaker,
+    CircuitBreakerRegistry,
+    CircuitState,
+)
+from smartbox.error import CircuitOpenError
+
+
+@pytest.fixture
+def clock(mocker):
+    clock = {"now": 1000.0}
+    mocker.patch(
+        "smartbox.circuit_breaker.time.monotonic", side_effect=lambda: clock["now"]
+    )
+    return clock
+
+
+def test_open_after_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+    assert breaker.state == CircuitState.CLOSED
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.before_request() == CircuitState.CLOSED
+    # Success resets the count
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitState.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+    assert breaker.retry_delay() == 10
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+    clock["now"] += 4
+    assert breaker.retry_delay() == 6
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    assert breaker.stats() == {
+        "state": "open",
+        "failures": 3,
+        "rejected": 2,
+        "opened": 1,
+    }
+
+
+def test_half_open(clock):
+    breaker = CircuitBreaker(
+        failure_threshold=1, reset_timeout=10, max_reset_timeout=30
+    )
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+
+    # Only one probe allowed through
+    clock["now"] += 10
+    assert breaker.retry_delay() == 0
+    assert breaker.before_request() == CircuitState.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+    # Failed probe doubles the timeout
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+    assert breaker.retry_delay() == 20
+    clock["now"] += 20
+    assert breaker.before_request() == CircuitState.HALF_OPEN
+    breaker.record_failure()
+    assert breaker.retry_delay() == 30
+
+    clock["now"] += 30
+    assert breaker.before_request() == CircuitState.HALF_OPEN
+    breaker.record_success()
+    assert breaker.state == CircuitState.CLOSED
+    assert breaker.before_request() == CircuitState.CLOSED
+
+    # Timeout is reset after closing
+    breaker.record_failure()
+    assert breaker.retry_delay() == 10
+
+
+def test_call(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+
+    def fail():
+        raise ConnectionError("offline")
+
+    assert breaker.call(lambda: 1) == 1
+    # Exceptions which aren't failures don't open the circuit
+    for _ in range(2):
+        with pytest.raises(KeyError):
+            breaker.call(lambda: {}["x"], failure_exceptions=(ConnectionError,))
+    assert breaker.state == CircuitState.CLOSED
+    # Nor do results which aren't failures
+    assert breaker.call(lambda: 200, is_failure=lambda r: r >= 500) == 200
+    assert breaker.call(lambda: 503, is_failure=lambda r: r >= 500) == 503
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    assert breaker.state == CircuitState.OPEN
+
+    calls = []
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: calls.append(1))
+    assert not calls
+
+    # Failed health check doesn't make the request
+    clock["now"] += 10
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: calls.append(1), probe=lambda: False)
+    assert not calls
+    assert breaker.state == CircuitState.OPEN
+
+    clock["now"] += 20
+    breaker.call(lambda: calls.append(1), probe=lambda: True)
+    assert calls == [1]
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_call_interrupted(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+
+    def interrupted():
+        raise KeyboardInterrupt()
+
+    breaker.record_failure()
+    clock["now"] += 10
+    # An interrupted probe is neither a success nor a failure
+    with pytest.raises(KeyboardInterrupt):
+        breaker.call(interrupted)
+    assert breaker.state == CircuitState.HALF_OPEN
+    assert breaker.stats()["failures"] == 1
+    # but another request can probe
+    assert breaker.call(lambda: 1) == 1
+    assert breaker.state == CircuitState.CLOSED
+
+    breaker.record_failure()
+    clock["now"] += 10
+    with pytest.raises(KeyboardInterrupt):
+        breaker.call(lambda: 1, probe=interrupted)
+    assert breaker.state == CircuitState.HALF_OPEN
+    assert breaker.call(lambda: 1) == 1
+
+
+def test_invalid_threshold():
+    with pytest.raises(ValueError):
+        CircuitBreaker(failure_threshold=0)
+
+
+def test_registry(clock):
+    registry = CircuitBreakerRegistry(failure_threshold=1, reset_timeout=5)
+    breaker = registry.get("dev1")
+    assert registry.get("dev1") is breaker
+    assert registry.get("dev2") is not breaker
+    breaker.record_failure()
+    assert registry.get_states() == {
+        "dev1": CircuitState.OPEN,
+        "dev2": CircuitState.CLOSED,
+    }
+    assert breaker.retry_delay() == 5
@@ -0,0 +1,79 @@
+import json
+import pytest
+import socketio
+
+from smartbox import codec
+from smartbox.socket import SocketSession
+
+
+@pytest.fixture(params=codec.get_available_json_codecs())
+def json_codec(request):
+    previous = codec.get_json_codec_name() if codec.is_json_codec_selected() else None
+    codec.set_json_codec(request.param)
+    yield request.param
+    codec.set_json_codec(previous)
+
+
+_DATA = {
+    "away_status": {"away": False, "enabled": True},
+    "nodes": [{"name": "Salón", "addr": 1, "type": "htr", "installed": True}],
+    "power_limit": "0",
+    "mtemp": 18.5,
+    "nothing": None,
+}
+
+
+def test_default_codec():
+    assert codec.get_json_codec_name() == codec.get_available_json_codecs()[0]
+    assert codec.get_available_json_codecs()[-1] == "json"
+    assert not codec.is_json_codec_selected()
+
+
+def test_socketio_json(json_codec, mock_session):
+    # Only set for socketio (globally) once a codec is explicitly selected
+    packet_json = socketio.packet.Packet.json
+    try:
+        codec.set_json_codec(None)
+        SocketSession(mock_session, "dev_id", None, None)
+        assert socketio.packet.Packet.json is packet_json
+        codec.set_json_codec(json_codec)
+        assert codec.is_json_codec_selected()
+        SocketSession(mock_session, "dev_id", None, None)
+        assert socketio.packet.Packet.json is codec
+    finally:
+        socketio.packet.Packet.json = packet_json
+
+
+def test_roundtrip(json_codec):
+    assert codec.get_json_codec_name() == json_codec
+    encoded = codec.dumps(_DATA)
+    assert isinstance(encoded, str)
+    assert json.loads(encoded) == _DATA
+    assert codec.loads(encoded) == _DATA
+    assert codec.loads(encoded.encode()) == _DATA
+
+
+def test_dumps_options(json_codec):
+    assert codec.dumps({"b": 1, "a": [1, 2]}, separators=(",", ":")) == (
+        '{"b":1,"a":[1,2]}'
+    )
+    assert codec.dumps({"b": 1, "a": 2}, sort_keys=True, separators=(",", ":")) == (
+        '{"a":2,"b":1}'
+    )
+    # Pretty printing should match the stdlib for the CLI
+    assert codec.dumps(_DATA, indent=4, sort_keys=True) == json.dumps(
+        _DATA, indent=4, sort_keys=True
+    )
+
+
+def test_set_json_codec():
+    previous = codec.get_json_codec_name()
+    with pytest.raises(ValueError):
+        codec.set_json_codec("notajsonlib")
+    assert codec.get_json_codec_name() == previous
+    codec.set_json_codec("json")
+    assert codec.get_json_codec_name() == "json"
+    assert codec.is_json_codec_selected()
+    codec.set_json_codec(None)
+    assert codec.get_json_codec_name() == codec.get_available_json_codecs()[0]
+    assert not codec.is_json_codec_selected()
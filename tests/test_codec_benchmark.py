@@ -0,0 +1,109 @@
+import pytest
+
+from smartbox import codec
+
+_NUM_NODES = 16
+
+
+def _node_status(addr):
+    return {
+        "sync_status": "ok",
+        "mode": "auto",
+        "active": addr % 2 == 0,
+        "ice_temp": "7.0",
+        "eco_temp": "17.5",
+        "comf_temp": "21.0",
+        "units": "C",
+        "stemp": "21.0",
+        "mtemp": f"{18 + addr / 10:.1f}",
+        "power": "1000",
+        "locked": 0,
+        "duty": 37,
+        "act_duty": 35,
+        "pcb_temp": "24.1",
+        "power_pcb_temp": "25.3",
+        "presence": False,
+        "window_open": False,
+        "true_radiant_active": False,
+        "boost": False,
+        "boost_end_min": 0,
+        "boost_end_day": 0,
+        "error_code": "",
+    }
+
+
+def _node_setup(addr):
+    return {
+        "sync_status": "ok",
+        "control_mode": 5,
+        "units": "C",
+        "power": "1000",
+        "offset": "0.0",
+        "away_mode": 0,
+        "away_offset": "2.0",
+        "modified_auto_span": 0,
+        "window_mode_enabled": False,
+        "true_radiant_enabled": False,
+        "user_duty_factor": 100,
+        "flash_version": "1.31",
+        "factory_options": {
+            "temp_compensation_enabled": False,
+            "window_mode_available": True,
+            "true_radiant_available": True,
+            "duty_limit": 100,
+            "boost_config": 2,
+        },
+        "extra_options": {"boost_temp": "22.0", "boost_time": 60},
+    }
+
+
+_DEV_DATA = {
+    "away_status": {"away": False, "enabled": True, "forced": False},
+    "connected": True,
+    "geo_data": {
+        "country": "es",
+        "state": "Andalucía",
+        "city": "Sevilla",
+        "tz_code": "Europe/Madrid",
+        "zip": "41001",
+    },
+    "htr_system": {"setup": {"power_limit": "0"}},
+    "nodes": [
+        {
+            "name": f"Radiator {addr}",
+            "addr": addr,
+            "type": "htr",
+            "installed": True,
+            "lost": False,
+            "status": _node_status(addr),
+            "setup": _node_setup(addr),
+            "prog": {"prog": {str(day): [2] * 24 for day in range(7)}},
+        }
+        for addr in range(1, _NUM_NODES + 1)
+    ],
+}
+
+_UPDATE = {"path": "/htr/3/status", "body": _node_status(3)}
+
+_PAYLOADS = {"dev_data": _DEV_DATA, "update": _UPDATE}
+
+
+@pytest.fixture(params=codec.get_available_json_codecs())
+def json_codec(request):
+    previous = codec.get_json_codec_name() if codec.is_json_codec_selected() else None
+    codec.set_json_codec(request.param)
+    yield request.param
+    codec.set_json_codec(previous)
+
+
+@pytest.mark.benchmark(group="codec-loads")
+@pytest.mark.parametrize("payload", _PAYLOADS.keys())
+def test_benchmark_loads(benchmark, json_codec, payload):
+    encoded = codec.dumps(_PAYLOADS[payload]).encode()
+    assert benchmark(codec.loads, encoded) == _PAYLOADS[payload]
+
+
+@pytest.mark.benchmark(group="codec-dumps")
+@pytest.mark.parametrize("payload", _PAYLOADS.keys())
+def test_benchmark_dumps(benchmark, json_codec, payload):
+    benchmark(codec.dumps, _PAYLOADS[payload], separators=(",", ":"))
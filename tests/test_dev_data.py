@@ -0,0 +1,39 @@
+from smartbox import get_node_setups, get_node_states, get_node_statuses
+
+_TEST_DEV_DATA = {
+    "away_status": {"away": False},
+    "nodes": [
+        {
+            "addr": 1,
+            "type": "htr",
+            "status": {"mode": "auto", "mtemp": "22.0"},
+            "setup": {"window_mode_enabled": False},
+        },
+        {
+            "addr": "2",
+            "type": "acm",
+            "status": {"mode": "off", "mtemp": "18.5"},
+            "setup": {"units": "C"},
+        },
+        {"addr": 3, "type": "pmo", "setup": {"power_limit": "0"}},
+    ],
+}
+
+
+def test_get_node_statuses():
+    assert get_node_statuses(_TEST_DEV_DATA) == {
+        ("htr", 1): {"mode": "auto", "mtemp": "22.0"},
+        ("acm", 2): {"mode": "off", "mtemp": "18.5"},
+    }
+
+
+def test_get_node_setups():
+    assert get_node_setups(_TEST_DEV_DATA) == {
+        ("htr", 1): {"window_mode_enabled": False},
+        ("acm", 2): {"units": "C"},
+        ("pmo", 3): {"power_limit": "0"},
+    }
+
+
+def test_get_node_states_no_nodes():
+    assert get_node_states({"away_status": {"away": True}}, "status") == {}
@@ -0,0 +1,159 @@
+import asyncio
+import concurrent.futures
+import threading
+
+import pytest
+
+from smartbox import DispatchQueue, OverflowPolicy
+
+
+async def test_dispatch_order():
+    queue = DispatchQueue()
+    results = []
+
+    async def async_callback(value):
+        await asyncio.sleep(0)
+        results.append(value)
+
+    for i in range(5):
+        await queue.put(results.append if i % 2 else async_callback, i)
+    await queue.join()
+    assert results == [0, 1, 2, 3, 4]
+    stats = queue.stats()
+    assert stats["enqueued"] == 5
+    assert stats["dispatched"] == 5
+    assert stats["depth"] == 0
+    assert stats["lag_max"] >= stats["lag_mean"] >= 0
+    await queue.close()
+
+
+async def test_dispatch_invalid():
+    with pytest.raises(ValueError):
+        DispatchQueue(maxsize=0)
+    with pytest.raises(ValueError):
+        DispatchQueue(workers=0)
+    with pytest.raises(ValueError):
+        DispatchQueue(policy="unknown")
+
+
+async def _blocked_queue(policy):
+    """Return a queue of size 2 whose worker is stuck on a first callback,
+    and an event to release it."""
+    queue = DispatchQueue(maxsize=2, policy=policy)
+    release = asyncio.Event()
+    await queue.put(release.wait)
+    while queue.stats()["active"] == 0:
+        await asyncio.sleep(0)
+    return queue, release
+
+
+async def test_dispatch_block():
+    queue, release = await _blocked_queue(OverflowPolicy.BLOCK)
+    results = []
+    await queue.put(results.append, 1)
+    await queue.put(results.append, 2)
+    put = asyncio.ensure_future(queue.put(results.append, 3))
+    await asyncio.sleep(0.01)
+    assert not put.done()
+    assert len(queue) == 2
+
+    release.set()
+    await put
+    await queue.join()
+    assert results == [1, 2, 3]
+    assert queue.stats()["blocked"] == 1
+    assert queue.stats()["max_depth"] == 2
+    await queue.close()
+
+
+async def test_dispatch_drop_oldest():
+    queue, release = await _blocked_queue(OverflowPolicy.DROP_OLDEST)
+    results = []
+    for i in range(4):
+        await queue.put(results.append, i)
+    release.set()
+    await queue.join()
+    assert results == [2, 3]
+    assert queue.stats()["dropped"] == 2
+    await queue.close()
+
+
+async def test_dispatch_coalesce():
+    queue, release = await _blocked_queue(OverflowPolicy.COALESCE)
+    results = []
+    await queue.put(results.append, "a1", key="a")
+    await queue.put(results.append, "b1", key="b")
+    # Replaces a1, and moves to the back
+    await queue.put(results.append, "a2", key="a")
+    # Full, so drops the oldest (b1)
+    await queue.put(results.append, "c1", key="c")
+    release.set()
+    await queue.join()
+    assert results == ["a2", "c1"]
+    stats = queue.stats()
+    assert stats["coalesced"] == 1
+    assert stats["dropped"] == 1
+    await queue.close()
+
+
+async def test_dispatch_coalesce_merge():
+    queue, release = await _blocked_queue(OverflowPolicy.COALESCE)
+    results = []
+
+    def merge(queued, new):
+        return ({**queued[0], **new[0]},)
+
+    await queue.put(results.append, {"mode": "auto", "stemp": "20"}, key="a")
+    await queue.put(results.append, {"stemp": "21"}, key="a", merge=merge)
+    release.set()
+    await queue.join()
+    assert results == [{"mode": "auto", "stemp": "21"}]
+    await queue.close()
+
+
+async def test_dispatch_errors(caplog):
+    queue = DispatchQueue()
+    results = []
+
+    def fail(value):
+        raise RuntimeError(value)
+
+    await queue.put(fail, "oops")
+    await queue.put(results.append, "ok")
+    await queue.join()
+    assert results == ["ok"]
+    assert queue.stats()["errors"] == 1
+    assert "Error in dispatched callback" in caplog.text
+    await queue.close()
+
+
+async def test_dispatch_executor():
+    main_thread = threading.get_ident()
+    threads = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        queue = DispatchQueue(executor=executor)
+
+        async def async_callback():
+            threads.append(threading.get_ident())
+
+        await queue.put(lambda: threads.append(threading.get_ident()))
+        await queue.put(async_callback)
+        await queue.join()
+        await queue.close()
+    assert threads[0] != main_thread
+    assert threads[1] == main_thread
+
+
+async def test_dispatch_close():
+    queue, release = await _blocked_queue(OverflowPolicy.BLOCK)
+    results = []
+    await queue.put(results.append, 1)
+    await queue.close(drain=False)
+    assert results == []
+    assert len(queue) == 0
+
+    # Restarts on the next put
+    await queue.put(results.append, 2)
+    await queue.join()
+    assert results == [2]
+    await queue.close()
@@ -0,0 +1,188 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import pytest
+import threading
+import time
+
+import smartbox
+from smartbox.hedging import HedgePolicy
+
+
+def _fast():
+    return "fast"
+
+
+def test_no_hedging_until_min_samples():
+    policy = HedgePolicy(min_samples=5, min_delay=0)
+    for _ in range(4):
+        assert policy.run("devs", _fast) == "fast"
+        assert policy.get_delay("devs") is None
+    policy.run("devs", _fast)
+    assert policy.get_delay("devs") is not None
+    assert policy.get_delay("devs/{dev}/mgr/nodes") is None
+    assert policy.stats()["hedges"] == 0
+    policy.shutdown()
+
+
+def test_hedge_wins():
+    policy = HedgePolicy(min_samples=5, budget=1.0, min_delay=0.01)
+    for _ in range(5):
+        policy.run("devs", _fast)
+    assert policy.get_delay("devs") == 0.01
+
+    calls = itertools.count()
+    release = threading.Event()
+
+    def slow_first():
+        if next(calls) == 0:
+            release.wait(5)
+            return "slow"
+        return "hedged"
+
+    start = time.monotonic()
+    assert policy.run("devs", slow_first) == "hedged"
+    assert time.monotonic() - start < 1
+    release.set()
+    stats = policy.stats()
+    assert stats["hedges"] == 1
+    assert stats["hedge_wins"] == 1
+    assert stats["delay:devs"] == 0.01
+    policy.shutdown()
+
+
+def test_budget():
+    policy = HedgePolicy(min_samples=1, budget=0.1, min_delay=0.01)
+    policy.run("devs", _fast)
+
+    def slow():
+        time.sleep(0.05)
+        return "slow"
+
+    # 2 requests so far, so no budget to hedge
+    assert policy.run("devs", slow) == "slow"
+    stats = policy.stats()
+    assert stats["hedges"] == 0
+    assert stats["budget_exhausted"] == 1
+
+    for _ in range(8):
+        policy.run("devs", _fast)
+    # 11 requests, so 1 hedge allowed
+    assert policy.run("devs", slow) == "slow"
+    stats = policy.stats()
+    assert stats["hedges"] == 1
+    assert stats["budget_exhausted"] == 1
+    policy.shutdown()
+
+
+def test_first_attempts_not_limited_by_pool():
+    policy = HedgePolicy(min_samples=1, budget=0, min_delay=0.01, max_workers=1)
+    policy.run("devs", _fast)
+    # Only completes if all the first attempts run at once
+    barrier = threading.Barrier(4, timeout=5)
+    results = []
+
+    def run():
+        results.append(policy.run("devs", lambda: barrier.wait() is not None))
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [True] * 4
+    assert policy.stats()["hedges"] == 0
+    policy.shutdown()
+
+
+def test_errors():
+    policy = HedgePolicy(min_samples=1, budget=1.0, min_delay=0.01)
+    policy.run("devs", _fast)
+    calls = itertools.count()
+
+    def slow_failure_then_success():
+        if next(calls) == 0:
+            time.sleep(0.05)
+            raise ValueError("first")
+        time.sleep(0.1)
+        return "second"
+
+    # A failing attempt doesn't win if the other succeeds
+    assert policy.run("devs", slow_failure_then_success) == "second"
+
+    def always_fails():
+        time.sleep(0.05)
+        raise ValueError("fail")
+
+    with pytest.raises(ValueError):
+        policy.run("devs", always_fails)
+    policy.shutdown()
+
+    with pytest.raises(ValueError):
+        HedgePolicy(percentile=1.5)
+    with pytest.raises(ValueError):
+        HedgePolicy(budget=-1)
+
+
+class _SlowSecondRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    gets = itertools.count()
+    release = threading.Event()
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self._send_json(
+            {
+                "token_type": "bearer",
+                "access_token": "sj32oj2lkwjf",
+                "expires_in": 14400,
+                "refresh_token": "23ij2oij324j3423",
+            }
+        )
+
+    def do_GET(self):
+        if next(self.gets) == 1:
+            self.release.wait(5)
+        self._send_json({"devs": [{"dev_id": "2o3jo2jkj"}]})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_session_hedging():
+    server = ThreadingHTTPServer(("localhost", 0), _SlowSecondRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    policy = HedgePolicy(min_samples=1, budget=1.0, min_delay=0.05)
+    session = smartbox.Session(
+        "myapi",
+        "sldjfls93r2lkj",
+        "xxxxx",
+        "yyyyy",
+        api_host=f"http://localhost:{server.server_address[1]}",
+        hedge_policy=policy,
+    )
+    try:
+        assert session.get_devices() == [{"dev_id": "2o3jo2jkj"}]
+        start = time.monotonic()
+        assert session.get_devices() == [{"dev_id": "2o3jo2jkj"}]
+        assert time.monotonic() - start < 1
+        stats = policy.stats()
+        assert stats["hedges"] == 1
+        assert stats["hedge_wins"] == 1
+        assert "delay:devs" in stats
+    finally:
+        _SlowSecondRequestHandler.release.set()
+        session.close()
+        policy.shutdown()
+        server.shutdown()
+        server.server_close()
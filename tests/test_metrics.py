@@ -0,0 +1,76 @@
+import pytest
+
+from smartbox.metrics import (
+    Histogram,
+    PrometheusSessionMetrics,
+    SessionMetrics,
+    get_endpoint_template,
+)
+
+
+@pytest.mark.parametrize(
+    "path,template",
+    [
+        ("devs", "devs"),
+        ("grouped_devs", "grouped_devs"),
+        ("devs/2o3jo2jkj/dev_data", "devs/{dev}/dev_data"),
+        ("devs/2o3jo2jkj/mgr/nodes", "devs/{dev}/mgr/nodes"),
+        ("devs/2o3jo2jkj/mgr/away_status", "devs/{dev}/mgr/away_status"),
+        ("devs/2o3jo2jkj/htr/1/status", "devs/{dev}/{type}/{addr}/status"),
+        ("devs/2o3jo2jkj/acm/12/setup", "devs/{dev}/{type}/{addr}/setup"),
+    ],
+)
+def test_endpoint_template(path, template):
+    assert get_endpoint_template(path) == template
+
+
+def test_histogram():
+    histogram = Histogram([0.1, 1.0])
+    assert histogram.quantile(0.5) is None
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    assert histogram.count == 4
+    assert histogram.sum == pytest.approx(2.65)
+    assert histogram.cumulative_buckets() == [(0.1, 2), (1.0, 3), (float("inf"), 4)]
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.75) == 1.0
+    assert histogram.quantile(1.0) == float("inf")
+
+
+def test_session_metrics_noop():
+    metrics = SessionMetrics()
+    metrics.observe_request("GET", "devs", "200", 0.1, 100, 0)
+    metrics.observe_auth("password", 0.1, True)
+
+
+def test_prometheus_export():
+    metrics = PrometheusSessionMetrics(latency_buckets=[0.1], size_buckets=[100])
+    metrics.observe_request("GET", "devs", "200", 0.05, 50, 0)
+    metrics.observe_request("GET", "devs", "503", 0.5, 200, 2)
+    metrics.observe_auth("password", 0.2, True)
+    metrics.observe_auth("refresh_token", 0.2, False)
+
+    assert metrics.get_request_count("GET", "devs", "200") == 1
+    assert metrics.get_request_count("GET", "devs", "404") == 0
+    assert metrics.get_retry_count("GET", "devs") == 2
+    assert metrics.get_latency("POST", "devs") is None
+
+    lines = metrics.export_prometheus().splitlines()
+    labels = 'method="GET",endpoint="devs"'
+    assert "# TYPE smartbox_request_duration_seconds histogram" in lines
+    assert f'smartbox_request_duration_seconds_bucket{{{labels},le="0.1"}} 1' in lines
+    assert f'smartbox_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2' in lines
+    assert (
+        'smartbox_request_duration_seconds_count{method="GET",endpoint="devs"} 2'
+        in lines
+    )
+    assert (
+        'smartbox_response_size_bytes_bucket{method="GET",endpoint="devs",le="100"} 1'
+        in lines
+    )
+    assert (
+        'smartbox_requests_total{method="GET",endpoint="devs",status="503"} 1' in lines
+    )
+    assert 'smartbox_request_retries_total{method="GET",endpoint="devs"} 2' in lines
+    assert 'smartbox_auth_failures_total{grant_type="refresh_token"} 1' in lines
+    assert 'smartbox_auth_failures_total{grant_type="password"} 1' not in lines
@@ -0,0 +1,107 @@
+import pytest
+
+from smartbox.models import (
+    AwayStatus,
+    Device,
+    Node,
+    NodeSetup,
+    NodeStatus,
+    nodes_from_dev_data,
+)
+
+_TEST_DEV_DATA = {
+    "away_status": {"away": False, "enabled": True},
+    "nodes": [
+        {
+            "addr": 1,
+            "type": "htr",
+            "name": "Living room",
+            "installed": True,
+            "status": {
+                "mode": "auto",
+                "stemp": "21.5",
+                "mtemp": "19.8",
+                "units": "C",
+                "active": True,
+                "sync_status": "ok",
+            },
+            "setup": {"window_mode_enabled": False, "offset": "0.5"},
+        },
+        {"addr": "2", "type": "pmo", "name": "Meter"},
+    ],
+}
+
+
+def test_node_status():
+    status = NodeStatus.from_dict(_TEST_DEV_DATA["nodes"][0]["status"])
+    assert status.mode == "auto"
+    assert status.stemp == 21.5
+    assert status.mtemp == 19.8
+    assert status.units == "C"
+    assert status.active is True
+    assert status.locked is None
+    assert status.extra == {"sync_status": "ok"}
+    assert status.to_dict() == {
+        "mode": "auto",
+        "stemp": 21.5,
+        "mtemp": 19.8,
+        "units": "C",
+        "active": True,
+        "sync_status": "ok",
+    }
+    assert NodeStatus.from_dict(status.to_dict()) == status
+    # Empty numeric strings and string booleans
+    status = NodeStatus.from_dict({"stemp": "", "charging": "0", "charge_level": "5"})
+    assert status.stemp is None
+    assert status.charging is False
+    assert status.charge_level == 5
+    assert status.extra is None
+
+
+def test_slots():
+    for model in (NodeStatus(), NodeSetup(), AwayStatus(), Device(), Node()):
+        assert not hasattr(model, "__dict__")
+        with pytest.raises(AttributeError):
+            model.not_a_field = 1
+
+
+def test_construct():
+    status = NodeStatus(mode="manual", stemp=20.0, boost=True)
+    assert status.mode == "manual"
+    assert status.mtemp is None
+    assert status.extra == {"boost": True}
+    assert status != NodeStatus(mode="manual", stemp=20.0)
+    assert repr(status) == "NodeStatus(mode='manual', stemp=20.0, boost=True)"
+
+
+def test_node():
+    node = Node.from_dict(_TEST_DEV_DATA["nodes"][0])
+    assert node.key == ("htr", 1)
+    assert node.name == "Living room"
+    assert node.installed is True
+    assert isinstance(node.status, NodeStatus)
+    assert node.status.stemp == 21.5
+    assert node.setup == NodeSetup(window_mode_enabled=False, offset=0.5)
+    assert node.to_dict()["setup"] == {"window_mode_enabled": False, "offset": 0.5}
+
+    node = Node.from_dict(_TEST_DEV_DATA["nodes"][1])
+    assert node.key == ("pmo", 2)
+    assert node.status is None
+    assert node.to_dict() == {"type": "pmo", "addr": 2, "name": "Meter"}
+
+
+def test_device_and_away_status():
+    device = Device.from_dict({"dev_id": "abc", "name": "Home", "product_id": 1})
+    assert device.dev_id == "abc"
+    assert device.product_id == "1"
+    away_status = AwayStatus.from_dict(_TEST_DEV_DATA["away_status"])
+    assert away_status.away is False
+    assert away_status.enabled is True
+    assert away_status.forced is None
+
+
+def test_nodes_from_dev_data():
+    nodes = nodes_from_dev_data(_TEST_DEV_DATA)
+    assert list(nodes) == [("htr", 1), ("pmo", 2)]
+    assert nodes["htr", 1].status.mtemp == 19.8
+    assert nodes_from_dev_data({}) == {}
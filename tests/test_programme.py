@@ -0,0 +1,84 @@
+import pytest
+
+from smartbox.programme import Programme, ProgrammeChange
+
+
+def _prog_dict(slots_per_day=24, mode=1):
+    return {"prog": {str(day): [mode] * slots_per_day for day in range(7)}}
+
+
+def test_from_dict():
+    prog = Programme.from_dict(_prog_dict())
+    assert prog.slots_per_day == 24
+    assert bytes(prog) == b"\x01" * 168
+    assert prog.to_dict() == _prog_dict()
+    assert list(prog) == [[1] * 24] * 7
+
+    prog = Programme.from_dict(_prog_dict(48, 2)["prog"])
+    assert prog.slots_per_day == 48
+    assert prog.get(6, 47) == 2
+
+    with pytest.raises(ValueError):
+        Programme.from_dict({"prog": {"0": [0] * 24}})
+    days = _prog_dict()
+    days["prog"]["3"] = [0] * 48
+    with pytest.raises(ValueError):
+        Programme.from_dict(days)
+    with pytest.raises(ValueError):
+        Programme.from_dict(_prog_dict(12))
+
+
+def test_get_set():
+    prog = Programme()
+    assert prog.get_day(0) == [0] * 24
+    prog.set(2, 7, 2)
+    assert prog.get(2, 7) == 2
+    assert prog.to_dict()["prog"]["2"][7] == 2
+    prog.set_day(6, [1] * 24)
+    assert prog.get_day(6) == [1] * 24
+    with pytest.raises(IndexError):
+        prog.get(7, 0)
+    with pytest.raises(IndexError):
+        prog.set(0, 24, 1)
+    with pytest.raises(ValueError):
+        prog.set_day(0, [1] * 48)
+    with pytest.raises(ValueError):
+        Programme(b"\x00" * 10)
+
+
+def test_diff():
+    prog = Programme.from_dict(_prog_dict())
+    other = prog.copy()
+    assert other == prog
+    assert prog.diff(other) == []
+
+    other.set(0, 8, 2)
+    other.set(4, 23, 0)
+    assert other != prog
+    assert prog.diff(other) == [
+        ProgrammeChange(0, 8, 1, 2),
+        ProgrammeChange(4, 23, 1, 0),
+    ]
+    # The copy is independent
+    assert prog.get(0, 8) == 1
+
+    assert Programme(slots_per_day=24) != Programme(slots_per_day=48)
+    with pytest.raises(ValueError):
+        prog.diff(Programme(slots_per_day=48))
+    with pytest.raises(TypeError):
+        hash(prog)
+
+
+def test_resample():
+    prog = Programme.from_dict(_prog_dict())
+    half_hourly = prog.resample(48)
+    assert half_hourly.slots_per_day == 48
+    assert half_hourly.get_day(0)[16:18] == [prog.get(0, 8)] * 2
+    assert half_hourly.resample(24) == prog
+    assert prog.resample(24) == prog
+
+    half_hourly.set(0, 17, 0)
+    with pytest.raises(ValueError):
+        half_hourly.resample(24)
+    with pytest.raises(ValueError):
+        prog.resample(12)
@@ -1,7 +1,10 @@
 import datetime
 from freezegun import freeze_time
 import pytest
+import requests
 from requests.exceptions import HTTPError
+import threading
+import time
 import smartbox
 
 _MOCK_API_NAME = "myapi"
@@ -264,3 +267,812 @@ def test_refresh(requests_mock):
         assert (
             requests_mock.call_count == 1 and requests_mock.last_request.method == "GET"
         )
+
+
+def test_get_all_node_states(requests_mock, session):
+    dev_2 = "9sdfj2lk3"
+    requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs",
+        json={"devs": [{"dev_id": _MOCK_DEV_ID}, {"dev_id": dev_2}]},
+    )
+    nodes = {
+        _MOCK_DEV_ID: [{"addr": 1, "type": "htr"}, {"addr": 2, "type": "acm"}],
+        dev_2: [{"addr": 1, "type": "htr"}],
+    }
+    for dev_id, dev_nodes in nodes.items():
+        requests_mock.get(
+            f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{dev_id}/mgr/nodes",
+            json={"nodes": dev_nodes},
+        )
+        for node in dev_nodes:
+            for kind in ("status", "setup"):
+                requests_mock.get(
+                    f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{dev_id}/{node['type']}/{node['addr']}/{kind}",
+                    json={"kind": kind, "dev_id": dev_id, "addr": node["addr"]},
+                )
+
+    for kind in ("status", "setup"):
+        resp = session.get_all_node_states(kind=kind, max_concurrency=4)
+        assert resp == {
+            (dev_id, node["type"], node["addr"]): {
+                "kind": kind,
+                "dev_id": dev_id,
+                "addr": node["addr"],
+            }
+            for dev_id, dev_nodes in nodes.items()
+            for node in dev_nodes
+        }
+
+    # A failing node doesn't lose the others
+    for kind, failed in (("status", {}), ("setup", None)):
+        requests_mock.get(
+            f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{dev_2}/htr/1/{kind}",
+            status_code=400,
+        )
+        resp = session.get_all_node_states(kind=kind, max_concurrency=4)
+        assert resp[(dev_2, "htr", 1)] == failed
+        assert resp[(_MOCK_DEV_ID, "htr", 1)]["kind"] == kind
+
+    with pytest.raises(ValueError):
+        session.get_all_node_states(kind="foo")
+
+
+def test_get_dev_data(requests_mock, session):
+    dev_data = {
+        "away_status": {"away": False},
+        "nodes": [{"addr": 1, "type": "htr", "status": {"mode": "auto"}}],
+    }
+    requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/dev_data",
+        json=dev_data,
+    )
+    assert session.get_dev_data(_MOCK_DEV_ID) == dev_data
+    assert smartbox.get_node_statuses(session.get_dev_data(_MOCK_DEV_ID)) == {
+        ("htr", 1): {"mode": "auto"}
+    }
+
+
+def test_topology_cache(requests_mock, session):
+    cached_session = smartbox.Session(
+        _MOCK_API_NAME,
+        _MOCK_BASIC_AUTH_CREDS,
+        _MOCK_USERNAME,
+        _MOCK_PASSWORD,
+        cache_ttl=300,
+    )
+    devs_mock = requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs",
+        json={"devs": [{"dev_id": _MOCK_DEV_ID, "name": _MOCK_DEV_NAME}]},
+    )
+    nodes_mock = requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/mgr/nodes",
+        json={"nodes": [{"addr": 1, "type": "htr"}]},
+    )
+
+    devices = cached_session.get_devices()
+    # modifying results shouldn't affect the cache
+    devices[0]["name"] = "changed"
+    assert cached_session.get_devices()[0]["name"] == _MOCK_DEV_NAME
+    assert devs_mock.call_count == 1
+
+    cached_session.get_nodes(_MOCK_DEV_ID)
+    cached_session.get_nodes(_MOCK_DEV_ID)
+    assert nodes_mock.call_count == 1
+    assert cached_session.get_cache_stats() == {
+        "hits": 2,
+        "misses": 2,
+        "evictions": 0,
+        "size": 2,
+    }
+
+    cached_session.invalidate_cache(_MOCK_DEV_ID)
+    cached_session.get_nodes(_MOCK_DEV_ID)
+    cached_session.get_devices()
+    assert nodes_mock.call_count == 2
+    assert devs_mock.call_count == 1
+
+    cached_session.invalidate_cache()
+    cached_session.get_devices()
+    assert devs_mock.call_count == 2
+
+    # uncached session always hits the API
+    session.get_devices()
+    session.get_devices()
+    assert devs_mock.call_count == 4
+    assert session.get_cache_stats() == {}
+
+
+def test_set_setup_sources(requests_mock):
+    node = {"addr": 2, "name": "My other heater", "type": "htr"}
+    setup_url = f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/{node['type']}/{node['addr']}/setup"
+    requests_mock.post(
+        f"https://{_MOCK_API_NAME}.helki.com/client/token",
+        json={
+            "token_type": _MOCK_TOKEN_TYPE,
+            "access_token": _MOCK_ACCESS_TOKEN,
+            "expires_in": _MOCK_EXPIRES_IN,
+            "refresh_token": _MOCK_REFRESH_TOKEN,
+        },
+    )
+    get_mock = requests_mock.get(setup_url, json={"away_mode": 0, "units": "C"})
+    requests_mock.post(setup_url, json={})
+
+    with freeze_time("2021-01-15 23:23:45") as frozen_datetime:
+        session = smartbox.Session(
+            _MOCK_API_NAME,
+            _MOCK_BASIC_AUTH_CREDS,
+            _MOCK_USERNAME,
+            _MOCK_PASSWORD,
+            setup_cache_ttl=60,
+        )
+        assert session.setup_cache_enabled
+
+        # nothing cached, so must fetch
+        session.set_setup(_MOCK_DEV_ID, node, {"units": "F"})
+        assert get_mock.call_count == 1
+        assert requests_mock.last_request.json() == {"away_mode": 0, "units": "F"}
+
+        # posted setup is now cached
+        session.set_setup(_MOCK_DEV_ID, node, {"away_mode": 1})
+        assert get_mock.call_count == 1
+        assert requests_mock.last_request.json() == {"away_mode": 1, "units": "F"}
+
+        # update from elsewhere (e.g. socket)
+        session.update_setup_cache(
+            _MOCK_DEV_ID, "htr", "2", {"away_mode": 0, "units": "C", "offset": "1"}
+        )
+        session.set_setup(_MOCK_DEV_ID, node, {"offset": "2"})
+        assert get_mock.call_count == 1
+        assert requests_mock.last_request.json() == {
+            "away_mode": 0,
+            "units": "C",
+            "offset": "2",
+        }
+
+        # supplied setup
+        session.set_setup(
+            _MOCK_DEV_ID, node, {"units": "C"}, current_setup={"units": "F"}
+        )
+        assert get_mock.call_count == 1
+        assert requests_mock.last_request.json() == {"units": "C"}
+
+        # stale cache
+        frozen_datetime.tick(61)
+        session.set_setup(_MOCK_DEV_ID, node, {"units": "F"})
+        assert get_mock.call_count == 2
+
+        assert session.get_set_setup_sources() == {
+            "provided": 1,
+            "cached": 2,
+            "fetched": 2,
+        }
+
+
+def test_set_setup_no_cache(requests_mock, session):
+    node = {"addr": 2, "name": "My other heater", "type": "htr"}
+    setup_url = f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/{node['type']}/{node['addr']}/setup"
+    get_mock = requests_mock.get(setup_url, json={"away_mode": 0, "units": "C"})
+    requests_mock.post(setup_url, json={})
+
+    assert not session.setup_cache_enabled
+    session.set_setup(_MOCK_DEV_ID, node, {"units": "F"})
+    session.set_setup(_MOCK_DEV_ID, node, {"units": "F"})
+    assert get_mock.call_count == 2
+    assert session.get_set_setup_sources()["fetched"] == 2
+
+
+def _mock_refresh_response(requests_mock, access_token):
+    return requests_mock.post(
+        f"https://{_MOCK_API_NAME}.helki.com/client/token",
+        json={
+            "token_type": _MOCK_TOKEN_TYPE,
+            "access_token": access_token,
+            "expires_in": _MOCK_EXPIRES_IN,
+            "refresh_token": _MOCK_REFRESH_TOKEN,
+        },
+        additional_matcher=lambda request: "grant_type=refresh_token" in request.text,
+    )
+
+
+def test_refresh_single_flight(requests_mock, session):
+    new_access_token = "sf8s9f09dfsj"
+    refresh_mock = _mock_refresh_response(requests_mock, new_access_token)
+
+    # force expiry
+    session._token = session._token._replace(expires_at=datetime.datetime.now())
+
+    num_threads = 16
+    barrier = threading.Barrier(num_threads)
+
+    def check_refresh():
+        barrier.wait()
+        session._check_refresh()
+
+    threads = [threading.Thread(target=check_refresh) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert refresh_mock.call_count == 1
+    assert session.get_access_token() == new_access_token
+
+
+def test_refresh_token_if_expiring(requests_mock, session):
+    new_access_token = "sf8s9f09dfsj"
+    refresh_mock = _mock_refresh_response(requests_mock, new_access_token)
+
+    # Expires in 10 minutes, which is fine unless we need it for longer
+    session._token = session._token._replace(
+        expires_at=datetime.datetime.now() + datetime.timedelta(minutes=10)
+    )
+    session.refresh_token_if_expiring(300)
+    assert refresh_mock.call_count == 0
+    session.refresh_token_if_expiring(900)
+    assert refresh_mock.call_count == 1
+    assert session.get_access_token() == new_access_token
+
+
+def test_background_refresh(requests_mock, session):
+    new_access_token = "sf8s9f09dfsj"
+    refresh_mock = _mock_refresh_response(requests_mock, new_access_token)
+
+    # refresh is due almost immediately: the lead time is clamped to half the
+    # remaining lifetime
+    session._token = session._token._replace(
+        expires_at=datetime.datetime.now() + datetime.timedelta(seconds=2)
+    )
+    session.start_refresh_scheduler()
+    try:
+        for _ in range(50):
+            if refresh_mock.called:
+                break
+            time.sleep(0.1)
+        assert refresh_mock.called
+        assert session.get_access_token() == new_access_token
+    finally:
+        session.close()
+    assert session._refresh_thread is None
+
+    # token isn't near expiry, so no refresh on the request path
+    requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs", json={"devs": []}
+    )
+    requests_mock.reset_mock()
+    session.get_devices()
+    assert requests_mock.call_count == 1
+
+
+def test_refresh_scheduling():
+    with freeze_time("2021-01-15 23:23:45"):
+        now = datetime.datetime.now()
+        expires_at = now + datetime.timedelta(hours=1)
+        assert smartbox.session._get_refresh_lead_time(300, expires_at) == 300
+        # Short-lived tokens are refreshed half way through their lifetime
+        expires_at = now + datetime.timedelta(seconds=200)
+        assert smartbox.session._get_refresh_lead_time(300, expires_at) == 100
+        expires_at = now - datetime.timedelta(seconds=10)
+        assert smartbox.session._get_refresh_lead_time(300, expires_at) == 0
+
+    assert [
+        smartbox.session._get_refresh_retry_interval(failures)
+        for failures in range(1, 5)
+    ] == [1, 2, 4, 8]
+    assert smartbox.session._get_refresh_retry_interval(20) == 300
+
+
+def test_token_store_resume(requests_mock, tmp_path):
+    token_mock = requests_mock.post(
+        f"https://{_MOCK_API_NAME}.helki.com/client/token",
+        json={
+            "token_type": _MOCK_TOKEN_TYPE,
+            "access_token": _MOCK_ACCESS_TOKEN,
+            "expires_in": _MOCK_EXPIRES_IN,
+            "refresh_token": _MOCK_REFRESH_TOKEN,
+        },
+    )
+    store = smartbox.FileTokenStore(str(tmp_path / "tokens.json"))
+
+    with freeze_time("2021-01-15 23:23:45") as frozen_datetime:
+        session = smartbox.Session(
+            _MOCK_API_NAME,
+            _MOCK_BASIC_AUTH_CREDS,
+            _MOCK_USERNAME,
+            _MOCK_PASSWORD,
+            token_store=store,
+        )
+        assert token_mock.call_count == 1
+        assert store.load(f"{_MOCK_API_NAME}:{_MOCK_USERNAME}") == (
+            smartbox.TokenData(
+                _MOCK_ACCESS_TOKEN, _MOCK_REFRESH_TOKEN, session.get_expiry_time()
+            )
+        )
+
+        # a new session resumes without authenticating
+        resumed_session = smartbox.Session(
+            _MOCK_API_NAME,
+            _MOCK_BASIC_AUTH_CREDS,
+            _MOCK_USERNAME,
+            _MOCK_PASSWORD,
+            token_store=store,
+        )
+        assert token_mock.call_count == 1
+        assert resumed_session.get_access_token() == _MOCK_ACCESS_TOKEN
+        assert resumed_session.get_expiry_time() == session.get_expiry_time()
+
+        # stored token near expiry, so resume with a refresh grant
+        frozen_datetime.move_to(
+            session.get_expiry_time() - datetime.timedelta(seconds=5)
+        )
+        smartbox.Session(
+            _MOCK_API_NAME,
+            _MOCK_BASIC_AUTH_CREDS,
+            _MOCK_USERNAME,
+            _MOCK_PASSWORD,
+            token_store=store,
+        )
+        assert token_mock.call_count == 2
+        assert "grant_type=refresh_token" in token_mock.last_request.text
+
+
+def test_token_store_rejected_refresh(requests_mock, tmp_path):
+    password_mock = requests_mock.post(
+        f"https://{_MOCK_API_NAME}.helki.com/client/token",
+        json={
+            "token_type": _MOCK_TOKEN_TYPE,
+            "access_token": _MOCK_ACCESS_TOKEN,
+            "expires_in": _MOCK_EXPIRES_IN,
+            "refresh_token": _MOCK_REFRESH_TOKEN,
+        },
+        additional_matcher=lambda request: "grant_type=password" in request.text,
+    )
+    # An invalid response to the refresh grant
+    refresh_mock = requests_mock.post(
+        f"https://{_MOCK_API_NAME}.helki.com/client/token",
+        json={"error": "invalid_grant"},
+        additional_matcher=lambda request: "grant_type=refresh_token" in request.text,
+    )
+    store = smartbox.FileTokenStore(str(tmp_path / "tokens.json"))
+    store.save(
+        f"{_MOCK_API_NAME}:{_MOCK_USERNAME}",
+        smartbox.TokenData(
+            "old_access_token",
+            "old_refresh_token",
+            datetime.datetime.now() + datetime.timedelta(seconds=5),
+        ),
+    )
+
+    # Falls back to the password grant
+    session = smartbox.Session(
+        _MOCK_API_NAME,
+        _MOCK_BASIC_AUTH_CREDS,
+        _MOCK_USERNAME,
+        _MOCK_PASSWORD,
+        token_store=store,
+    )
+    assert refresh_mock.call_count == 1
+    assert password_mock.call_count == 1
+    assert session.get_access_token() == _MOCK_ACCESS_TOKEN
+
+
+def test_token_store_shared_refresh(requests_mock, tmp_path):
+    requests_mock.post(
+        f"https://{_MOCK_API_NAME}.helki.com/client/token",
+        json={
+            "token_type": _MOCK_TOKEN_TYPE,
+            "access_token": _MOCK_ACCESS_TOKEN,
+            "expires_in": _MOCK_EXPIRES_IN,
+            "refresh_token": _MOCK_REFRESH_TOKEN,
+        },
+        additional_matcher=lambda request: "grant_type=password" in request.text,
+    )
+    new_access_token = "sf8s9f09dfsj"
+    refresh_mock = _mock_refresh_response(requests_mock, new_access_token)
+    store = smartbox.SqliteTokenStore(str(tmp_path / "tokens.db"))
+
+    with freeze_time("2021-01-15 23:23:45") as frozen_datetime:
+        session_1 = smartbox.Session(
+            _MOCK_API_NAME,
+            _MOCK_BASIC_AUTH_CREDS,
+            _MOCK_USERNAME,
+            _MOCK_PASSWORD,
+            token_store=store,
+        )
+        session_2 = smartbox.Session(
+            _MOCK_API_NAME,
+            _MOCK_BASIC_AUTH_CREDS,
+            _MOCK_USERNAME,
+            _MOCK_PASSWORD,
+            token_store=store,
+        )
+        frozen_datetime.move_to(
+            session_1.get_expiry_time() - datetime.timedelta(seconds=5)
+        )
+        session_1._check_refresh()
+        assert refresh_mock.call_count == 1
+
+        # second session picks up the refreshed token from the store
+        session_2._check_refresh()
+        assert refresh_mock.call_count == 1
+        assert session_2.get_access_token() == new_access_token
+        assert session_2.get_expiry_time() == session_1.get_expiry_time()
+
+
+def test_rate_limit_retry_after(requests_mock):
+    api_name = "api-ratelimited"
+    requests_mock.post(
+        f"https://{api_name}.helki.com/client/token",
+        json={
+            "token_type": _MOCK_TOKEN_TYPE,
+            "access_token": _MOCK_ACCESS_TOKEN,
+            "expires_in": _MOCK_EXPIRES_IN,
+            "refresh_token": _MOCK_REFRESH_TOKEN,
+        },
+    )
+    session = smartbox.Session(
+        api_name,
+        _MOCK_BASIC_AUTH_CREDS,
+        _MOCK_USERNAME,
+        _MOCK_PASSWORD,
+        rate_limit=100,
+    )
+    devs_mock = requests_mock.get(
+        f"https://{api_name}.helki.com/api/v2/devs",
+        [
+            {"status_code": 429, "headers": {"Retry-After": "0.1"}},
+            {"json": {"devs": [{"dev_id": _MOCK_DEV_ID}]}},
+        ],
+    )
+    start = time.monotonic()
+    assert session.get_devices() == [{"dev_id": _MOCK_DEV_ID}]
+    assert time.monotonic() - start >= 0.09
+    assert devs_mock.call_count == 2
+    stats = session.get_rate_limit_stats()
+    assert stats["read_admitted"] == 2
+    assert stats["pauses"] == 1
+
+    requests_mock.post(
+        f"https://{api_name}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/mgr/away_status",
+        json={"away": True},
+    )
+    session.set_device_away_status(_MOCK_DEV_ID, {"away": True})
+    assert session.get_rate_limit_stats()["write_admitted"] == 1
+
+
+def test_parse_retry_after():
+    from smartbox.session import _parse_retry_after
+
+    assert _parse_retry_after(None) is None
+    assert _parse_retry_after("5") == 5
+    assert _parse_retry_after("-1") == 0
+    assert _parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert _parse_retry_after("garbage") is None
+
+
+def test_metrics(requests_mock):
+    requests_mock.post(
+        f"https://{_MOCK_API_NAME}.helki.com/client/token",
+        json={
+            "token_type": _MOCK_TOKEN_TYPE,
+            "access_token": _MOCK_ACCESS_TOKEN,
+            "expires_in": _MOCK_EXPIRES_IN,
+            "refresh_token": _MOCK_REFRESH_TOKEN,
+        },
+    )
+    metrics = smartbox.PrometheusSessionMetrics()
+    session = smartbox.Session(
+        _MOCK_API_NAME,
+        _MOCK_BASIC_AUTH_CREDS,
+        _MOCK_USERNAME,
+        _MOCK_PASSWORD,
+        metrics=metrics,
+    )
+    for addr in (1, 2):
+        requests_mock.get(
+            f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/htr/{addr}/status",
+            json={"mtemp": "20.0"},
+        )
+        session.get_status(_MOCK_DEV_ID, {"type": "htr", "addr": addr})
+    requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/mgr/away_status",
+        status_code=500,
+    )
+    with pytest.raises(HTTPError):
+        session.get_device_away_status(_MOCK_DEV_ID)
+
+    endpoint = "devs/{dev}/{type}/{addr}/status"
+    assert metrics.get_latency("GET", endpoint).count == 2
+    assert metrics.get_request_count("GET", endpoint, "200") == 2
+    assert metrics.get_request_count("GET", "devs/{dev}/mgr/away_status", "500") == 1
+    exported = metrics.export_prometheus()
+    labels = f'method="GET",endpoint="{endpoint}",status="200"'
+    assert f"smartbox_requests_total{{{labels}}} 2" in exported
+    assert 'smartbox_auth_duration_seconds_count{grant_type="password"} 1' in exported
+
+
+def test_unsupported_endpoints(requests_mock, session):
+    htr_node = {"addr": 1, "name": "My heater", "type": "htr"}
+    pmo_node = {"addr": 2, "name": "My power monitor", "type": "pmo"}
+
+    # pmo status is known to be unsupported, so isn't requested
+    call_count = requests_mock.call_count
+    assert not session.supports_endpoint("pmo", "status")
+    assert session.get_status(_MOCK_DEV_ID, pmo_node) == {}
+    assert requests_mock.call_count == call_count
+
+    version_mock = requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/htr/1/version",
+        status_code=404,
+    )
+    with pytest.raises(HTTPError):
+        session.get_version(_MOCK_DEV_ID, htr_node)
+    with pytest.raises(smartbox.UnsupportedEndpointError):
+        session.get_version(_MOCK_DEV_ID, htr_node)
+    assert version_mock.call_count == 1
+    assert not session.supports_endpoint("htr", "version", _MOCK_DEV_ID, 1)
+    # Other nodes of the type are still tried
+    assert session.supports_endpoint("htr", "version")
+    assert session.supports_endpoint("htr", "version", _MOCK_DEV_ID, 2)
+
+    requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/htr/1/status",
+        json={"mode": "auto"},
+    )
+    assert session.get_status(_MOCK_DEV_ID, htr_node) == {"mode": "auto"}
+    capabilities = session.get_capabilities()
+    assert capabilities["htr"]["status"] is True
+    assert capabilities["htr"]["version"] is None
+    assert capabilities["htr"]["setup"] is None
+    assert capabilities["pmo"]["status"] is False
+
+    # Errors other than from the request aren't swallowed
+    with pytest.raises(KeyError):
+        session.get_status(_MOCK_DEV_ID, {"type": "htr"})
+
+
+def test_shared_capabilities(requests_mock):
+    requests_mock.post(
+        f"https://{_MOCK_API_NAME}.helki.com/client/token",
+        json={
+            "token_type": _MOCK_TOKEN_TYPE,
+            "access_token": _MOCK_ACCESS_TOKEN,
+            "expires_in": _MOCK_EXPIRES_IN,
+            "refresh_token": _MOCK_REFRESH_TOKEN,
+        },
+    )
+    capabilities = smartbox.CapabilityMap()
+    sessions = [
+        smartbox.Session(
+            _MOCK_API_NAME,
+            _MOCK_BASIC_AUTH_CREDS,
+            username,
+            _MOCK_PASSWORD,
+            capabilities=capabilities,
+        )
+        for username in ("a", "b")
+    ]
+    setup_mock = requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/acm/1/setup",
+        status_code=404,
+    )
+    node = {"addr": 1, "type": "acm"}
+    with pytest.raises(HTTPError):
+        sessions[0].get_setup(_MOCK_DEV_ID, node)
+    with pytest.raises(smartbox.UnsupportedEndpointError):
+        sessions[1].get_setup(_MOCK_DEV_ID, node)
+    assert setup_mock.call_count == 1
+
+    # The same node on another device is unaffected
+    other_mock = requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/other_dev/acm/1/setup",
+        json={"mode": "auto"},
+    )
+    assert sessions[1].get_setup("other_dev", node) == {"mode": "auto"}
+    assert other_mock.call_count == 1
+
+    # Server errors and bad requests don't mark endpoints as unsupported
+    for status_code in (400, 500):
+        status_mock = requests_mock.get(
+            f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/acm/2/status",
+            status_code=status_code,
+        )
+        acm_2 = {"addr": 2, "type": "acm"}
+        assert sessions[0].get_status(_MOCK_DEV_ID, acm_2) == {}
+        calls = status_mock.call_count
+        assert calls >= 1
+        assert sessions[0].supports_endpoint("acm", "status", _MOCK_DEV_ID, 2)
+        # so later requests are still sent
+        assert sessions[0].get_status(_MOCK_DEV_ID, acm_2) == {}
+        assert status_mock.call_count == 2 * calls
+
+
+def test_circuit_breaker(requests_mock, mocker):
+    now = 1000.0
+    mocker.patch("smartbox.circuit_breaker.time.monotonic", side_effect=lambda: now)
+    requests_mock.post(
+        f"https://{_MOCK_API_NAME}.helki.com/client/token",
+        json={
+            "token_type": _MOCK_TOKEN_TYPE,
+            "access_token": _MOCK_ACCESS_TOKEN,
+            "expires_in": _MOCK_EXPIRES_IN,
+            "refresh_token": _MOCK_REFRESH_TOKEN,
+        },
+    )
+    session = smartbox.Session(
+        _MOCK_API_NAME,
+        _MOCK_BASIC_AUTH_CREDS,
+        _MOCK_USERNAME,
+        _MOCK_PASSWORD,
+        circuit_breakers=smartbox.CircuitBreakerRegistry(
+            failure_threshold=2, reset_timeout=10
+        ),
+    )
+    node = {"addr": 1, "type": "htr"}
+    status_mock = requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/htr/1/status",
+        exc=requests.exceptions.ConnectionError,
+    )
+    connected_mock = requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/connected",
+        json={"connected": False},
+    )
+
+    assert session.get_status(_MOCK_DEV_ID, node) == {}
+    assert session.get_status(_MOCK_DEV_ID, node) == {}
+    breaker = session.get_circuit_breaker(_MOCK_DEV_ID)
+    assert breaker.state == smartbox.CircuitState.OPEN
+    # Connection errors aren't taken to mean the endpoint is unsupported
+    assert session.supports_endpoint("htr", "status")
+
+    # Fails fast while open
+    with pytest.raises(smartbox.CircuitOpenError):
+        session.get_device_away_status(_MOCK_DEV_ID)
+    assert session.get_status(_MOCK_DEV_ID, node) == {}
+    assert status_mock.call_count == 2
+
+    # Device still offline after the reset timeout
+    now += 10
+    assert session.get_status(_MOCK_DEV_ID, node) == {}
+    assert connected_mock.call_count == 1
+    assert status_mock.call_count == 2
+    assert breaker.state == smartbox.CircuitState.OPEN
+
+    # Device back online
+    now += 20
+    connected_mock = requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/connected",
+        json={"connected": True},
+    )
+    status_mock = requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/htr/1/status",
+        json={"mode": "auto"},
+    )
+    assert session.get_status(_MOCK_DEV_ID, node) == {"mode": "auto"}
+    assert connected_mock.call_count == 1
+    assert breaker.state == smartbox.CircuitState.CLOSED
+
+
+def test_iter_devices(requests_mock, session):
+    devs = [{"dev_id": f"dev{i}", "name": f"Device {i}"} for i in range(100)]
+    requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs",
+        json={"devs": devs},
+    )
+    groups = [{"id": "g1", "name": "Group", "devs": devs[:2]}]
+    requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/grouped_devs",
+        json=groups,
+    )
+    assert list(session.iter_devices()) == devs
+    assert list(session.iter_grouped_devices()) == groups
+
+    requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs",
+        status_code=500,
+        json={},
+    )
+    with pytest.raises(requests.exceptions.RequestException):
+        list(session.iter_devices())
+
+
+def test_roll_out_prog(requests_mock, session):
+    dev_2 = "9sdfj2lk3"
+    requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs",
+        json={"devs": [{"dev_id": _MOCK_DEV_ID}, {"dev_id": dev_2}]},
+    )
+    nodes = {
+        _MOCK_DEV_ID: [{"addr": 1, "type": "htr"}, {"addr": 2, "type": "acm"}],
+        dev_2: [{"addr": 1, "type": "htr"}],
+    }
+    target = smartbox.Programme.from_dict(
+        {"prog": {str(day): [2] * 8 + [0] * 16 for day in range(7)}}
+    )
+    old = target.copy()
+    old.set(0, 0, 1)
+    post_mocks = {}
+    for dev_id, dev_nodes in nodes.items():
+        requests_mock.get(
+            f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{dev_id}/mgr/nodes",
+            json={"nodes": dev_nodes},
+        )
+        for node in dev_nodes:
+            url = f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{dev_id}/{node['type']}/{node['addr']}/prog"
+            current = target if node["type"] == "acm" else old
+            requests_mock.get(url, json=current.to_dict())
+            post_mocks[dev_id, node["type"], node["addr"]] = requests_mock.post(
+                url, json={}
+            )
+
+    key = (_MOCK_DEV_ID, "htr", 1)
+    assert session.get_prog(_MOCK_DEV_ID, {"addr": 1, "type": "htr"}) == old
+    progs = session.get_all_node_states("prog")
+    assert progs[key] == old
+
+    # Only nodes with a different programme are posted
+    rollout = session.roll_out_prog(target)
+    assert sorted(rollout.posted) == sorted([key, (dev_2, "htr", 1)])
+    assert rollout.failed == {}
+    assert post_mocks[key].last_request.json() == target.to_dict()
+    assert post_mocks[_MOCK_DEV_ID, "acm", 2].call_count == 0
+
+    # Restricted to the given nodes, with known current programmes
+    assert session.roll_out_prog(target, nodes=[key], current_progs=progs) == (
+        [key],
+        {},
+    )
+    assert post_mocks[key].call_count == 2
+    assert post_mocks[dev_2, "htr", 1].call_count == 1
+
+    # Only the given nodes' programmes are fetched
+    request_count = requests_mock.call_count
+    assert session.roll_out_prog(target, nodes=[key]).posted == [key]
+    assert requests_mock.call_count == request_count + 2
+
+
+def test_roll_out_prog_failures(requests_mock, session):
+    requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs",
+        json={"devs": [{"dev_id": _MOCK_DEV_ID}]},
+    )
+    requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/mgr/nodes",
+        json={
+            "nodes": [
+                {"addr": 1, "type": "htr"},
+                {"addr": 2, "type": "pmo"},
+                {"addr": 3, "type": "acm"},
+            ]
+        },
+    )
+    node_url = f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}"
+    half_hourly = smartbox.Programme(slots_per_day=48)
+    requests_mock.get(f"{node_url}/htr/1/prog", json=half_hourly.to_dict())
+    requests_mock.get(f"{node_url}/pmo/2/prog", status_code=404, json={})
+    requests_mock.get(f"{node_url}/acm/3/prog", json=half_hourly.to_dict())
+    htr_mock = requests_mock.post(f"{node_url}/htr/1/prog", json={})
+    acm_mock = requests_mock.post(f"{node_url}/acm/3/prog", json={})
+
+    target = smartbox.Programme.from_dict(
+        {"prog": {str(day): [2] * 8 + [0] * 16 for day in range(7)}}
+    )
+    # The pmo node doesn't stop the rollout, and the hourly programme is
+    # resampled for nodes with half-hour slots
+    rollout = session.roll_out_prog(target)
+    assert sorted(rollout.posted) == [
+        (_MOCK_DEV_ID, "acm", 3),
+        (_MOCK_DEV_ID, "htr", 1),
+    ]
+    assert list(rollout.failed) == [(_MOCK_DEV_ID, "pmo", 2)]
+    assert isinstance(rollout.failed[_MOCK_DEV_ID, "pmo", 2], requests.HTTPError)
+    assert htr_mock.last_request.json() == target.resample(48).to_dict()
+
+    # A programme using half-hour slots can't be posted to an hourly node
+    requests_mock.get(f"{node_url}/htr/1/prog", json=target.to_dict())
+    half_hour = smartbox.Programme(slots_per_day=48)
+    half_hour.set(0, 1, 2)
+    rollout = session.roll_out_prog(half_hour, nodes=[(_MOCK_DEV_ID, "htr", 1)])
+    assert rollout.posted == []
+    assert isinstance(rollout.failed[_MOCK_DEV_ID, "htr", 1], ValueError)
+    assert htr_mock.call_count == 1
+    assert acm_mock.call_count == 1
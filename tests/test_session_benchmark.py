@@ -0,0 +1,108 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import pytest
+import threading
+
+import smartbox
+
+_MOCK_API_NAME = "myapi"
+_MOCK_BASIC_AUTH_CREDS = "sldjfls93r2lkj"
+_MOCK_USERNAME = "xxxxx"
+_MOCK_PASSWORD = "yyyyy"
+_MOCK_DEV_ID = "2o3jo2jkj"
+_REQUESTS_PER_ROUND = 128
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    # Keep connections alive so we measure pooled connection reuse
+    protocol_version = "HTTP/1.1"
+    # Avoid delayed ACK stalls between the header and body writes
+    disable_nagle_algorithm = True
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self._send_json(
+            {
+                "token_type": "bearer",
+                "access_token": "sj32oj2lkwjf",
+                "expires_in": 14400,
+                "refresh_token": "23ij2oij324j3423",
+            }
+        )
+
+    def do_GET(self):
+        self._send_json({"devs": [{"dev_id": _MOCK_DEV_ID, "name": "My device"}]})
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def stand_in_server():
+    server = ThreadingHTTPServer(("localhost", 0), _StandInHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://localhost:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def _create_session(api_host, num_threads):
+    return smartbox.Session(
+        _MOCK_API_NAME,
+        _MOCK_BASIC_AUTH_CREDS,
+        _MOCK_USERNAME,
+        _MOCK_PASSWORD,
+        pool_maxsize=num_threads,
+        pool_block=True,
+        tcp_keepalive=30,
+        api_host=api_host,
+    )
+
+
+def _run_requests(session, executor):
+    results = list(
+        executor.map(lambda _: session.get_devices(), range(_REQUESTS_PER_ROUND))
+    )
+    assert all(r[0]["dev_id"] == _MOCK_DEV_ID for r in results)
+
+
+def test_concurrent_requests_reuse_pool(stand_in_server, caplog):
+    num_threads = 32
+    session = _create_session(stand_in_server, num_threads)
+    try:
+        with caplog.at_level(logging.WARNING, logger="urllib3"):
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                _run_requests(session, executor)
+    finally:
+        session.close()
+    assert not any("pool is full" in r.getMessage() for r in caplog.records)
+
+
+@pytest.mark.benchmark(group="session-throughput")
+@pytest.mark.parametrize("num_threads", [1, 4, 16, 64])
+def test_benchmark_session_throughput(benchmark, stand_in_server, num_threads):
+    session = _create_session(stand_in_server, num_threads)
+    try:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            benchmark.pedantic(
+                _run_requests, args=(session, executor), rounds=3, warmup_rounds=1
+            )
+        # No stats with --benchmark-disable
+        if benchmark.stats is not None:
+            benchmark.extra_info["requests_per_second"] = (
+                _REQUESTS_PER_ROUND / benchmark.stats.stats.mean
+            )
+    finally:
+        session.close()
@@ -0,0 +1,179 @@
+import pytest
+import time
+from urllib.parse import parse_qs
+
+import smartbox
+from smartbox.session_pool import _get_object_size
+
+_MOCK_API_NAME = "myapi"
+_MOCK_OTHER_API_NAME = "myotherapi"
+_MOCK_BASIC_AUTH_CREDS = "sldjfls93r2lkj"
+_MOCK_PASSWORD = "yyyyy"
+_MOCK_EXPIRES_IN = 14400
+_MOCK_DEV_ID = "2o3jo2jkj"
+
+
+def _token_response(request, context):
+    credentials = parse_qs(request.text)
+    if credentials["grant_type"] == ["password"]:
+        return {
+            "token_type": "bearer",
+            "access_token": f"access-{credentials['username'][0]}",
+            "expires_in": _MOCK_EXPIRES_IN,
+            "refresh_token": "refresh",
+        }
+    return {
+        "token_type": "bearer",
+        "access_token": "refreshed",
+        # Far enough ahead that we don't refresh again during the test
+        "expires_in": _MOCK_EXPIRES_IN * 10,
+        "refresh_token": "refresh",
+    }
+
+
+@pytest.fixture
+def token_mocks(requests_mock):
+    return {
+        api_name: requests_mock.post(
+            f"https://{api_name}.helki.com/client/token", json=_token_response
+        )
+        for api_name in (_MOCK_API_NAME, _MOCK_OTHER_API_NAME)
+    }
+
+
+def _get_session(pool, username, api_name=_MOCK_API_NAME):
+    return pool.get_session(api_name, _MOCK_BASIC_AUTH_CREDS, username, _MOCK_PASSWORD)
+
+
+def test_get_session(token_mocks):
+    pool = smartbox.SessionPool()
+    session_a = _get_session(pool, "a")
+    assert session_a.get_access_token() == "access-a"
+    assert _get_session(pool, "a") is session_a
+    assert token_mocks[_MOCK_API_NAME].call_count == 1
+
+    session_b = _get_session(pool, "b")
+    session_other = _get_session(pool, "a", _MOCK_OTHER_API_NAME)
+    assert session_b is not session_a
+    assert len(pool) == 3
+    assert (_MOCK_OTHER_API_NAME, "a") in pool
+
+    # Connection pools are shared per host
+    assert session_b._requests is session_a._requests
+    assert session_other._requests is not session_a._requests
+    assert pool.stats()["hosts"] == 2
+
+    assert pool.remove(_MOCK_API_NAME, "b")
+    assert not pool.remove(_MOCK_API_NAME, "b")
+    assert len(pool) == 2
+    pool.close()
+    assert len(pool) == 0
+
+
+def test_lru_eviction(token_mocks):
+    pool = smartbox.SessionPool(max_sessions=2)
+    session_a = _get_session(pool, "a")
+    _get_session(pool, "b")
+    # a is now the most recently used
+    assert _get_session(pool, "a") is session_a
+    _get_session(pool, "c")
+    assert (_MOCK_API_NAME, "a") in pool
+    assert (_MOCK_API_NAME, "b") not in pool
+    assert (_MOCK_API_NAME, "c") in pool
+    assert pool.stats()["evictions"] == 1
+    assert pool.stats()["scheduled_refreshes"] == 2
+
+    # Evicted sessions are recreated on demand
+    _get_session(pool, "b")
+    assert (_MOCK_API_NAME, "a") not in pool
+    assert token_mocks[_MOCK_API_NAME].call_count == 4
+
+    with pytest.raises(ValueError):
+        smartbox.SessionPool(max_sessions=0)
+
+
+def test_idle_eviction(token_mocks):
+    pool = smartbox.SessionPool(idle_timeout=60)
+    session_a = _get_session(pool, "a")
+    _get_session(pool, "b")
+    assert pool.evict_idle() == 0
+    session_a._last_used -= 120
+    assert pool.evict_idle() == 1
+    assert (_MOCK_API_NAME, "a") not in pool
+    assert (_MOCK_API_NAME, "b") in pool
+    assert smartbox.SessionPool().evict_idle() == 0
+
+
+def test_refresh_scheduler(requests_mock, token_mocks):
+    def short_lived_token_response(request, context):
+        response = _token_response(request, context)
+        if response["access_token"] != "refreshed":
+            response["expires_in"] = 1
+        return response
+
+    # Tokens expire sooner than the lead time, so are refreshed half way
+    # through their lifetime
+    token_mocks[_MOCK_API_NAME] = requests_mock.post(
+        f"https://{_MOCK_API_NAME}.helki.com/client/token",
+        json=short_lived_token_response,
+    )
+    pool = smartbox.SessionPool(refresh_lead_time=300)
+    sessions = [_get_session(pool, username) for username in ("a", "b", "c")]
+    pool.start_refresh_scheduler()
+    deadline = time.monotonic() + 5
+    while pool.stats()["refreshes"] < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pool.stop_refresh_scheduler()
+    assert all(s.get_access_token() == "refreshed" for s in sessions)
+    stats = pool.stats()
+    assert stats["refreshes"] == 3
+    assert stats["refresh_failures"] == 0
+    assert stats["scheduled_refreshes"] == 3
+    assert token_mocks[_MOCK_API_NAME].call_count == 6
+    pool.close()
+
+
+def test_refresh_scheduler_backoff(token_mocks, mocker):
+    pool = smartbox.SessionPool()
+    session = _get_session(pool, "a")
+    key = (_MOCK_API_NAME, "a")
+    mocker.patch.object(session, "_refresh", side_effect=RuntimeError("failed"))
+    mocker.patch("smartbox.session_pool.time.time", return_value=1000.0)
+    retry_at = []
+    for _ in range(4):
+        with pool._lock:
+            pool._push_refresh(key, 0.0)
+        pool._refresh_due()
+        retry_at.append(pool._refresh_at[key])
+    assert retry_at == [1030.0, 1060.0, 1120.0, 1240.0]
+    assert pool.stats()["refresh_failures"] == 4
+
+    # Backoff resets after a success
+    session._refresh.side_effect = None
+    with pool._lock:
+        pool._push_refresh(key, 0.0)
+    pool._refresh_due()
+    assert key not in pool._refresh_retries
+    pool.close()
+
+
+def test_memory_usage(requests_mock, token_mocks):
+    pool = smartbox.SessionPool(cache_ttl=60)
+    session_a = _get_session(pool, "a")
+    _get_session(pool, "b")
+    usage = pool.get_memory_usage()
+    assert set(usage.keys()) == {(_MOCK_API_NAME, "a"), (_MOCK_API_NAME, "b")}
+    # The shared requests session isn't counted
+    assert all(
+        0 < size < _get_object_size(session_a._requests, set())
+        for size in usage.values()
+    )
+
+    requests_mock.get(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs",
+        json={"devs": [{"dev_id": f"{_MOCK_DEV_ID}{i}"} for i in range(100)]},
+    )
+    session_a.get_devices()
+    new_usage = pool.get_memory_usage()
+    assert new_usage[(_MOCK_API_NAME, "a")] > usage[(_MOCK_API_NAME, "a")] + 1000
+    assert new_usage[(_MOCK_API_NAME, "b")] == usage[(_MOCK_API_NAME, "b")]
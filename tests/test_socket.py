@@ -1,10 +1,11 @@
 from aiohttp import web
 import asyncio
+import datetime
 import logging
 import pytest
 import socketio
 
-from smartbox import SocketSession
+from smartbox import CircuitBreaker, CircuitState, SocketSession, SocketState
 
 from const import MOCK_ACCESS_TOKEN, MOCK_DEV_ID
 
@@ -335,3 +336,151 @@ async def test_connect_retry_failure(mock_session, mocker):
     mock_async_client.connect.assert_awaited()
     mock_async_client.disconnect.assert_not_awaited()
     mock_async_client.wait.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "message,expires_in,token_failure",
+    [
+        ("Unexpected status code 401 in server response", 3600, True),
+        ("Unexpected status code 403 in server response", 3600, True),
+        ("Unexpected status code 502 in server response", -10, True),
+        ("Unexpected status code 502 in server response", 3600, False),
+        ("Connection refused by the server", 3600, False),
+    ],
+)
+async def test_connect_failure_circuit(
+    mock_session, mocker, message, expires_in, token_failure
+):
+    mock_async_client = mocker.MagicMock()
+
+    async def connect_side_effect(*args, **kwargs):
+        raise socketio.exceptions.ConnectionError(message)
+
+    class TestFinishedException(Exception):
+        pass
+
+    mock_session._check_refresh = mocker.MagicMock(side_effect=TestFinishedException)
+    mock_session.get_expiry_time.return_value = (
+        datetime.datetime.now() + datetime.timedelta(seconds=expires_in)
+    )
+    mock_async_client.connect = mocker.AsyncMock(side_effect=connect_side_effect)
+    mock_async_client.disconnect = mocker.AsyncMock()
+    mock_async_client.wait = mocker.AsyncMock()
+    mocker.patch("socketio.AsyncClient", return_value=mock_async_client)
+    circuit_breaker = CircuitBreaker(failure_threshold=1)
+    socket_session = SocketSession(
+        mock_session,
+        MOCK_DEV_ID,
+        reconnect_attempts=1,
+        circuit_breaker=circuit_breaker,
+    )
+
+    with pytest.raises(TestFinishedException):
+        await socket_session.run()
+
+    # Token failures don't open the circuit shared with the REST session
+    expected = CircuitState.CLOSED if token_failure else CircuitState.OPEN
+    assert circuit_breaker.state == expected
+
+
+@pytest.mark.asyncio
+async def test_token_rotation(mock_session, mocker):
+    namespace = "/api/v2/socket_io"
+    clients = []
+    disconnected = {}
+
+    async def connect(sio, url, namespaces):
+        clients.append((sio, url))
+        sio.namespace_handlers[namespace].on_connect()
+
+    async def wait(sio):
+        await disconnected.setdefault(sio, asyncio.Event()).wait()
+
+    async def disconnect(sio):
+        disconnected.setdefault(sio, asyncio.Event()).set()
+
+    mocker.patch.object(socketio.AsyncClient, "connect", connect)
+    mocker.patch.object(socketio.AsyncClient, "wait", wait)
+    mocker.patch.object(socketio.AsyncClient, "disconnect", disconnect)
+    mocker.patch.object(socketio.AsyncClient, "emit", mocker.AsyncMock())
+    mocker.patch("smartbox.socket._ROTATION_RETRY_INTERVAL", 0.01)
+
+    # The first token expires within the rotation lead time, and refreshing
+    # gets a new one
+    now = datetime.datetime.now()
+    expiry_times = [now + datetime.timedelta(seconds=30)]
+    mock_session.get_expiry_time.side_effect = lambda: (
+        expiry_times.pop(0) if expiry_times else now + datetime.timedelta(hours=4)
+    )
+
+    def refresh(min_lifetime):
+        assert min_lifetime == 60
+        mock_session._access_token = _MOCK_ACCESS_TOKEN_2
+
+    mock_session.refresh_token_if_expiring.side_effect = refresh
+
+    dev_data = []
+    updates = []
+    socket_session = SocketSession(
+        mock_session,
+        MOCK_DEV_ID,
+        dev_data.append,
+        updates.append,
+        rotate_before_expiry=60,
+    )
+    client_task = asyncio.create_task(socket_session.run())
+
+    async def wait_for(condition):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(wait_for(lambda: len(clients) == 2), 5)
+    assert f"token={MOCK_ACCESS_TOKEN}" in clients[0][1]
+    assert f"token={_MOCK_ACCESS_TOKEN_2}" in clients[1][1]
+    old_ns = clients[0][0].namespace_handlers[namespace]
+    new_ns = clients[1][0].namespace_handlers[namespace]
+    assert socket_session.namespace is old_ns
+
+    update = {"path": "/htr/1/status", "body": {"stemp": "16.0"}}
+    active = {"path": "/htr/1/status", "body": {"active": True}}
+    inactive = {"path": "/htr/1/status", "body": {"active": False}}
+    await old_ns.on_dev_data(_TEST_DEV_DATA)
+    # A connection repeating an update isn't a duplicate
+    await old_ns.on_update(active)
+    await old_ns.on_update(inactive)
+    await old_ns.on_update(active)
+    await old_ns.on_update(_TEST_UPDATE_1)
+    # Updates on the new connection are ignored until it has switched over
+    await new_ns.on_update(update)
+    await new_ns.on_update(update)
+    await old_ns.on_update(_TEST_UPDATE_2)
+    await new_ns.on_dev_data(_TEST_DEV_DATA)
+    assert socket_session.namespace is new_ns
+    # Duplicates across the switch and updates from the old connection are
+    # dropped
+    await new_ns.on_update(_TEST_UPDATE_2)
+    await old_ns.on_update(update)
+    await new_ns.on_update(update)
+    # nor is the new connection repeating an update it has already matched
+    await new_ns.on_update(_TEST_UPDATE_2)
+
+    # No resync, and the old connection is closed without a reconnect
+    assert dev_data == [_TEST_DEV_DATA]
+    assert updates == [
+        active,
+        inactive,
+        active,
+        _TEST_UPDATE_1,
+        _TEST_UPDATE_2,
+        update,
+        _TEST_UPDATE_2,
+    ]
+    await asyncio.wait_for(wait_for(lambda: socket_session.rotations == 1), 5)
+    assert disconnected[clients[0][0]].is_set()
+    await asyncio.sleep(0.05)
+    assert len(clients) == 2
+    assert socket_session.state == SocketState.CONNECTED
+
+    await socket_session.cancel()
+    await client_task
@@ -0,0 +1,117 @@
+import asyncio
+import pytest
+import socketio
+
+from smartbox import SocketFleet, SocketState, UpdateManager
+
+_API_V2_NAMESPACE = "/api/v2/socket_io"
+
+
+@pytest.fixture
+def mock_sio(mocker):
+    """Patch socketio so connections succeed without a server, tracking
+    concurrent connects."""
+    connects = {"current": 0, "max": 0, "total": 0}
+
+    async def connect(sio, url, namespaces):
+        connects["current"] += 1
+        connects["total"] += 1
+        connects["max"] = max(connects["max"], connects["current"])
+        await asyncio.sleep(0.01)
+        connects["current"] -= 1
+        sio.namespace_handlers[_API_V2_NAMESPACE].on_connect()
+
+    async def wait(sio):
+        await asyncio.sleep(3600)
+
+    mocker.patch.object(socketio.AsyncClient, "connect", connect)
+    mocker.patch.object(socketio.AsyncClient, "wait", wait)
+    mocker.patch.object(socketio.AsyncClient, "disconnect", mocker.AsyncMock())
+    mocker.patch.object(socketio.AsyncClient, "send", mocker.AsyncMock())
+    return connects
+
+
+async def _wait_for(condition, timeout=5):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+async def test_connect(mock_session, mock_sio):
+    fleet = SocketFleet(mock_session, max_concurrent_connects=3)
+    device_ids = [f"dev{i}" for i in range(10)]
+    for device_id in device_ids:
+        fleet.add_device(device_id)
+    assert len(fleet) == 10
+    assert "dev3" in fleet
+    assert set(fleet.get_states().values()) == {SocketState.DISCONNECTED}
+    with pytest.raises(ValueError):
+        fleet.add_device("dev0")
+
+    task = asyncio.create_task(fleet.run())
+    await _wait_for(lambda: fleet.stats()["connected"] == 10)
+    assert mock_sio["max"] == 3
+    assert fleet.get_states() == {d: SocketState.CONNECTED for d in device_ids}
+
+    # Devices added while running are started
+    update_manager = fleet.add_update_manager("dev10")
+    assert isinstance(update_manager, UpdateManager)
+    assert fleet.get_socket_session("dev10") is update_manager.socket_session
+    await _wait_for(lambda: fleet.stats()["connected"] == 11)
+
+    await fleet.remove_device("dev0")
+    assert "dev0" not in fleet
+
+    await fleet.cancel()
+    await task
+    stats = fleet.stats()
+    assert stats["closed"] == 10
+    assert stats["devices"] == 10
+
+
+async def test_ping_wheel(mock_session, mocker):
+    pings = []
+
+    async def send_ping(socket_session):
+        pings.append(socket_session.device_id)
+        return True
+
+    mocker.patch("smartbox.socket.SocketSession.send_ping", send_ping)
+    mocker.patch("smartbox.socket.SocketSession.run", mocker.AsyncMock())
+    fleet = SocketFleet(mock_session, ping_interval=0.2, wheel_slots=4)
+    for i in range(8):
+        fleet.add_device(f"dev{i}")
+    assert all(
+        s._ping_task is None and not s._send_pings
+        for s in map(fleet.get_socket_session, [f"dev{i}" for i in range(8)])
+    )
+
+    task = asyncio.create_task(fleet.run())
+    await asyncio.sleep(0.45)
+    await fleet.cancel()
+    await task
+
+    # Devices are spread evenly over the wheel, and each is pinged once per
+    # interval
+    assert [len(slot) for slot in fleet._wheel] == [2, 2, 2, 2]
+    assert len(pings) >= 8
+    assert set(pings[:8]) == {f"dev{i}" for i in range(8)}
+    assert pings[8:] == pings[: len(pings) - 8]
+    assert fleet.stats()["pings"] == len(pings)
+
+
+async def test_ping_errors(mock_session, mocker):
+    mocker.patch(
+        "smartbox.socket.SocketSession.send_ping",
+        mocker.AsyncMock(side_effect=ConnectionError),
+    )
+    mocker.patch("smartbox.socket.SocketSession.run", mocker.AsyncMock())
+    fleet = SocketFleet(mock_session, ping_interval=0.05, wheel_slots=1)
+    fleet.add_device("dev0")
+    task = asyncio.create_task(fleet.run())
+    await _wait_for(lambda: fleet.stats()["ping_errors"] > 0)
+    await fleet.cancel()
+    await task
+    assert fleet.stats()["pings"] == 0
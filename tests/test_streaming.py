@@ -0,0 +1,84 @@
+import json
+import pytest
+
+from smartbox.streaming import JSONArrayParser, iter_json_array
+
+_DEVS = [
+    {"dev_id": f"dev{i}", "name": f"Device é{i}", "fw_version": 1.5 + i}
+    for i in range(20)
+]
+
+
+def _chunks(data, size):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 64, 100000])
+def test_iter_json_array(size):
+    body = json.dumps(
+        {"count": 20, "meta": {"a": [1, {"b": "]}"}]}, "devs": _DEVS, "after": 1},
+        indent=2,
+    ).encode()
+    assert list(iter_json_array(_chunks(body, size), "devs")) == _DEVS
+
+    body = json.dumps(_DEVS).encode()
+    assert list(iter_json_array(_chunks(body, size))) == _DEVS
+
+
+def test_numbers_across_chunks():
+    assert list(iter_json_array([b"[12", b"34, 5", b"6]"])) == [1234, 56]
+    # Top-level number at the end of the body
+    assert list(iter_json_array([b'{"a": 12', b'3, "b": [1]}'], "b")) == [1]
+
+
+def test_strings_across_chunks():
+    body = b'["a\\"b", "\\\\", {"c": "]}\\u00e9"}]'
+    expected = ['a"b', "\\", {"c": "]}\u00e9"}]
+    assert json.loads(body) == expected
+    for size in range(1, len(body)):
+        assert list(iter_json_array(_chunks(body, size))) == expected
+
+
+def test_large_element():
+    # Each chunk is scanned once, rather than rescanning the element from its
+    # start
+    parser = JSONArrayParser()
+    parser.feed(b'[{"values": [')
+    for _ in range(1000):
+        assert parser.feed(b'"x", ' * 100) == []
+    assert parser._scan_pos == len(parser._buffer)
+    assert parser.feed(b'"y"]}]') == [{"values": ["x"] * 100000 + ["y"]}]
+    assert parser.done
+
+
+def test_empty():
+    assert list(iter_json_array([b'{"devs": []}'], "devs")) == []
+    assert list(iter_json_array([b" [ ] "])) == []
+
+
+def test_yields_incrementally():
+    parser = JSONArrayParser("devs")
+    assert parser.feed(b'{"devs": [{"dev_id": "a"}, {"dev_') == [{"dev_id": "a"}]
+    assert parser.feed(b'id": "b"') == []
+    # Complete objects don't need to wait for the next chunk, unlike numbers
+    assert parser.feed(b"}") == [{"dev_id": "b"}]
+    assert parser.feed(b"]") == []
+    assert parser.done
+    assert parser.close() == []
+
+
+def test_errors():
+    with pytest.raises(KeyError):
+        list(iter_json_array([b'{"other": []}'], "devs"))
+    with pytest.raises(KeyError):
+        list(iter_json_array([b"{}"], "devs"))
+    with pytest.raises(ValueError):
+        list(iter_json_array([b'{"devs": {}}'], "devs"))
+    with pytest.raises(ValueError):
+        list(iter_json_array([b"[1, 2"]))
+    with pytest.raises(ValueError):
+        list(iter_json_array([b"[1 2]"]))
+    with pytest.raises(ValueError):
+        list(iter_json_array([b"[1, nope]"]))
+    with pytest.raises(ValueError):
+        list(iter_json_array([b"[1]"], "devs"))
@@ -0,0 +1,74 @@
+import datetime
+import os
+import pytest
+import threading
+import time
+
+from smartbox.token_store import FileTokenStore, SqliteTokenStore, TokenData
+
+_TEST_TOKEN = TokenData(
+    "sj32oj2lkwjf", "23ij2oij324j3423", datetime.datetime(2021, 1, 15, 23, 23, 45)
+)
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def store_factory(request, tmp_path):
+    if request.param == "file":
+        return lambda: FileTokenStore(str(tmp_path / "tokens.json"))
+    return lambda: SqliteTokenStore(str(tmp_path / "tokens.db"))
+
+
+def test_load_save(store_factory):
+    store = store_factory()
+    assert store.load("api:user") is None
+    store.save("api:user", _TEST_TOKEN)
+    assert store.load("api:user") == _TEST_TOKEN
+    assert store.load("api:other") is None
+
+    # visible to other instances
+    other_store = store_factory()
+    assert other_store.load("api:user") == _TEST_TOKEN
+
+    new_token = _TEST_TOKEN._replace(access_token="j323jf3202")
+    with other_store.lock():
+        other_store.save("api:user", new_token)
+    assert store.load("api:user") == new_token
+
+
+def test_lock_exclusion(store_factory):
+    store_1 = store_factory()
+    store_2 = store_factory()
+    events = []
+    locked = threading.Event()
+
+    def hold_lock():
+        with store_1.lock():
+            locked.set()
+            time.sleep(0.2)
+            events.append("released")
+
+    thread = threading.Thread(target=hold_lock)
+    thread.start()
+    locked.wait()
+    with store_2.lock():
+        events.append("acquired")
+    thread.join()
+    assert events == ["released", "acquired"]
+
+
+def test_lock_reentrant(store_factory):
+    store = store_factory()
+    with store.lock():
+        with store.lock():
+            store.save("api:user", _TEST_TOKEN)
+    assert store.load("api:user") == _TEST_TOKEN
+
+
+def test_file_permissions(store_factory, tmp_path):
+    store = store_factory()
+    with store.lock():
+        store.save("api:user", _TEST_TOKEN)
+    paths = list(tmp_path.iterdir())
+    assert paths
+    for path in paths:
+        assert os.stat(path).st_mode & 0o777 == 0o600, path
@@ -1,8 +1,13 @@
+import asyncio
+import concurrent.futures
 import logging
 import re
+import threading
 from typing import Any, Dict, List
 from unittest.mock import patch
 
+from smartbox.dispatch import DispatchQueue, OverflowPolicy
+from smartbox.session import Session
 from smartbox.update_manager import (
     DevDataSubscription,
     OptimisedJQMatcher,
@@ -241,3 +246,385 @@ async def test_integration(mocker, mock_session, caplog):
         power_limit_update_sub.assert_called_with("500")
         power_limit_specific_sub.assert_called_with(500)
         assert isinstance(power_limit_specific_sub.call_args[0][0], int)
+
+
+async def test_setup_cache_updates(mocker):
+    session = mocker.MagicMock(spec=Session)
+    session.setup_cache_enabled = True
+    session._check_refresh = mocker.MagicMock()
+    with patch("smartbox.update_manager.SocketSession.run") as mock_socket_run:
+        update_manager = UpdateManager(session, MOCK_DEV_ID)
+
+        async def send_data() -> None:
+            await _socket_dev_data(
+                update_manager,
+                {"nodes": [{"addr": 1, "type": "htr", "setup": {"units": "C"}}]},
+            )
+            await _socket_update(
+                update_manager, {"path": "/htr/1/setup", "body": {"units": "F"}}
+            )
+
+        mock_socket_run.side_effect = send_data
+        await update_manager.run()
+
+    assert session.update_setup_cache.call_args_list == [
+        mocker.call(MOCK_DEV_ID, "htr", 1, {"units": "C"}),
+        mocker.call(MOCK_DEV_ID, "htr", 1, {"units": "F"}),
+    ]
+
+
+def test_dev_data_subscription_previous():
+    result = []
+    sub = DevDataSubscription(".nodes[]", result.append)
+    node1 = {"addr": 1, "status": {"mtemp": "20.0"}}
+    node2 = {"addr": 2, "status": {"mtemp": "21.0"}}
+
+    # Everything delivered if the subscription hasn't seen dev data yet
+    assert sub.match({"nodes": [node1, node2]}, {"nodes": [node1, node2]}) == 2
+    assert result == [node1, node2]
+
+    result.clear()
+    changed = {"addr": 2, "status": {"mtemp": "21.5"}}
+    assert sub.match({"nodes": [node1, changed]}, {"nodes": [node1, node2]}) == 1
+    assert result == [changed]
+
+    result.clear()
+    assert sub.match({"nodes": [node1, changed]}) == 2
+    assert result == [node1, changed]
+
+
+async def test_resync_diffing(mocker, mock_session, caplog):
+    caplog.set_level(logging.INFO)
+    with patch("smartbox.update_manager.SocketSession.run") as mock_socket_run:
+        update_manager = UpdateManager(mock_session, MOCK_DEV_ID)
+        dev_data = {
+            "away_status": {"away": False},
+            "htr_system": {"setup": {"power_limit": "0"}},
+            "nodes": [
+                {"addr": 1, "type": "htr", "status": {"mtemp": "20.0"}},
+                {"addr": 2, "type": "htr", "status": {"mtemp": "21.0"}},
+                {"addr": 3, "type": "acm", "status": {"mtemp": "19.0"}},
+            ],
+        }
+        status_sub = mocker.MagicMock()
+        update_manager.subscribe_to_node_status(status_sub)
+        away_sub = mocker.MagicMock()
+        update_manager.subscribe_to_device_away_status(away_sub)
+        power_limit_sub = mocker.MagicMock()
+        update_manager.subscribe_to_device_power_limit(power_limit_sub)
+
+        async def send_data() -> None:
+            await _socket_dev_data(update_manager, dev_data)
+            await _socket_update(
+                update_manager, {"path": "/htr/1/status", "body": {"mtemp": "20.5"}}
+            )
+            await _socket_update(
+                update_manager, {"path": "/mgr/away_status", "body": {"away": True}}
+            )
+            await _socket_update(
+                update_manager,
+                {"path": "/htr_system/power_limit", "body": {"power_limit": "500"}},
+            )
+            status_sub.reset_mock()
+            away_sub.reset_mock()
+            power_limit_sub.reset_mock()
+
+            # Reconnect: node 1, away status and power limit are as updated,
+            # only node 2 has changed
+            resync = {
+                "away_status": {"away": True},
+                "htr_system": {"setup": {"power_limit": "500"}},
+                "nodes": [
+                    {"addr": 1, "type": "htr", "status": {"mtemp": "20.5"}},
+                    {"addr": 2, "type": "htr", "status": {"mtemp": "22.0"}},
+                    {"addr": 3, "type": "acm", "status": {"mtemp": "19.0"}},
+                ],
+            }
+            await _socket_dev_data(update_manager, resync)
+
+        mock_socket_run.side_effect = send_data
+        assert update_manager.last_resync is None
+        await update_manager.run()
+
+    status_sub.assert_called_once_with("htr", 2, {"mtemp": "22.0"})
+    away_sub.assert_not_called()
+    power_limit_sub.assert_not_called()
+    assert update_manager.last_resync == (1, 5)
+    assert update_manager.stats() == {
+        "resyncs": 1,
+        "resync_changed": 1,
+        "resync_total": 5,
+        "callbacks_pending": 0,
+        "callbacks_completed": 0,
+        "callback_errors": 0,
+        "callbacks_dropped": 0,
+    }
+    _assert_log_message(
+        "smartbox.update_manager",
+        logging.INFO,
+        "Resync changed 1 of 5 items",
+        caplog.record_tuples,
+    )
+    # Dev data passed to subscribers isn't modified by later updates
+    assert dev_data["nodes"][0]["status"] == {"mtemp": "20.0"}
+
+
+async def test_resync_diffing_disabled(mocker, mock_session):
+    with patch("smartbox.update_manager.SocketSession.run") as mock_socket_run:
+        update_manager = UpdateManager(mock_session, MOCK_DEV_ID, resync_diffing=False)
+        dev_data = {"nodes": [{"addr": 1, "type": "htr", "status": {"mtemp": "20"}}]}
+        status_sub = mocker.MagicMock()
+        update_manager.subscribe_to_node_status(status_sub)
+
+        async def send_data() -> None:
+            await _socket_dev_data(update_manager, dev_data)
+            await _socket_dev_data(update_manager, dev_data)
+
+        mock_socket_run.side_effect = send_data
+        await update_manager.run()
+
+    assert status_sub.call_count == 2
+    assert update_manager.last_resync is None
+
+
+async def test_dispatch_queue(mocker, mock_session):
+    queue = DispatchQueue(policy=OverflowPolicy.COALESCE)
+    with patch("smartbox.update_manager.SocketSession.run") as mock_socket_run:
+        update_manager = UpdateManager(mock_session, MOCK_DEV_ID, dispatch_queue=queue)
+        status_sub = mocker.MagicMock()
+        update_manager.subscribe_to_node_status(status_sub)
+
+        async def send_data() -> None:
+            await _socket_dev_data(
+                update_manager,
+                {"nodes": [{"addr": 1, "type": "htr", "status": {"mtemp": "20"}}]},
+            )
+            for mtemp in ("21", "22"):
+                await _socket_update(
+                    update_manager,
+                    {"path": "/htr/1/status", "body": {"mtemp": mtemp}},
+                )
+            # Queued rather than called in the receive loop
+            status_sub.assert_not_called()
+
+        mock_socket_run.side_effect = send_data
+        await update_manager.run()
+
+    await queue.join()
+    assert status_sub.call_args_list == [
+        mocker.call("htr", 1, {"mtemp": "20"}),
+        mocker.call("htr", 1, {"mtemp": "22"}),
+    ]
+    assert queue.stats()["coalesced"] == 1
+    await queue.close()
+
+
+async def test_dispatch_queue_executor(mocker, mock_session):
+    loop_thread = threading.get_ident()
+    threads = []
+    statuses = []
+
+    def status_callback(node_type, addr, status):
+        threads.append(threading.get_ident())
+        statuses.append(status)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        queue = DispatchQueue(policy=OverflowPolicy.COALESCE, executor=executor)
+        with patch("smartbox.update_manager.SocketSession.run") as mock_socket_run:
+            update_manager = UpdateManager(
+                mock_session, MOCK_DEV_ID, dispatch_queue=queue
+            )
+            update_manager.subscribe_to_node_status(status_callback)
+
+            async def send_data() -> None:
+                await _socket_dev_data(
+                    update_manager,
+                    {
+                        "nodes": [
+                            {
+                                "addr": 1,
+                                "type": "htr",
+                                "status": {"mtemp": "20", "stemp": "18"},
+                            }
+                        ]
+                    },
+                )
+                # Coalesced, with the partial bodies merged
+                await _socket_update(
+                    update_manager,
+                    {"path": "/htr/1/status", "body": {"mtemp": "21"}},
+                )
+                await _socket_update(
+                    update_manager,
+                    {"path": "/htr/1/status", "body": {"stemp": "19"}},
+                )
+
+            mock_socket_run.side_effect = send_data
+            await update_manager.run()
+        await queue.join()
+        await update_manager.wait_for_callbacks()
+        await queue.close()
+
+    # State is updated on the event loop, and the blocking user callback is
+    # run in the executor
+    assert queue.stats()["coalesced"] == 1
+    assert update_manager._state["nodes"][0]["status"] == {
+        "mtemp": "21",
+        "stemp": "19",
+    }
+    assert statuses == [
+        {"mtemp": "20", "stemp": "18"},
+        {"mtemp": "21", "stemp": "19"},
+    ]
+    assert loop_thread not in threads
+
+
+async def test_coroutine_callbacks(mock_session, caplog):
+    with patch("smartbox.update_manager.SocketSession.run") as mock_socket_run:
+        update_manager = UpdateManager(
+            mock_session, MOCK_DEV_ID, max_concurrent_callbacks=2
+        )
+        running = 0
+        max_running = 0
+        statuses = []
+        setups = []
+
+        async def status_callback(node_type, addr, status):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            # Later calls finish sooner, but must still be in order
+            await asyncio.sleep(0.01 / (len(statuses) + 1))
+            statuses.append((node_type, addr, status))
+            running -= 1
+
+        async def setup_callback(node_type, addr, setup):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.005)
+            running -= 1
+            if setup["fail"]:
+                raise RuntimeError("Setup callback failed")
+            setups.append(setup)
+
+        update_manager.subscribe_to_node_status(status_callback)
+        update_manager.subscribe_to_node_setup(setup_callback)
+
+        async def send_data() -> None:
+            await _socket_dev_data(
+                update_manager,
+                {
+                    "nodes": [
+                        {
+                            "addr": 1,
+                            "type": "htr",
+                            "status": {"mtemp": "20"},
+                            "setup": {"fail": True},
+                        }
+                    ]
+                },
+            )
+            for mtemp in ("21", "22", "23"):
+                await _socket_update(
+                    update_manager,
+                    {"path": "/htr/1/status", "body": {"mtemp": mtemp}},
+                )
+            await _socket_update(
+                update_manager, {"path": "/htr/1/setup", "body": {"fail": False}}
+            )
+            # Scheduled rather than awaited in the receive loop
+            assert statuses == []
+
+        mock_socket_run.side_effect = send_data
+        await update_manager.run()
+        await update_manager.wait_for_callbacks()
+
+    assert statuses == [
+        ("htr", 1, {"mtemp": mtemp}) for mtemp in ("20", "21", "22", "23")
+    ]
+    # The failure didn't stop later calls
+    assert setups == [{"fail": False}]
+    assert max_running == 2
+    stats = update_manager.stats()
+    assert stats["callbacks_pending"] == 0
+    assert stats["callbacks_completed"] == 6
+    assert stats["callback_errors"] == 1
+    _assert_log_message(
+        "smartbox.update_manager",
+        logging.ERROR,
+        "Error in subscription callback",
+        caplog.record_tuples,
+    )
+
+
+async def test_dev_data_subscription_coroutine():
+    result = []
+
+    async def callback(data):
+        result.append(data)
+
+    sub = DevDataSubscription(".foo[]", callback)
+    assert sub.match({"foo": [1, 2]}) == 2
+    assert result == []
+    await asyncio.sleep(0.01)
+    assert result == [1, 2]
+
+
+async def test_coroutine_callbacks_from_thread():
+    loop_thread = threading.get_ident()
+    threads = []
+
+    async def callback(data):
+        threads.append(threading.get_ident())
+
+    sub = DevDataSubscription(".foo[]", callback)
+    sub.match({"foo": [1]})
+    # Once the event loop is known, callbacks can be scheduled from any thread
+    await asyncio.get_running_loop().run_in_executor(None, sub.match, {"foo": [2]})
+    await asyncio.sleep(0.01)
+    assert threads == [loop_thread] * 2
+
+
+async def test_max_pending_callbacks(mock_session, caplog):
+    with patch("smartbox.update_manager.SocketSession.run") as mock_socket_run:
+        update_manager = UpdateManager(
+            mock_session, MOCK_DEV_ID, max_pending_callbacks_per_key=2
+        )
+        release = asyncio.Event()
+        statuses = []
+
+        async def status_callback(node_type, addr, status):
+            await release.wait()
+            statuses.append(status["mtemp"])
+
+        update_manager.subscribe_to_node_status(status_callback)
+
+        async def send_data() -> None:
+            await _socket_dev_data(update_manager, {"nodes": []})
+            for mtemp in range(5):
+                await _socket_update(
+                    update_manager,
+                    {"path": "/htr/1/status", "body": {"mtemp": mtemp}},
+                )
+                # Let the worker start the first call
+                await asyncio.sleep(0)
+            # One running, and the latest two waiting
+            assert update_manager.stats()["callbacks_pending"] == 3
+
+        mock_socket_run.side_effect = send_data
+        await update_manager.run()
+        release.set()
+        await update_manager.wait_for_callbacks()
+
+    # The oldest waiting calls were dropped
+    assert statuses == [0, 3, 4]
+    stats = update_manager.stats()
+    assert stats["callbacks_dropped"] == 2
+    assert stats["callbacks_completed"] == 3
+    _assert_log_message(
+        "smartbox.update_manager",
+        logging.WARNING,
+        "Dropped subscription callback",
+        caplog.record_tuples,
+    )
@@ -0,0 +1,140 @@
+import pytest
+from requests.exceptions import HTTPError
+import time
+
+import smartbox
+
+_MOCK_API_NAME = "myapi"
+_MOCK_BASIC_AUTH_CREDS = "sldjfls93r2lkj"
+_MOCK_USERNAME = "xxxxx"
+_MOCK_PASSWORD = "yyyyy"
+_MOCK_DEV_ID = "2o3jo2jkj"
+_MOCK_NODE = {"addr": 1, "name": "My heater", "type": "htr"}
+_STATUS_URL = (
+    f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/htr/1/status"
+)
+
+
+@pytest.fixture
+def session(requests_mock):
+    requests_mock.post(
+        f"https://{_MOCK_API_NAME}.helki.com/client/token",
+        json={
+            "token_type": "bearer",
+            "access_token": "sj32oj2lkwjf",
+            "expires_in": 14400,
+            "refresh_token": "23ij2oij324j3423",
+        },
+    )
+    return smartbox.Session(
+        _MOCK_API_NAME, _MOCK_BASIC_AUTH_CREDS, _MOCK_USERNAME, _MOCK_PASSWORD
+    )
+
+
+def test_coalesce_status(requests_mock, session):
+    status_mock = requests_mock.post(_STATUS_URL, json={"mode": "manual"})
+    buffer = smartbox.WriteBuffer(session, window=0.05)
+    futures = [
+        buffer.set_status(_MOCK_DEV_ID, _MOCK_NODE, {"mode": "auto"}),
+        buffer.set_status(_MOCK_DEV_ID, _MOCK_NODE, {"stemp": "21.0", "units": "C"}),
+        buffer.set_status(_MOCK_DEV_ID, _MOCK_NODE, {"mode": "manual", "locked": None}),
+    ]
+    assert buffer.pending == 1
+    assert [f.result(timeout=5) for f in futures] == [{"mode": "manual"}] * 3
+    assert status_mock.call_count == 1
+    assert status_mock.last_request.json() == {
+        "mode": "manual",
+        "stemp": "21.0",
+        "units": "C",
+    }
+    assert buffer.stats() == {"writes": 3, "posts": 1, "pending": 0}
+
+
+def test_separate_keys(requests_mock, session):
+    status_mock = requests_mock.post(_STATUS_URL, json={})
+    other_status_mock = requests_mock.post(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/htr/2/status",
+        json={},
+    )
+    away_mock = requests_mock.post(
+        f"https://{_MOCK_API_NAME}.helki.com/api/v2/devs/{_MOCK_DEV_ID}/mgr/away_status",
+        json={"away": True, "enabled": True},
+    )
+    buffer = smartbox.WriteBuffer(session, window=10)
+    buffer.set_status(_MOCK_DEV_ID, _MOCK_NODE, {"mode": "auto"})
+    buffer.set_status(_MOCK_DEV_ID, {"addr": 2, "type": "htr"}, {"mode": "off"})
+    buffer.set_device_away_status(_MOCK_DEV_ID, {"away": True})
+    away_future = buffer.set_device_away_status(_MOCK_DEV_ID, {"enabled": True})
+    assert buffer.pending == 3
+    assert not away_future.done()
+
+    buffer.flush()
+    assert away_future.result() == {"away": True, "enabled": True}
+    assert away_mock.last_request.json() == {"away": True, "enabled": True}
+    assert status_mock.call_count == 1
+    assert other_status_mock.last_request.json() == {"mode": "off"}
+    assert buffer.stats() == {"writes": 4, "posts": 3, "pending": 0}
+
+
+def test_max_delay(requests_mock, session):
+    status_mock = requests_mock.post(_STATUS_URL, json={})
+    buffer = smartbox.WriteBuffer(session, window=0.1, max_delay=0.2)
+    futures = []
+    for i in range(8):
+        futures.append(
+            buffer.set_status(_MOCK_DEV_ID, _MOCK_NODE, {"stemp": str(i), "units": "C"})
+        )
+        time.sleep(0.05)
+    for future in futures:
+        future.result(timeout=5)
+    # Writes kept arriving within the window, but max_delay forced sends
+    assert 2 <= status_mock.call_count < 8
+
+
+def test_errors(requests_mock, session):
+    requests_mock.post(_STATUS_URL, status_code=400, json={"error": "Bad request"})
+    buffer = smartbox.WriteBuffer(session, window=0.01)
+    future = buffer.set_status(_MOCK_DEV_ID, _MOCK_NODE, {"mode": "auto"})
+    with pytest.raises(HTTPError):
+        future.result(timeout=5)
+
+    # Validation happens on the merged write
+    future = buffer.set_status(_MOCK_DEV_ID, _MOCK_NODE, {"stemp": "21.0"})
+    with pytest.raises(ValueError):
+        future.result(timeout=5)
+
+    buffer.close()
+    with pytest.raises(RuntimeError):
+        buffer.set_status(_MOCK_DEV_ID, _MOCK_NODE, {"mode": "auto"})
+
+
+def test_serialised_sends(mocker, session):
+    active = []
+    overlaps = []
+    sent = []
+
+    def slow_set_status(device_id, node, status_args):
+        if active:
+            overlaps.append(status_args)
+        active.append(status_args)
+        time.sleep(0.3)
+        sent.append(status_args["stemp"])
+        active.remove(status_args)
+        return {}
+
+    mocker.patch.object(session, "set_status", side_effect=slow_set_status)
+    buffer = smartbox.WriteBuffer(session, window=0.01)
+    futures = []
+    for i in range(3):
+        futures.append(
+            buffer.set_status(_MOCK_DEV_ID, _MOCK_NODE, {"stemp": str(i), "units": "C"})
+        )
+        time.sleep(0.05)
+    for future in futures:
+        future.result(timeout=5)
+    # The first write was in flight while the others were buffered, so they
+    # were merged and sent after it completed
+    assert overlaps == []
+    assert sent == ["0", "2"]
+    assert buffer.stats() == {"writes": 3, "posts": 2, "pending": 0}
+    buffer.close()